@@ -18,8 +18,42 @@ Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
 
 __version__ = '0.6.0'
 
-from .top_level import ColorMatcher
-from .hist_matcher import HistogramMatcher
-from .mvgd_matcher import TransferMVGD
-from .reinhard_matcher import ReinhardMatcher
-from .baseclass import MatcherBaseclass
+METHODS = ('default', 'hm', 'reinhard', 'mvgd', 'mkl', 'hm-mvgd-hm', 'hm-mkl-hm')
+
+# public classes are imported on first access (PEP 562) so that the package and its CLI start without numpy
+_LAZY_ATTRS = {
+    'ColorMatcher': 'top_level',
+    'HistogramMatcher': 'hist_matcher',
+    'TransferMVGD': 'mvgd_matcher',
+    'ReinhardMatcher': 'reinhard_matcher',
+    'MatcherBaseclass': 'baseclass',
+    'ReferenceModel': 'ref_model',
+    'ColorTransform': 'color_transform',
+    'TiledMatcher': 'tiled_matcher',
+    'VideoMatcher': 'video_matcher',
+    'Lut3D': 'lut3d',
+    'StatsCache': 'stats_cache',
+    'MomentAccumulator': 'accumulators',
+    'HistAccumulator': 'accumulators',
+    'ReferenceAccumulator': 'accumulators',
+    'ReferenceIndex': 'ref_index',
+}
+
+__all__ = ['__version__', 'METHODS'] + list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+
+    if name not in _LAZY_ATTRS:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+    from importlib import import_module
+    value = getattr(import_module('.' + _LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
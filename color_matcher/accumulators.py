@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from color_matcher.baseclass import MatcherBaseclass
+from color_matcher.hist_matcher import HistogramMatcher
+from color_matcher.mvgd_matcher import CHUNK_SIZE
+from color_matcher.reinhard_matcher import ReinhardMatcher, LAB_MAT, LN10
+from color_matcher.ref_model import ReferenceModel
+from color_matcher import METHODS
+
+
+class MomentAccumulator(object):
+
+    def __init__(self, channels: int = 3, lab: bool = False):
+        """
+        Mergeable accumulator of pixel count, channel means and the sum of centered outer products, which yields the
+        moments of :meth:`TransferMVGD.mvgd_stats` (or :meth:`ReinhardMatcher.lab_moments` in Lab space) from pixels
+        fed chunk by chunk. Chunks are combined by the pairwise update of Chan et al., which avoids the cancellation
+        of raw sums of squares, so that accumulators of parallel processes can be merged in any order.
+
+        :param channels: Number of color channels
+        :param lab: Whether RGB pixels are converted to Lab space of Reinhard's method before accumulation
+        """
+
+        self.channels = channels
+        self.lab = lab
+        self.w = 0.
+        self.w2 = 0.
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros((channels, channels))
+
+    def update(self, pixels: np.ndarray = None, weights: np.ndarray = None):
+        """
+        Accumulate pixels of an image or a chunk.
+
+        :param pixels: Array of shape (..., C) whose last axis holds the color channels
+        :param weights: Optional non-negative weights of shape (...) (e.g. from a boolean mask)
+
+        :type pixels: :class:`~numpy:numpy.ndarray`
+        :type weights: :class:`~numpy:numpy.ndarray`
+
+        :return: **self**
+        :rtype: MomentAccumulator
+        """
+
+        rows = np.asarray(pixels).reshape(-1, np.shape(pixels)[-1])[:, :self.channels]
+        if rows.shape[1] != self.channels:
+            raise BaseException('Accumulator expects %s color channels' % self.channels)
+        weights = None if weights is None else np.asarray(weights, dtype=np.float64).reshape(-1)
+
+        for i in range(0, rows.shape[0], CHUNK_SIZE):
+            chunk = ReinhardMatcher.log_lms(rows[i:i+CHUNK_SIZE]) @ (LAB_MAT.T / LN10) if self.lab else \
+                rows[i:i+CHUNK_SIZE].astype(np.float64)
+            w = np.ones(chunk.shape[0]) if weights is None else weights[i:i+CHUNK_SIZE]
+            w_sum = w.sum()
+            if w_sum == 0:
+                continue
+            mean = (w @ chunk) / w_sum
+            chunk -= mean
+            self.combine(w_sum, w @ w, mean, chunk.T @ (chunk * w[:, np.newaxis]))
+
+        return self
+
+    def merge(self, other):
+        """ combine the moments of another accumulator (e.g. of a different process) into this one """
+
+        if other.channels != self.channels or other.lab != self.lab:
+            raise BaseException('Accumulators of different channels or color spaces cannot be merged')
+        if other.w > 0:
+            self.combine(other.w, other.w2, other.mean, other.m2)
+
+        return self
+
+    def combine(self, w: float, w2: float, mean: np.ndarray, m2: np.ndarray):
+        """ pairwise update of weight sums, means and centered outer products (Chan et al.) """
+
+        total = self.w + w
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (w / total)
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * (self.w * w / total)
+        self.w, self.w2 = total, self.w2 + w2
+
+    def stats(self) -> tuple:
+        """
+        Moments of the accumulated pixels.
+
+        :return: **stats**: color channel means of shape (C, 1) and unbiased covariance matrix as from
+                 :meth:`TransferMVGD.mvgd_stats`, or (mean, std) vectors as from :meth:`ReinhardMatcher.lab_moments`
+                 in Lab space
+        :rtype: tuple
+        """
+
+        if self.w == 0:
+            raise BaseException('No pixels accumulated')
+        if self.lab:
+            return self.mean.copy(), np.sqrt(np.maximum(np.diagonal(self.m2) / self.w, 0))
+
+        return self.mean[:, np.newaxis], self.m2 / (self.w - self.w2 / self.w)
+
+
+class HistAccumulator(object):
+
+    def __init__(self, channels: int = 3, bins: int = 4096, value_range: tuple = (0, 1)):
+        """
+        Mergeable accumulator of channel-wise integer histograms, which yields the (values, cdf) pairs of
+        :meth:`HistogramMatcher.hist_stats`. Counts of 8- and 16-bit integer pixels are exact over the domain of their
+        type, whereas float pixels are counted in equally spaced bins over a fixed value range (values outside are
+        assigned to the outer bins) as the range of a stream is not known beforehand. Without bins, counts of all
+        unique values are kept instead, which is exact for any type but grows with the number of distinct values.
+
+        :param channels: Number of color channels
+        :param bins: Number of bins for float pixels (None for counts of unique values)
+        :param value_range: Range of float pixels covered by the bins
+        """
+
+        self.channels = channels
+        self.bins = bins
+        self.value_range = tuple(float(val) for val in value_range)
+        self.dtype = None
+        self.cnts = None
+        self.vals = None
+
+    def update(self, pixels: np.ndarray = None, weights: np.ndarray = None):
+        """
+        Accumulate pixels of an image or a chunk.
+
+        :param pixels: Array of shape (..., C) whose last axis holds the color channels
+        :param weights: Optional non-negative weights of shape (...) (e.g. from a boolean mask)
+
+        :type pixels: :class:`~numpy:numpy.ndarray`
+        :type weights: :class:`~numpy:numpy.ndarray`
+
+        :return: **self**
+        :rtype: HistAccumulator
+        """
+
+        pixels = np.asarray(pixels)
+        pixels = pixels[..., np.newaxis] if self.channels == 1 and pixels.shape[-1] != 1 else pixels
+        rows = pixels.reshape(-1, pixels.shape[-1])[:, :self.channels]
+        if rows.shape[1] != self.channels:
+            raise BaseException('Accumulator expects %s color channels' % self.channels)
+        weights = None if weights is None else np.asarray(weights, dtype=np.float64).reshape(-1)
+
+        # counts of unique values per channel which are merged with those accumulated so far
+        if self.bins is None:
+            if self.dtype is None:
+                self.dtype, self.vals, self.cnts = rows.dtype, [], []
+            elif self.dtype != rows.dtype:
+                raise BaseException('Pixels of type %s cannot be counted with those of type %s' % (rows.dtype,
+                                                                                                   self.dtype))
+            for ch in range(self.channels):
+                vals, idxs = np.unique(rows[:, ch], return_inverse=True)
+                self.add_counts(ch, vals, np.bincount(idxs.ravel(), weights, minlength=vals.size))
+            return self
+
+        # counts are kept in the domain of the first type and in float for weights
+        exact = np.issubdtype(rows.dtype, np.integer) and rows.dtype.itemsize <= 2
+        dtype = rows.dtype if exact else np.dtype('float64')
+        if self.dtype is None:
+            size = 2**(8*dtype.itemsize) if exact else self.bins
+            self.dtype = dtype
+            self.cnts = np.zeros((self.channels, size), dtype=np.int64 if weights is None else np.float64)
+        elif self.dtype != dtype:
+            raise BaseException('Pixels of type %s cannot be counted with those of type %s' % (dtype, self.dtype))
+        if weights is not None and self.cnts.dtype != np.float64:
+            self.cnts = self.cnts.astype(np.float64)
+
+        lo, hi = self.value_range
+        scale = self.bins / (hi - lo)
+        for ch in range(self.channels):
+            vec = rows[:, ch]
+            if exact:
+                idxs = HistogramMatcher.int_bincount(vec)[1] if vec.size else vec.astype(np.intp)
+            else:
+                idxs = HistogramMatcher.bin_index(np.clip(vec, lo, hi), lo, scale, self.bins)[0]
+            self.cnts[ch] += np.bincount(idxs, weights, minlength=self.cnts.shape[1]).astype(self.cnts.dtype)
+
+        return self
+
+    def add_counts(self, ch: int = 0, vals: np.ndarray = None, cnts: np.ndarray = None):
+        """ add counts of sorted unique values to those of a channel in the mode without bins """
+
+        if ch == len(self.vals):
+            self.vals.append(vals)
+            self.cnts.append(cnts)
+        else:
+            vals, idxs = np.unique(np.concatenate([self.vals[ch], vals]), return_inverse=True)
+            self.vals[ch] = vals
+            self.cnts[ch] = np.bincount(idxs.ravel(), np.concatenate([self.cnts[ch], cnts]), minlength=vals.size)
+
+    def merge(self, other):
+        """ add the counts of another accumulator (e.g. of a different process) to this one """
+
+        if other.cnts is None:
+            return self
+        if (other.channels, other.value_range) != (self.channels, self.value_range) or \
+                (self.cnts is not None and other.bins != self.bins):
+            raise BaseException('Accumulators of different channels or bins cannot be merged')
+        if self.cnts is None:
+            self.bins, self.dtype = other.bins, other.dtype
+            self.cnts = [cnts.copy() for cnts in other.cnts] if self.bins is None else other.cnts.copy()
+            self.vals = None if other.vals is None else [vals.copy() for vals in other.vals]
+        elif self.dtype != other.dtype:
+            raise BaseException('Accumulators of types %s and %s cannot be merged' % (self.dtype, other.dtype))
+        elif self.bins is None:
+            for ch in range(self.channels):
+                self.add_counts(ch, other.vals[ch], other.cnts[ch])
+        else:
+            self.cnts = self.cnts + other.cnts
+
+        return self
+
+    def stats(self) -> tuple:
+        """
+        Cumulative distributions of the accumulated pixels.
+
+        :return: **stats**: tuple of (values, cdf) pairs per color channel as from :meth:`HistogramMatcher.hist_stats`
+        :rtype: tuple
+        """
+
+        if self.cnts is None or not np.any(self.cnts[0] > 0):
+            raise BaseException('No pixels accumulated')
+
+        stats = []
+        for ch, cnts in enumerate(self.cnts):
+            if self.bins is None:
+                mask = cnts > 0
+                stats.append((self.vals[ch][mask], np.cumsum(cnts[mask]).astype(np.float64) / cnts.sum()))
+            elif np.issubdtype(self.dtype, np.integer):
+                mask = cnts > 0
+                vals = np.flatnonzero(mask) + int(np.iinfo(self.dtype).min)
+                stats.append((vals, np.cumsum(cnts[mask]).astype(np.float64) / cnts.sum()))
+            else:
+                # bin edges enclosing non-empty bins between which values are distributed uniformly
+                edges = np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+                mask = np.append(cnts > 0, False) | np.append(False, cnts > 0)
+                cdf = np.append(0, np.cumsum(cnts)).astype(np.float64) / cnts.sum()
+                stats.append((edges[mask], cdf[mask]))
+
+        return tuple(stats)
+
+
+class ReferenceAccumulator(object):
+
+    def __init__(self, method: str = None, channels: int = 3, bins: int = 4096, value_range: tuple = (0, 1)):
+        """
+        Streaming fit of a :class:`ReferenceModel` from many images or chunks (e.g. all frames of a shot) which are
+        never held in memory at once. Accumulators of several processes can be merged before the model is built.
+        The analytical MVGD solver requires reference pixels and is therefore not supported. Gray scale values of
+        integer references are counted exactly as by :meth:`ColorMatcher.fit`, whereas those of float references are
+        binned like their color channels.
+
+        :param method: Method out of METHODS to accumulate statistics for or None for all methods
+        :param channels: Number of color channels of the reference (1 or 3)
+        :param bins: Number of histogram bins for float pixels (see :class:`HistAccumulator`)
+        :param value_range: Range of float pixels covered by the histogram bins
+        """
+
+        self.method = method.lower() if method is not None else None
+        if self.method is not None and self.method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+        if channels not in (1, 3):
+            raise BaseException('Accumulator supports references with 1 or 3 color channels')
+
+        methods = METHODS if self.method is None else (self.method,)
+        self.channels = channels
+        self.hist = HistAccumulator(channels, bins, value_range) \
+            if channels == 1 or any('hm' in m.split('-') for m in methods) else None
+        self.gray = HistAccumulator(1, bins, value_range) if channels == 3 else None
+        self.moments = MomentAccumulator(channels) \
+            if channels > 1 and any(m not in METHODS[1:3] for m in methods) else None
+        self.lab = MomentAccumulator(channels, lab=True) if channels == 3 and METHODS[2] in methods else None
+        self.shape = None
+
+    def accumulators(self) -> list:
+        return [acc for acc in (self.hist, self.gray, self.moments, self.lab) if acc is not None]
+
+    def update(self, img: np.ndarray = None, weights: np.ndarray = None):
+        """
+        Accumulate statistics of a reference image or chunk of shape (H, W, C) (alpha channels are ignored).
+
+        :param img: Image array or chunk of rows
+        :param weights: Optional non-negative weights of shape (H, W) (e.g. from a boolean mask)
+
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type weights: :class:`~numpy:numpy.ndarray`
+
+        :return: **self**
+        :rtype: ReferenceAccumulator
+        """
+
+        img = np.asarray(img)
+        img = img[..., np.newaxis] if len(img.shape) == 2 else img
+        if img.shape[-1] not in (self.channels, self.channels + 1):
+            raise BaseException('Accumulator expects %s color channels' % self.channels)
+        img = img[..., :self.channels]
+        self.shape = tuple(img.shape[-3:-1]) + (self.channels,) if self.shape is None else self.shape
+
+        for acc in (self.hist, self.moments, self.lab):
+            if acc is not None:
+                acc.update(img, weights)
+        if self.gray is not None:
+            # unique gray values of integer pixels as these lie off the integer grid
+            if self.gray.cnts is None and np.issubdtype(img.dtype, np.integer):
+                self.gray.bins = None
+            self.gray.update(MatcherBaseclass.rgb2gray(img.reshape((-1, 1, 3))), weights)
+
+        return self
+
+    def merge(self, other):
+        """ combine the statistics of another accumulator (e.g. of a different process) into this one """
+
+        if (other.method, other.channels) != (self.method, self.channels):
+            raise BaseException('Accumulators of different methods or channels cannot be merged')
+        for acc, other_acc in zip(self.accumulators(), other.accumulators()):
+            acc.merge(other_acc)
+        self.shape = other.shape if self.shape is None else self.shape
+
+        return self
+
+    def model(self) -> ReferenceModel:
+        """
+        Build the reference model from the accumulated statistics.
+
+        :return: **model**: Reference model to be passed wherever a reference image is expected
+        :rtype: ReferenceModel
+        """
+
+        mu, cov = self.moments.stats() if self.moments is not None else (None, None)
+        gray = None
+        if self.gray is not None:
+            gray = ReferenceModel(method=self.method, shape=self.shape[:2] + (1,), hist=self.gray.stats())
+
+        return ReferenceModel(method=self.method, shape=self.shape,
+                              hist=self.hist.stats() if self.hist is not None else None,
+                              lab=self.lab.stats() if self.lab is not None else None,
+                              mu=mu, cov=cov, gray=gray)
@@ -16,9 +16,14 @@ Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import numbers
+
 import numpy as np
 import warnings
 
+from .ref_model import ReferenceModel
+
 
 class MatcherBaseclass(object):
 
@@ -28,6 +33,32 @@ class MatcherBaseclass(object):
         self._ref = None
         self._funs = []
 
+        # pixel subsampling for estimation of statistics (fraction or maximum pixel count)
+        self._stats_sample = None
+        self._stats_sampler = 'random'
+        self._stats_seed = 0
+        self.stats_err = dict()
+
+        # floating point type of computations (None selects float32 for 8-bit and single precision sources)
+        self._dtype = None
+
+        # on-disk cache of reference statistics (StatsCache or directory)
+        self._stats_cache = None
+
+        # number of bins for approximate histogram matching of float images (None for exact matching)
+        self._hist_bins = None
+
+        # number of threads for channel- and tile-parallel computations (None for serial execution)
+        self._n_threads = None
+
+        # boolean or weight masks of shape (H, W) for statistics of source and reference and for applying the transfer
+        self._src_mask = None
+        self._ref_mask = None
+        self._apply_mask = None
+
+        # maximum pixel count of reduced-resolution proxies statistics are computed from (None for full resolution)
+        self._proxy_size = None
+
         if len(args) == 2:
             self._src = args[0]
             self._ref = args[1]
@@ -35,6 +66,34 @@ class MatcherBaseclass(object):
         if bool(kwargs):
             self._src = kwargs['src'] if 'src' in kwargs else self._src
             self._ref = kwargs['ref'] if 'ref' in kwargs else self._ref
+            self._stats_sample = kwargs['stats_sample'] if 'stats_sample' in kwargs else self._stats_sample
+            self._stats_sampler = kwargs['stats_sampler'] if 'stats_sampler' in kwargs else self._stats_sampler
+            self._stats_seed = kwargs['stats_seed'] if 'stats_seed' in kwargs else self._stats_seed
+            self._dtype = kwargs['dtype'] if 'dtype' in kwargs else self._dtype
+            self._stats_cache = kwargs['stats_cache'] if 'stats_cache' in kwargs else self._stats_cache
+            self._hist_bins = kwargs['hist_bins'] if 'hist_bins' in kwargs else self._hist_bins
+            self._n_threads = kwargs['n_threads'] if 'n_threads' in kwargs else self._n_threads
+            self._src_mask = kwargs['src_mask'] if 'src_mask' in kwargs else self._src_mask
+            self._ref_mask = kwargs['ref_mask'] if 'ref_mask' in kwargs else self._ref_mask
+            self._apply_mask = kwargs['apply_mask'] if 'apply_mask' in kwargs else self._apply_mask
+            self._proxy_size = kwargs['proxy_size'] if 'proxy_size' in kwargs else self._proxy_size
+
+        if self._stats_sampler not in ('random', 'grid'):
+            raise BaseException('Sampler \'%s\' not recognized' % self._stats_sampler)
+        if self._stats_sample is not None and not (isinstance(self._stats_sample, numbers.Real) and
+                                                   self._stats_sample > 0):
+            raise BaseException('Sample size must be a fraction in (0, 1] or a positive pixel count')
+        if self._dtype is not None and np.dtype(self._dtype) not in (np.float32, np.float64):
+            raise BaseException('Compute type \'%s\' not supported' % self._dtype)
+        if self._hist_bins is not None and int(self._hist_bins) < 2:
+            raise BaseException('Histogram matching requires at least 2 bins')
+        if self._n_threads is not None and int(self._n_threads) < 1:
+            raise BaseException('Number of threads must be a positive integer')
+        if self._proxy_size is not None and int(self._proxy_size) < 1:
+            raise BaseException('Proxy size must be a positive pixel count')
+        if isinstance(self._stats_cache, str):
+            from color_matcher.stats_cache import StatsCache
+            self._stats_cache = StatsCache(self._stats_cache)
 
     def validate_img_dims(self):
         """
@@ -63,7 +122,8 @@ class MatcherBaseclass(object):
             elif self._src.shape[2] == 4 and self._ref.shape[2] == 3:
                 self._src = self._src[..., :3]
             elif self._src.shape[2] == 1 and self._ref.shape[2] == 3:
-                self._ref = self.rgb2gray(self._ref)
+                # fitted reference models carry precomputed monochromatic statistics
+                self._ref = self._ref.gray if isinstance(self._ref, ReferenceModel) else self.rgb2gray(self._ref)
             elif self._src.shape[2] == 3 and self._ref.shape[2] == 1:
                 self._src = self.rgb2gray(self._src)
 
@@ -103,3 +163,192 @@ class MatcherBaseclass(object):
         arr = arr.reshape(shape[:2] + (1,))
 
         return arr
+
+    def compute_dtype(self, img: np.ndarray = None) -> np.dtype:
+        """
+        This function determines the floating point type of computations and results. Unless set by the dtype option,
+        single precision is used for 8-bit integer and float16/float32 images and double precision otherwise.
+
+        :param img: Image array whose type determines the default
+        :type img: :class:`~numpy:numpy.ndarray`
+
+        :return: **dtype**: Floating point type
+        :rtype: np.dtype
+        """
+
+        if self._dtype is not None:
+            return np.dtype(self._dtype)
+
+        img = self._src if img is None else img
+        single = img.dtype.itemsize == 1 or img.dtype in (np.float16, np.float32)
+
+        return np.dtype('float32') if single else np.dtype('float64')
+
+    @staticmethod
+    def run_parallel(fun, args, n_threads: int = None) -> list:
+        """
+        Call a function for each argument either serially or on a pool of threads while keeping the order of results.
+        Threads pay off for NumPy operations on large arrays as these release the GIL, e.g. when independent channels
+        or row tiles of an image are written to disjoint parts of a result array.
+
+        :param fun: Function taking a single argument
+        :param args: Iterable of arguments
+        :param n_threads: Number of threads (None or 1 for serial execution)
+
+        :type fun: :class:`function`
+        :type n_threads: :class:`int`
+
+        :return: **results**: list of return values in the order of arguments
+        :rtype: list
+        """
+
+        args = list(args)
+        if n_threads is None or int(n_threads) < 2 or len(args) < 2:
+            return [fun(arg) for arg in args]
+
+        with ThreadPoolExecutor(max_workers=min(int(n_threads), len(args))) as pool:
+            return list(pool.map(fun, args))
+
+    def sample_pixels(self, img: np.ndarray = None) -> np.ndarray:
+        """
+        This function selects the pixels used for the estimation of statistics. Subsampling is controlled by the
+        stats_sample option, which is either a fraction in (0, 1] (such that 1 selects all pixels) or a maximum pixel
+        count greater than 1, and the stats_sampler option, which picks pixels randomly (with seed stats_seed) or on a
+        regular spatial 'grid' thinned out evenly to the sample size.
+
+        :param img: Image array of shape (..., H, W, C) with optional leading batch dimensions
+        :type img: :class:`~numpy:numpy.ndarray`
+
+        :return: **mat**: Pixel matrix of shape (..., k, C)
+        :rtype: np.ndarray
+        """
+
+        lead, n, ch = img.shape[:-3], int(np.prod(img.shape[-3:-1])), img.shape[-1]
+
+        # number of samples
+        if self._stats_sample is None:
+            k = n
+        elif self._stats_sample <= 1:
+            k = int(round(float(self._stats_sample) * n))
+        else:
+            k = int(self._stats_sample)
+        k = min(max(k, 2), n)
+
+        if k == n:
+            return img.reshape(lead + (n, ch))
+
+        if self._stats_sampler == 'grid':
+            step = max(int(np.floor(np.sqrt(n / k))), 1)
+            mat = img[..., ::step, ::step, :].reshape(lead + (-1, ch))
+            if mat.shape[-2] > k:
+                mat = mat[..., np.linspace(0, mat.shape[-2] - 1, k).round().astype(int), :]
+        else:
+            idxs = np.sort(np.random.default_rng(self._stats_seed).choice(n, size=k, replace=False))
+            mat = img.reshape(lead + (n, ch))[..., idxs, :]
+
+        return mat
+
+    @staticmethod
+    def area_proxy(img: np.ndarray = None, size: int = 10**6, dtype: np.dtype = None) -> np.ndarray:
+        """
+        This function reduces the resolution of an image by averaging blocks of f x f pixels, where the integer factor f
+        is chosen such that the proxy has about size pixels. Blocks at the right and bottom borders may be smaller.
+        Rows of blocks are summed one after another so that no full-resolution copies are created. Proxies of integer
+        images are rounded to the type of the image so that they remain in its units (e.g. 0..255).
+
+        :param img: Image array of shape (H, W, ...) (e.g. a boolean mask of shape (H, W))
+        :param size: Maximum pixel count of the proxy
+        :param dtype: Floating point type of proxies of non-integer images (defaults to float64)
+
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type size: :class:`int`
+        :type dtype: :class:`~numpy:numpy.dtype`
+
+        :return: **proxy**: Proxy image or the image itself if it does not exceed the size
+        :rtype: np.ndarray
+        """
+
+        h, w = img.shape[:2]
+        f = int(np.ceil(np.sqrt(h * w / float(size))))
+        if f < 2:
+            return img
+
+        # block columns and their areas
+        cols = np.arange(0, w, f)
+        widths = np.diff(np.append(cols, w)).reshape((-1,) + (1,) * (len(img.shape) - 2))
+
+        is_int = np.issubdtype(img.dtype, np.integer)
+        dtype = img.dtype if is_int else np.dtype(dtype or 'float64')
+        proxy = np.empty((len(range(0, h, f)), cols.size) + img.shape[2:], dtype=dtype)
+        for i, y in enumerate(range(0, h, f)):
+            rows = np.add.reduceat(img[y:y+f].sum(axis=0, dtype=np.float64), cols, axis=0) / (widths * min(f, h - y))
+            proxy[i] = np.rint(rows) if is_int else rows
+
+        return proxy
+
+    def pixel_weights(self, mask: np.ndarray = None, img: np.ndarray = None, sample: bool = False) -> np.ndarray:
+        """
+        This function flattens a boolean or weight mask to per-pixel weights of an image, where statistics are computed
+        as weighted moments or histograms instead of from masked copies of the image.
+
+        :param mask: Boolean or non-negative weight mask of shape (H, W) or None
+        :param img: Image array of shape (H, W, C) or a :class:`ReferenceModel` the mask refers to
+        :param sample: Whether weights of the pixels selected by :meth:`sample_pixels` are returned
+
+        :type mask: :class:`~numpy:numpy.ndarray`
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type sample: :class:`bool`
+
+        :return: **weights**: Weight vector of pixels or None if no mask is provided
+        :rtype: np.ndarray
+        """
+
+        if mask is None:
+            return None
+
+        mask = np.asarray(mask)
+        if mask.size != int(np.prod(img.shape[:2])):
+            raise BaseException('Mask of shape %s does not match image of shape %s' % (mask.shape, img.shape))
+        mask = mask.reshape(tuple(img.shape[:2]) + (1,))
+        weights = (self.sample_pixels(mask) if sample else mask).reshape(-1).astype(np.float64)
+
+        if np.any(weights < 0) or not np.any(weights > 0):
+            raise BaseException('Mask weights must be non-negative and include at least one pixel')
+
+        return weights
+
+    def sample_err(self, mat: np.ndarray = None, n: int = None, suffix: str = '') -> dict:
+        """
+        Estimate standard errors of statistics computed from a pixel sample with respect to all pixels. Errors are only
+        reported for random samples as pixels on a grid are no independent draws.
+
+        :param mat: Sampled pixel matrix of shape (k, C)
+        :param n: Total number of pixels the sample has been drawn from
+        :param suffix: Suffix appended to the keys of the returned dictionary (e.g. 'r' yields 'mu_r')
+
+        :type mat: :class:`~numpy:numpy.ndarray`
+        :type n: :class:`int`
+        :type suffix: :class:`str`
+
+        :return: **err**: standard errors of means 'mu', covariances 'cov' and deviations 'std' (empty if not sampled)
+        :rtype: dict
+        """
+
+        k = mat.shape[0]
+        if k >= n or self._stats_sampler != 'random':
+            return dict()
+
+        # finite population correction
+        fpc = np.sqrt(1 - k / n)
+
+        mat_c = mat - mat.mean(axis=0)
+        prods = mat_c[:, :, np.newaxis] * mat_c[:, np.newaxis, :]
+        var, var_prods = np.diagonal(prods.mean(axis=0)), prods.var(axis=0)
+
+        err = {
+            'mu': np.sqrt(var / k) * fpc,
+            'cov': np.sqrt(var_prods / k) * fpc,
+            'std': np.sqrt(np.diagonal(var_prods) / k) / (2*np.sqrt(var) + np.spacing(1)) * fpc,
+        }
+
+        return dict((key + '_' + suffix if suffix else key, val) for key, val in err.items())
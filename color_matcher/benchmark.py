@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import getopt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from color_matcher import __version__
+from color_matcher.top_level import ColorMatcher, METHODS
+from color_matcher.io_handler import load_img_file, save_img_file
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_VERSION = 1
+STAGES = ('io_load', 'init_vars', 'solver', 'apply', 'hist_match', 'reinhard', 'io_save')
+PERCENTILES = (50, 90, 99)
+STARTUP_CMDS = {
+    'interpreter': ['-c', 'pass'],
+    'import': ['-c', 'import color_matcher'],
+    'import_matcher': ['-c', 'from color_matcher import ColorMatcher'],
+    'cli_help': ['-m', 'color_matcher.bin.cli', '--help'],
+}
+
+
+def synth_img(height: int = 512, width: int = 512, channels: int = 3, bit_depth: int = 8, seed: int = 0):
+    """
+    Generate a synthetic image of random smooth color gradients with noise.
+
+    :param height: Number of image rows
+    :param width: Number of image columns
+    :param channels: Number of color channels (1, 3 or 4)
+    :param bit_depth: 8 or 16 for unsigned integer and 32 for float32 images in [0, 1]
+    :param seed: Seed of the random generator
+
+    :return: **img**: Image array of shape (height, width, channels)
+    :rtype: np.ndarray
+    """
+
+    if bit_depth not in (8, 16, 32):
+        raise BaseException('Bit depth %s not supported' % bit_depth)
+
+    rng = np.random.default_rng(seed)
+    y, x = np.linspace(0, 1, height)[:, np.newaxis], np.linspace(0, 1, width)[np.newaxis, :]
+
+    img = np.empty((height, width, channels), dtype='float32')
+    for ch, (a, b, c, d) in enumerate(rng.random((channels, 4))):
+        img[..., ch] = (a*x + b*y + c*x*y) / 3 + d / 4
+    img += rng.normal(0, .05, img.shape).astype('float32')
+    np.clip(img, 0, 1, out=img)
+
+    # gray scale images are two-dimensional
+    img = img[..., 0] if channels == 1 else img
+
+    if bit_depth == 32:
+        return img
+
+    dtype = np.uint8 if bit_depth == 8 else np.uint16
+
+    return np.round(img * np.iinfo(dtype).max).astype(dtype)
+
+
+class StageProfiler(object):
+
+    def __init__(self, matcher: ColorMatcher = None):
+        """
+        Measure time and traced memory of processing stages. Methods of a matcher are replaced on the instance by
+        wrappers so that stages called within a transfer (including the fused pipeline) are captured.
+
+        :param matcher: Matcher whose stages are profiled
+        """
+
+        self.times = dict()
+        self.peaks = dict()
+        self.peak = 0
+
+        if matcher is not None:
+            for name in ('init_vars', 'apply_transfer_mat', 'hist_match', 'reinhard'):
+                setattr(matcher, name, self.wrap('apply' if name == 'apply_transfer_mat' else name,
+                                                 getattr(matcher, name)))
+            matcher._fun_dict = {key: self.wrap('solver', fun) for key, fun in matcher._fun_dict.items()}
+
+    def wrap(self, stage: str, fun):
+        """ return function which accumulates time and peak memory of a stage """
+
+        def wrapper(*args, **kwargs):
+            with self.measure(stage):
+                return fun(*args, **kwargs)
+        wrapper.__name__ = fun.__name__
+
+        return wrapper
+
+    def measure(self, stage: str):
+        """ context manager accumulating elapsed time and traced memory allocated on top of the stage entry """
+
+        profiler = self
+
+        class Measure(object):
+
+            def __enter__(self):
+                self.base = profiler.trace_reset()[0]
+                self.start = time.perf_counter()
+
+            def __exit__(self, *args):
+                profiler.times[stage] = profiler.times.get(stage, 0) + time.perf_counter() - self.start
+                if tracemalloc.is_tracing():
+                    peak = profiler.trace_reset()[1]
+                    profiler.peaks[stage] = max(profiler.peaks.get(stage, 0), peak - self.base)
+
+        return Measure()
+
+    def trace_reset(self) -> tuple:
+        """ keep overall peak of traced memory before resetting it and return current and peak traced memory """
+
+        if not tracemalloc.is_tracing():
+            return 0, 0
+
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+
+        return current, peak
+
+
+def save_bench_img(img: np.ndarray = None, file_path: str = None, file_type: str = 'png'):
+    """ write image to file where float images are kept in npy files as their values lie off the 8-bit grid """
+
+    if file_type == 'npy':
+        np.save(file_path + ('' if file_path.endswith('.npy') else '.npy'), img)
+    else:
+        save_img_file(img, file_path, file_type)
+
+
+def load_bench_img(file_path: str = None, dtype: str = None) -> np.ndarray:
+    """ load image written by :func:`save_bench_img` as float type """
+
+    if file_path.endswith('.npy'):
+        img = np.load(file_path)
+        return img.astype(dtype) if dtype else img
+
+    return load_img_file(file_path, dtype=dtype)
+
+
+def peak_rss() -> float:
+    """ peak resident set size of the current process in MB (None if not available on the platform) """
+
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on macOS and kilobytes otherwise
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def latency_stats(times: list) -> dict:
+    """ summarize latencies in seconds by mean, min, max and percentiles """
+
+    stats = {'mean': float(np.mean(times)), 'min': float(np.min(times)), 'max': float(np.max(times))}
+    stats.update({'p%s' % p: float(np.percentile(times, p)) for p in PERCENTILES})
+
+    return stats
+
+
+def bench_method(method: str = METHODS[0], height: int = 512, width: int = 512, channels: int = 3,
+                 bit_depth: int = 8, repeats: int = 5, warmup: int = 1, dtype: str = None) -> dict:
+    """
+    Benchmark a single method on synthetic source and reference images passed through image files. For sources
+    with alpha channel, an RGB reference is used. Float images (32 bit) are passed through npy files.
+
+    :param method: Method out of METHODS
+    :param height: Number of image rows
+    :param width: Number of image columns
+    :param channels: Number of color channels
+    :param bit_depth: 8, 16 or 32 (float)
+    :param repeats: Number of timed runs
+    :param warmup: Number of untimed runs preceding the timed runs
+    :param dtype: Compute type passed to the matcher (None for default)
+
+    :return: **result**: Dictionary of throughput, latency percentiles, peak memory and stage measures
+    :rtype: dict
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # write synthetic images to files (in 8-bit png, 16-bit tiff or float npy)
+        file_type = {8: 'png', 16: 'tiff', 32: 'npy'}[bit_depth]
+        src_path, ref_path = os.path.join(tmp_dir, 'src.' + file_type), os.path.join(tmp_dir, 'ref.' + file_type)
+        save_bench_img(synth_img(height, width, channels, bit_depth, seed=0), src_path, file_type)
+        save_bench_img(synth_img(height, width, min(channels, 3), bit_depth, seed=1), ref_path, file_type)
+        ref = load_bench_img(ref_path, dtype=dtype)
+
+        def run() -> tuple:
+            cm = ColorMatcher(method=method, dtype=dtype)
+            profiler = StageProfiler(cm)
+            with profiler.measure('io_load'):
+                src = load_bench_img(src_path, dtype=dtype)
+            start = time.perf_counter()
+            res = cm.transfer(src=src, ref=ref)
+            latency = time.perf_counter() - start
+            with profiler.measure('io_save'):
+                save_bench_img(res[..., 0] if res.shape[-1] == 1 else res, os.path.join(tmp_dir, 'res'), file_type)
+            return latency, profiler
+
+        for _ in range(warmup):
+            run()
+
+        # timed runs without tracing
+        latencies, stage_times = [], {stage: [] for stage in STAGES}
+        for _ in range(repeats):
+            latency, profiler = run()
+            latencies.append(latency)
+            for stage in STAGES:
+                stage_times[stage].append(profiler.times.get(stage, 0))
+
+        # traced run for memory measures
+        tracemalloc.start()
+        try:
+            _, profiler = run()
+            profiler.trace_reset()
+        finally:
+            tracemalloc.stop()
+
+    transfer_stages = [stage for stage in STAGES if not stage.startswith('io') and any(stage_times[stage])]
+    stages = {stage: dict(latency_stats(stage_times[stage]), peak_tracemalloc_mb=profiler.peaks.get(stage, 0) / 2**20)
+              for stage in STAGES if any(stage_times[stage])}
+    other = [lat - sum(stage_times[stage][i] for stage in transfer_stages) for i, lat in enumerate(latencies)]
+    stages['other'] = latency_stats(other)
+
+    latency = latency_stats(latencies)
+    result = {
+        'megapixels_per_s': height * width / 1e6 / latency['p50'],
+        'latency_s': latency,
+        'peak_tracemalloc_mb': profiler.peak / 2**20,
+        'peak_rss_mb': peak_rss(),
+        'stages': stages,
+    }
+
+    return result
+
+
+def bench_startup(repeats: int = 5, warmup: int = 1) -> dict:
+    """
+    Benchmark the startup of fresh interpreters importing the package or printing the CLI help, where the bare
+    interpreter serves as baseline.
+
+    :param repeats: Number of timed runs per command
+    :param warmup: Number of untimed runs preceding the timed runs (populating file system and bytecode caches)
+
+    :return: **result**: Dictionary of latency statistics per command and modules loaded by the package import
+    :rtype: dict
+    """
+
+    # make the package importable in child processes regardless of the working directory
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + [os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep))
+
+    result = dict()
+    for name, args in STARTUP_CMDS.items():
+        times = []
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        result[name] = latency_stats(times[warmup:])
+
+    # heavy modules that are expected to be deferred until first use
+    code = 'import sys, color_matcher; print(",".join(m for m in ("numpy", "PIL", "imageio") if m in sys.modules))'
+    out = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, check=True).stdout
+    result['import_loads'] = [m for m in out.decode().strip().split(',') if m]
+
+    return result
+
+
+def run_benchmark(methods: tuple = METHODS, height: int = 512, width: int = 512, channels: int = 3,
+                  bit_depth: int = 8, repeats: int = 5, warmup: int = 1, dtype: str = None,
+                  isolate: bool = True, startup: bool = False) -> dict:
+    """
+    Benchmark methods on synthetic images. Each method is run in a fresh process (if isolate is set) so that the
+    peak resident set size is attributable to the method.
+
+    :param methods: Methods out of METHODS
+    :param height: Number of image rows
+    :param width: Number of image columns
+    :param channels: Number of color channels
+    :param bit_depth: 8, 16 or 32 (float)
+    :param repeats: Number of timed runs per method
+    :param warmup: Number of untimed runs preceding the timed runs
+    :param dtype: Compute type passed to the matcher (None for default)
+    :param isolate: Whether each method is benchmarked in a separate process
+    :param startup: Whether package import and CLI startup times are benchmarked (see :func:`bench_startup`)
+
+    :return: **report**: JSON serializable dictionary of environment, configuration and results per method
+    :rtype: dict
+    """
+
+    for method in methods:
+        if method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+
+    config = {'height': height, 'width': width, 'channels': channels, 'bit_depth': bit_depth, 'repeats': repeats,
+              'warmup': warmup, 'dtype': dtype, 'isolate': isolate}
+    kwargs = {key: val for key, val in config.items() if key != 'isolate'}
+
+    results = dict()
+    for method in methods:
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[method] = executor.submit(bench_method, method, **kwargs).result()
+        else:
+            results[method] = bench_method(method, **kwargs)
+
+    report = {
+        'version': BENCH_VERSION,
+        'color_matcher': __version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'results': results,
+    }
+    if startup:
+        report['startup'] = bench_startup(repeats, warmup)
+
+    return report
+
+
+def print_report(report: dict = None):
+    """ print results of a benchmark report as table """
+
+    cfg = report['config']
+    if 'startup' in report:
+        print('color-matcher %s startup (%s runs)\n' % (report['color_matcher'], cfg['repeats']))
+        print('%-15s %9s %9s %9s' % ('command', 'p50 [s]', 'p90 [s]', 'p99 [s]'))
+        for name, lat in report['startup'].items():
+            if name in STARTUP_CMDS:
+                print('%-15s %9.4f %9.4f %9.4f' % (name, lat['p50'], lat['p90'], lat['p99']))
+        print('%-15s %s\n' % ('import loads', ', '.join(report['startup']['import_loads']) or '-'))
+    if not report['results']:
+        return
+
+    print('color-matcher %s benchmark on %sx%sx%s images with %s-bit depth (%s runs)\n' %
+          (report['color_matcher'], cfg['height'], cfg['width'], cfg['channels'], cfg['bit_depth'], cfg['repeats']))
+    print('%-12s %8s %9s %9s %9s %10s %9s' % ('method', 'MP/s', 'p50 [s]', 'p90 [s]', 'p99 [s]', 'trace [MB]',
+                                              'RSS [MB]'))
+    for method, res in report['results'].items():
+        lat, rss = res['latency_s'], res['peak_rss_mb']
+        print('%-12s %8.2f %9.4f %9.4f %9.4f %10.1f %9s' % (method, res['megapixels_per_s'], lat['p50'], lat['p90'],
+                                                            lat['p99'], res['peak_tracemalloc_mb'],
+                                                            '-' if rss is None else '%.1f' % rss))
+        for stage, vals in res['stages'].items():
+            print('  %-10s %8s %9.4f %9.4f %9.4f %10s' % (stage, '', vals['p50'], vals['p90'], vals['p99'],
+                                                          '%.1f' % vals['peak_tracemalloc_mb']
+                                                          if 'peak_tracemalloc_mb' in vals else ''))
+
+
+def usage():
+
+    print("Usage: python -m color_matcher.benchmark <options>\n")
+    print("Options:")
+    print("-m <methods>,  --method=<methods> Comma-separated methods out of:")
+    print("                                  "+', '.join(['"'+m+'"' for m in METHODS]))
+    print("-s <WxH>,      --size=<WxH>       Image width and height (default 512x512)")
+    print("-c <num>,      --channels=<num>   Number of color channels (default 3)")
+    print("-b <bits>,     --bits=<bits>      Bit depth of 8, 16 or 32 for float (default 8)")
+    print("-n <num>,      --repeats=<num>    Number of timed runs per method (default 5)")
+    print("-d <dtype>,    --dtype=<dtype>    Compute type float32 or float64 (default depends on bit depth)")
+    print("-o <filepath>, --output=<path>    Write JSON report to file or to stdout for '-'")
+    print("-i,            --inline           Run methods in the current process (peak RSS is cumulative)")
+    print("-u,            --startup          Benchmark import and CLI startup only")
+    print("-h,            --help             Print this help message")
+    print("")
+
+
+def main(argv: list = None) -> dict:
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, "hm:s:c:b:n:d:o:iu",
+                                   ["help", "method=", "size=", "channels=", "bits=", "repeats=", "dtype=",
+                                    "output=", "inline", "startup"])
+    except getopt.GetoptError as e:
+        print(e)
+        sys.exit(2)
+
+    cfg = {'methods': METHODS, 'width': 512, 'height': 512, 'channels': 3, 'bit_depth': 8, 'repeats': 5,
+           'dtype': None, 'isolate': True, 'startup': False}
+    output = None
+
+    try:
+        for (opt, arg) in opts:
+            arg = arg.strip(" \"\'")
+            if opt in ("-h", "--help"):
+                usage()
+                sys.exit()
+            if opt in ("-m", "--method"):
+                cfg['methods'] = tuple(m.strip().lower() for m in arg.split(','))
+            if opt in ("-s", "--size"):
+                cfg['width'], cfg['height'] = [int(val) for val in arg.lower().split('x')]
+            if opt in ("-c", "--channels"):
+                cfg['channels'] = int(arg)
+            if opt in ("-b", "--bits"):
+                cfg['bit_depth'] = int(arg)
+            if opt in ("-n", "--repeats"):
+                cfg['repeats'] = max(int(arg), 1)
+            if opt in ("-d", "--dtype"):
+                cfg['dtype'] = arg
+            if opt in ("-o", "--output"):
+                output = arg
+            if opt in ("-i", "--inline"):
+                cfg['isolate'] = False
+            if opt in ("-u", "--startup"):
+                cfg['methods'], cfg['startup'] = (), True
+    except ValueError:
+        print('Numeric option could not be parsed\n')
+        usage()
+        sys.exit(2)
+
+    report = run_benchmark(**cfg)
+
+    if output == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
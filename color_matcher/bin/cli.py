@@ -20,12 +20,16 @@ __license__ = """
 
 """
 
-from color_matcher import __version__
-from color_matcher.top_level import ColorMatcher, METHODS
-from color_matcher.io_handler import *
+from color_matcher import __version__, METHODS
 
 import getopt
 import sys, os
+from collections import deque
+
+# reference model or color transform shared by all files processed in a worker
+_worker_ref = None
+# matcher options shared by all files processed in a worker
+_worker_opts = {}
 
 
 def usage():
@@ -36,7 +40,14 @@ def usage():
     print("-r <filepath>, --ref=<filepath>   Specify target image file")
     print("-m <method>,   --method=<method>  Provide color transfer method such as:")
     print("                                  "+', '.join(['"'+m+'"' for m in METHODS]))
+    print("-e <filepath>, --export=<path>    Export fitted color transform of a single source to file (.npz/.cube)")
+    print("-t <filepath>, --transform=<path> Apply color transform or 3-D LUT from file instead of reference")
+    print("-j <num>,      --jobs=<num>       Number of parallel processes for folder processing")
+    print("-c <path>,     --cache=<path>     Directory caching reference statistics across runs")
+    print("               --cache-mb=<MB>    Size cap of the cache directory in megabytes (default 1024)")
+    print("-p <pixels>,   --proxy=<pixels>   Fit statistics on area-averaged proxies of at most this pixel count")
     print("-w ,           --win              Select files from window")
+    print("serve                             Run as server keeping fitted references (see serve --help)")
     print("-h,            --help             Print this help message")
     print("")
 
@@ -44,7 +55,9 @@ def usage():
 def parse_options(argv):
 
     try:
-        opts, args = getopt.getopt(argv, "hs:r:m:w", ["help", "src=", "ref=", "method=", "win"])
+        opts, args = getopt.getopt(argv, "hs:r:m:e:t:j:c:p:w",
+                                   ["help", "src=", "ref=", "method=", "export=", "transform=", "jobs=", "cache=",
+                                    "cache-mb=", "proxy=", "win"])
     except getopt.GetoptError as e:
         print(e)
         sys.exit(2)
@@ -56,6 +69,12 @@ def parse_options(argv):
     cfg['src_path'] = '.'
     cfg['ref_path'] = '.'
     cfg['method'] = METHODS[0]
+    cfg['export_path'] = None
+    cfg['transform_path'] = None
+    cfg['jobs'] = 1
+    cfg['cache_dir'] = None
+    cfg['cache_mb'] = 1024
+    cfg['proxy_size'] = None
     cfg['win'] = None
 
     if opts:
@@ -69,20 +88,132 @@ def parse_options(argv):
                 cfg['ref_path'] = arg.strip(" \"\'")
             if opt in ("-m", "--method"):
                 cfg['method'] = arg.strip(" \"\'")
+            if opt in ("-e", "--export"):
+                cfg['export_path'] = arg.strip(" \"\'")
+            if opt in ("-t", "--transform"):
+                cfg['transform_path'] = arg.strip(" \"\'")
+            if opt in ("-j", "--jobs"):
+                try:
+                    cfg['jobs'] = max(int(arg.strip(" \"\'")), 1)
+                except ValueError:
+                    print('Number of jobs must be an integer\n')
+                    sys.exit(2)
+            if opt in ("-c", "--cache"):
+                cfg['cache_dir'] = arg.strip(" \"\'")
+            if opt == "--cache-mb":
+                try:
+                    cfg['cache_mb'] = float(arg.strip(" \"\'"))
+                except ValueError:
+                    print('Cache size must be a number\n')
+                    sys.exit(2)
+            if opt in ("-p", "--proxy"):
+                try:
+                    cfg['proxy_size'] = int(arg.strip(" \"\'"))
+                except ValueError:
+                    print('Proxy size must be an integer pixel count\n')
+                    sys.exit(2)
+                if cfg['proxy_size'] < 1:
+                    print('Proxy size must be a positive pixel count\n')
+                    sys.exit(2)
             if opt in ("-w", "--win"):
                 cfg['win'] = True
 
     return cfg
 
 
+def output_file_path(file_path: str, output_path: str, method: str) -> str:
+    """ compose output file path (without extension) from source file path """
+
+    filename = os.path.splitext(os.path.basename(file_path))[0]+'_'+method
+
+    return os.path.join(output_path, filename)
+
+
+def init_worker(ref=None, options: dict = None):
+    """ keep reference model or color transform and matcher options for all files processed by a worker """
+
+    global _worker_ref, _worker_opts
+    _worker_ref = ref
+    _worker_opts = options or {}
+
+
+def process_file(file_path: str, output_path: str, method: str) -> str:
+    """ load, match and save a single source image using the reference of the worker """
+
+    from color_matcher.top_level import ColorMatcher
+    from color_matcher.color_transform import ColorTransform
+    from color_matcher.lut3d import Lut3D
+    from color_matcher.io_handler import load_img_file, save_img_file
+
+    src = load_img_file(file_path)
+    if isinstance(_worker_ref, (ColorTransform, Lut3D)):
+        res = _worker_ref.apply(src)
+    else:
+        res = ColorMatcher(src=src, ref=_worker_ref, method=method, **_worker_opts).main()
+    save_img_file(res, file_path=output_file_path(file_path, output_path, method),
+                  file_type=os.path.splitext(file_path)[-1][1:])
+
+    return file_path
+
+
+def process_files(filenames: list, output_path: str, method: str, ref=None, jobs: int = 1,
+                  options: dict = None) -> list:
+    """ process source images sequentially or in a pool of processes and return a list of failures """
+
+    failures = []
+    num = len(filenames)
+
+    def report(i, f, e=None):
+        print('[%s/%s] %s %s' % (i+1, num, 'failed' if e else 'done', os.path.basename(f)))
+        if e:
+            failures.append((f, e))
+
+    if jobs == 1 or num < 2:
+        init_worker(ref, options)
+        for i, f in enumerate(filenames):
+            try:
+                process_file(f, output_path, method)
+                report(i, f)
+            except Exception as e:
+                report(i, f, e)
+        return failures
+
+    # bound number of files in flight so that memory remains flat and report progress in order
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(ref, options)) as pool:
+        queue = deque()
+        for i, f in enumerate(filenames):
+            queue.append((i, f, pool.submit(process_file, f, output_path, method)))
+            while queue and (len(queue) >= 2*jobs or i == num-1):
+                k, g, future = queue.popleft()
+                try:
+                    future.result()
+                    report(k, g)
+                except Exception as e:
+                    report(k, g, e)
+
+    return failures
+
+
 def main():
 
+    # long-running server mode as sub-command
+    if sys.argv[1:2] == ['serve']:
+        from color_matcher.server import main as serve
+        return serve(sys.argv[2:])
+
     # program info
     print("\ncolor-matcher v%s \n" % __version__)
 
     # retrieve parse options
     cfg = parse_options(sys.argv[1:])
 
+    # matchers and imaging libraries are loaded once options are valid so that help is printed without them
+    from color_matcher.top_level import ColorMatcher
+    from color_matcher.stats_cache import StatsCache
+    from color_matcher.io_handler import FILE_EXTS, LUT_EXT, select_file, load_img_file, save_img_file, \
+        load_transform_file, save_transform_file, load_lut_file, save_lut_file
+
     # select files from window (if option set)
     if cfg['win']:
         cfg['src_path'] = select_file(cfg['src_path'], 'Select source image')
@@ -94,15 +225,29 @@ def main():
         print('Canceled due to missing image file path\n')
         sys.exit()
 
+    # method handling where a color transform file replaces the reference
+    if cfg['transform_path'] and os.path.isfile(cfg['transform_path']):
+        if cfg['transform_path'].lower().endswith('.' + LUT_EXT):
+            transform = load_lut_file(cfg['transform_path'])
+            cfg['method'] = 'lut'
+        else:
+            transform = load_transform_file(cfg['transform_path'])
+            cfg['method'] = transform.method or 'transform'
+    else:
+        cfg['method'] = cfg['method'] if cfg['method'] in METHODS else METHODS[0]
+
+    # reference is either an image file or a transform file
+    ref_found = os.path.isfile(cfg['transform_path'] or cfg['ref_path'])
+
     # select image(s) considering provided folder or file
-    if os.path.isdir(cfg['src_path']) and os.path.isfile(cfg['ref_path']):
+    if os.path.isdir(cfg['src_path']) and ref_found:
         # case where source is directory and reference is file
-        filenames = [os.path.join(cfg['src_path'], f) for f in os.listdir(cfg['src_path'])
+        filenames = [os.path.join(cfg['src_path'], f) for f in sorted(os.listdir(cfg['src_path']))
                      if f.lower().endswith(FILE_EXTS)]
         output_path = os.path.join(cfg['src_path'], 'batch_proc_'+str(cfg['method']))
         os.makedirs(output_path, exist_ok=True)
         print('Output files are placed in created directory %s' % os.path.join('.', os.path.basename(output_path)))
-    elif os.path.isfile(cfg['src_path']) and os.path.isfile(cfg['ref_path']):
+    elif os.path.isfile(cfg['src_path']) and ref_found:
         # case where source is file and reference is file
         filenames = [cfg['src_path']]
         output_path = os.path.dirname(cfg['src_path'])
@@ -114,23 +259,53 @@ def main():
         print('File(s) not found \n')
         sys.exit()
 
-    # method handling
-    cfg['method'] = cfg['method'] if cfg['method'] in METHODS else METHODS[0]
+    # transform export is limited to a single source
+    if cfg['export_path'] and (len(filenames) > 1 or cfg['transform_path']):
+        print('Transform export requires a single source file and reference image \n')
+        sys.exit()
+
+    # statistics of reduced-resolution proxies applied to full-resolution sources
+    options = {'proxy_size': cfg['proxy_size']} if cfg['proxy_size'] else {}
+
+    if not cfg['transform_path']:
+        # read reference image and analyze it once for all source images
+        ref = load_img_file(cfg['ref_path'])
+        cache = StatsCache(cfg['cache_dir'], cfg['cache_mb']) if cfg['cache_dir'] else None
+        model = ColorMatcher(method=cfg['method'], stats_cache=cache, **options).fit(ref, method=cfg['method'])
 
-    # read reference image
-    ref = load_img_file(cfg['ref_path'])
+    if cfg['export_path']:
+        # process single file while keeping its transform
+        src = load_img_file(filenames[0])
+        cm = ColorMatcher(src=src, ref=model, method=cfg['method'], **options)
+        res = cm.main()
+        if cfg['export_path'].lower().endswith('.' + LUT_EXT):
+            # bake transform into 3-D lookup table
+            print('LUT exported to %s' % save_lut_file(cm.get_transform().to_lut(), cfg['export_path']))
+        else:
+            print('Transform exported to %s' % save_transform_file(cm.get_transform(), cfg['export_path']))
+        save_img_file(res, file_path=output_file_path(filenames[0], output_path, cfg['method']),
+                      file_type=os.path.splitext(filenames[0])[-1][1:])
+        return True
 
     # process images
-    for f in filenames:
-        src = load_img_file(f)
-        res = ColorMatcher(src=src, ref=ref, method=cfg['method']).main()
-        filename = os.path.splitext(os.path.basename(f))[0]+'_'+cfg['method']
-        file_ext = os.path.splitext(f)[-1]
-        save_img_file(res, file_path=os.path.join(output_path, filename), file_type=file_ext[1:])
+    ref = transform if cfg['transform_path'] else model
+    failures = process_files(filenames, output_path, cfg['method'], ref, jobs=cfg['jobs'], options=options)
+
+    # summarize failures
+    if failures:
+        for f, e in failures:
+            print('Failed to process %s: %s' % (f, e))
+        sys.exit('%s of %s file(s) failed' % (len(failures), len(filenames)))
 
     return True
 
 
+def run():
+    """ console entry point translating the result of main() to an exit status """
+
+    sys.exit(0 if main() is True else 1)
+
+
 if __name__ == "__main__":
 
-    sys.exit(main())
+    run()
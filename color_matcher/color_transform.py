@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from color_matcher.baseclass import MatcherBaseclass
+from color_matcher.hist_matcher import HistogramMatcher
+from color_matcher.mvgd_matcher import TransferMVGD
+from color_matcher.reinhard_matcher import ReinhardMatcher
+from color_matcher.lut3d import Lut3D
+
+TRANSFORM_VERSION = 1
+STAGE_PARAMS = {
+    'hist_match': ('luts',),
+    'multivar_transfer': ('transfer_mat', 'mu_r', 'mu_z'),
+    'reinhard': ('mean_src', 'std_ratios', 'mean_ref'),
+}
+
+
+class ColorTransform(object):
+
+    def __init__(self, stages: list = None, channels: int = None, method: str = None):
+        """
+        Color transform fitted by a :class:`ColorMatcher` which is applicable to images without the reference.
+
+        :param stages: list of (name, params) tuples with name being a key of STAGE_PARAMS
+        :param channels: number of color channels the stages operate on
+        :param method: method the transform has been fitted with
+        """
+
+        self.stages = [] if stages is None else list(stages)
+        self.channels = channels
+        self.method = method
+
+        for name, params in self.stages:
+            if name not in STAGE_PARAMS:
+                raise BaseException('Transform stage \'%s\' not recognized' % name)
+
+    def __call__(self, img: np.ndarray = None, dtype: str = None) -> np.ndarray:
+        return self.apply(img, dtype)
+
+    def apply(self, img: np.ndarray = None, dtype: str = None) -> np.ndarray:
+        """
+        Apply all stages of the transform to an image.
+
+        :param img: Image array
+        :param dtype: Floating point type of computations defaulting to that of :meth:`MatcherBaseclass.compute_dtype`
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type dtype: :class:`str`
+
+        :return: **res**: Resulting image after color mapping
+        :rtype: np.ndarray
+        """
+
+        res = self.validate_chs(img)
+        dtype = MatcherBaseclass(dtype=dtype).compute_dtype(res)
+        for name, params in self.stages:
+            if name == 'hist_match':
+                res = HistogramMatcher.apply_luts(res, params['luts'], dtype)
+            elif name == 'multivar_transfer':
+                res = TransferMVGD.apply_transfer_mat(res, *[params[k] for k in STAGE_PARAMS[name]], dtype=dtype)
+            elif name == 'reinhard':
+                log_lms = ReinhardMatcher.log_lms(res, dtype=dtype)
+                res = ReinhardMatcher.lab_transfer(log_lms, *[params[k] for k in STAGE_PARAMS[name]],
+                                                   out=log_lms).reshape(res.shape)
+
+        return res
+
+    def to_lut(self, size: int = 33, domain: np.ndarray = None) -> Lut3D:
+        """
+        Bake the transform into a 3-D lookup table, which is cheaper to apply than the stages it samples.
+
+        :param size: Number of grid points per axis
+        :param domain: Minimum and maximum input values per channel of shape (2, 3) defaulting to [0, 1]
+
+        :return: **lut**: Baked lookup table
+        :rtype: Lut3D
+        """
+
+        return Lut3D.bake(self, size=size, domain=domain, title=self.method)
+
+    def validate_chs(self, img: np.ndarray = None) -> np.ndarray:
+        """ adapt color channels of an image to those the transform has been fitted for """
+
+        img = img[..., np.newaxis] if len(img.shape) == 2 else img
+
+        if img.shape[2] == 4 and self.channels == 3:
+            img = img[..., :3]
+        elif img.shape[2] == 3 and self.channels == 1:
+            img = MatcherBaseclass.rgb2gray(img)
+
+        if img.shape[2] != self.channels:
+            raise BaseException('Transform requires %s color channels, but got %s' % (self.channels, img.shape[2]))
+
+        return img
+
+    def to_dict(self) -> dict:
+        """ flatten transform to a dictionary of numpy arrays (e.g., for storage in an npz file) """
+
+        data = {
+            'version': np.array(TRANSFORM_VERSION),
+            'method': np.array('' if self.method is None else self.method),
+            'channels': np.array(self.channels),
+            'stages': np.array([name for name, _ in self.stages]),
+        }
+        for i, (name, params) in enumerate(self.stages):
+            for key in STAGE_PARAMS[name]:
+                if key == 'luts':
+                    for ch, (vals, maps) in enumerate(params[key]):
+                        data['%d_vals_%d' % (i, ch)] = vals
+                        data['%d_maps_%d' % (i, ch)] = maps
+                else:
+                    data['%d_%s' % (i, key)] = params[key]
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict = None):
+        """ create transform from a dictionary of numpy arrays as obtained by :meth:`to_dict` """
+
+        version = int(data['version'])
+        if version > TRANSFORM_VERSION:
+            raise BaseException('Transform version %s is not supported (max. %s)' % (version, TRANSFORM_VERSION))
+
+        channels = int(data['channels'])
+        stages = []
+        for i, name in enumerate(data['stages'].tolist()):
+            if name not in STAGE_PARAMS:
+                raise BaseException('Transform stage \'%s\' not recognized' % name)
+            params = dict()
+            for key in STAGE_PARAMS[name]:
+                if key == 'luts':
+                    params[key] = tuple((data['%d_vals_%d' % (i, ch)], data['%d_maps_%d' % (i, ch)])
+                                        for ch in range(channels))
+                else:
+                    params[key] = data['%d_%s' % (i, key)]
+            stages.append((name, params))
+
+        return cls(stages=stages, channels=channels, method=str(data['method']) or None)
@@ -23,17 +23,24 @@ __license__ = """
 import os
 import numpy as np
 
-try:
-    from PIL import Image
-except ImportError:
-    raise ImportError('Please install pillow.')
-
 from color_matcher.normalizer import Normalizer
+from color_matcher.color_transform import ColorTransform
+from color_matcher.lut3d import Lut3D
 
 FILE_EXTS = ('bmp', 'png', 'tiff', 'tif', 'jpeg', 'jpg')
+TRANSFORM_EXT = 'npz'
+LUT_EXT = 'cube'
+
+# imaging library module resolved on first file access
+_backend = None
 
 
-def save_img_file(img, file_path: str = None, file_type: str = None) -> bool:
+def save_img_file(img, file_path: str = None, file_type: str = None, native: bool = False) -> bool:
+    """
+    Write image to file where arrays are stretched to the full 8-bit (16-bit for tiff) range unless native is set.
+    Native saving writes 8-bit arrays as they are and 16-bit arrays to tiff files (shifted to 8-bit for other formats)
+    whereas other types are rounded and clipped to the file bit depth without stretching.
+    """
 
     file_path = os.getcwd() if file_path is None else file_path
     ext = os.path.splitext(file_path)[-1][1:]
@@ -46,54 +53,218 @@ def save_img_file(img, file_path: str = None, file_type: str = None) -> bool:
     file_type = 'png' if file_type is None else file_type
     file_path += '.' + file_type
 
-    # normalization
-    img = Normalizer(img).uint16_norm() if file_type.__contains__('tif') else Normalizer(img).uint8_norm()
+    img = to_file_depth(img, file_type, native)
 
-    try:
-        import imageio
+    backend = imaging_backend()
+    if backend.__name__ == 'imageio':
         suppress_user_warning(True, category=UserWarning)
-        imageio.imwrite(uri=file_path, im=img)
+        backend.imwrite(uri=file_path, im=img)
         suppress_user_warning(False, category=UserWarning)
-    except ImportError:
-        if file_type == 'png' or file_type == 'bmp':
-            try:
-                Image.fromarray(img).save(file_path, file_type, optimize=True)
-                #imageio.imwrite(uri=file_path, im=img)
-            except PermissionError as e:
-                raise Exception(e)
+    elif file_type == 'png' or file_type == 'bmp':
+        try:
+            backend.fromarray(img).save(file_path, file_type, optimize=True)
+        except PermissionError as e:
+            raise Exception(e)
 
     return True
 
 
-def load_img_file(file_path: str = None) -> np.ndarray:
+def load_img_file(file_path: str = None, dtype: str = None, native: bool = False) -> np.ndarray:
+    """
+    Load image normalized to [0, 1] as float type (defaults to float32 for 8-bit and float64 for other files) or
+    in its storage type (e.g. uint8 or uint16) without any conversion if native is set.
+    """
 
     # get file extension
     file_type = file_path.split('.')[-1]
 
     if any(file_type.lower() in ext for ext in FILE_EXTS):
-        try:
-            import imageio
+        backend = imaging_backend()
+        if backend.__name__ == 'imageio':
             suppress_user_warning(True, category=UserWarning)
-            img = imageio.imread(uri=file_path, format=file_type)
+            img = backend.imread(uri=file_path, format=file_type)
             suppress_user_warning(False, category=UserWarning)
-        except ImportError:
+        else:
             try:
-                img = Image.open(file_path)
+                img = backend.open(file_path)
             except OSError or TypeError:
                 # support load of truncated images
                 from PIL import ImageFile
                 ImageFile.LOAD_TRUNCATED_IMAGES = True
-                img = Image.open(file_path)
+                img = backend.open(file_path)
 
     else:
         raise TypeError('Filetype %s not recognized' % file_type)
 
+    return to_array(img, dtype, native)
+
+
+def encode_img(img, file_type: str = 'png', native: bool = False) -> bytes:
+    """ encode image to the contents of a file (e.g. for network transfer) as written by :func:`save_img_file` """
+
+    file_type = file_type.lower()
+    if file_type not in FILE_EXTS:
+        raise TypeError('Filetype %s not recognized' % file_type)
+
+    # pass through a temporary file as in-memory encoding is not supported by all imaging plugins
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'img.' + file_type)
+        save_img_file(img, file_path, file_type, native)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+    return data
+
+
+def decode_img(data: bytes = None, dtype: str = None, native: bool = False) -> np.ndarray:
+    """ decode image from the contents of a file with its type detected from the data as in :func:`load_img_file` """
+
+    backend = imaging_backend()
+    if backend.__name__ == 'imageio':
+        suppress_user_warning(True, category=UserWarning)
+        img = backend.imread(data)
+        suppress_user_warning(False, category=UserWarning)
+    else:
+        from io import BytesIO
+        img = backend.open(BytesIO(data))
+
+    return to_array(img, dtype, native)
+
+
+def to_file_depth(img, file_type: str = None, native: bool = False) -> np.ndarray:
+    """ convert image to the integer type written to files of the given type (16-bit for tiff and 8-bit otherwise) """
+
+    if native:
+        img = np.asarray(img)
+        depth = 'uint16' if file_type.__contains__('tif') else 'uint8'
+        if img.dtype == 'uint16' and depth == 'uint8':
+            img = (img >> 8).astype(np.uint8)
+        else:
+            img = Normalizer().type_cast(img, depth)
+    else:
+        # normalization
+        img = Normalizer(img).uint16_norm() if file_type.__contains__('tif') else Normalizer(img).uint8_norm()
+
+    return img
+
+
+def to_array(img, dtype: str = None, native: bool = False) -> np.ndarray:
+    """ convert decoded image to numpy array normalized to [0, 1] or in its storage type if native is set """
+
     # normalize (convert to numpy array)
-    img = Normalizer(np.asarray(img)).type_norm()
+    img = np.asarray(img)
+    if native:
+        return img
+    dtype = dtype if dtype is not None else 'float32' if img.dtype.itemsize == 1 else 'float64'
+    img = Normalizer(img, dtype=dtype).type_norm()
 
     return img
 
 
+def load_img_memmap(file_path: str = None, mode: str = 'r') -> np.memmap:
+    """ map image from npy or uncompressed tiff file into memory without reading it """
+
+    file_type = file_path.split('.')[-1].lower()
+
+    if file_type == 'npy':
+        img = np.load(file_path, mmap_mode=mode)
+    elif file_type in ('tif', 'tiff'):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError('Please install tifffile for memory-mapped tiff files.')
+        img = tifffile.memmap(file_path, mode=mode)
+    else:
+        raise TypeError('Filetype %s not recognized' % file_type)
+
+    return img
+
+
+def create_img_memmap(file_path: str = None, shape: tuple = None, dtype: str = 'uint16') -> np.memmap:
+    """ create memory-mapped npy or uncompressed tiff file for writing images larger than memory """
+
+    file_type = file_path.split('.')[-1].lower()
+
+    if file_type == 'npy':
+        img = np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype, shape=shape)
+    elif file_type in ('tif', 'tiff'):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError('Please install tifffile for memory-mapped tiff files.')
+        img = tifffile.memmap(file_path, shape=shape, dtype=dtype)
+    else:
+        raise TypeError('Filetype %s not recognized' % file_type)
+
+    return img
+
+
+def save_transform_file(transform: ColorTransform, file_path: str = None) -> str:
+    """ write fitted color transform to compressed npz file and return its path """
+
+    file_path = os.path.join(os.getcwd(), 'transform') if file_path is None else file_path
+    file_path = file_path if file_path.lower().endswith('.' + TRANSFORM_EXT) else file_path + '.' + TRANSFORM_EXT
+
+    np.savez_compressed(file_path, **transform.to_dict())
+
+    return file_path
+
+
+def load_transform_file(file_path: str = None) -> ColorTransform:
+    """ read color transform from npz file """
+
+    if not file_path.lower().endswith('.' + TRANSFORM_EXT):
+        raise TypeError('Filetype %s not recognized' % file_path.split('.')[-1])
+
+    with np.load(file_path, allow_pickle=False) as data:
+        transform = ColorTransform.from_dict(dict(data))
+
+    return transform
+
+
+def save_lut_file(lut: Lut3D, file_path: str = None) -> str:
+    """ write 3-D lookup table to .cube file and return its path """
+
+    file_path = os.path.join(os.getcwd(), 'lut') if file_path is None else file_path
+    file_path = file_path if file_path.lower().endswith('.' + LUT_EXT) else file_path + '.' + LUT_EXT
+
+    with open(file_path, 'w') as f:
+        f.write(lut.to_cube())
+
+    return file_path
+
+
+def load_lut_file(file_path: str = None) -> Lut3D:
+    """ read 3-D lookup table from .cube file """
+
+    if not file_path.lower().endswith('.' + LUT_EXT):
+        raise TypeError('Filetype %s not recognized' % file_path.split('.')[-1])
+
+    with open(file_path, 'r') as f:
+        lut = Lut3D.from_cube(f.read())
+
+    return lut
+
+
+def imaging_backend():
+    """ resolve imaging library once where imageio is preferred over pillow and return its module """
+
+    global _backend
+    if _backend is None:
+        try:
+            import imageio
+            _backend = imageio
+        except ImportError:
+            try:
+                from PIL import Image
+                _backend = Image
+            except ImportError:
+                raise ImportError('Please install imageio or pillow.')
+
+    return _backend
+
+
 def suppress_user_warning(switch=None, category=None):
 
     import warnings
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from color_matcher.baseclass import MatcherBaseclass
+from color_matcher.mvgd_matcher import CHUNK_SIZE
+
+INTERP_TYPES = ('tetrahedral', 'trilinear')
+
+
+class Lut3D(object):
+
+    def __init__(self, table: np.ndarray = None, domain: np.ndarray = None, title: str = None):
+        """
+        Three-dimensional lookup table (LUT) sampling an RGB to RGB color mapping on a regular grid, which replaces
+        the evaluation of a fitted (possibly nonlinear) transform by interpolation between grid points.
+
+        :param table: Mapped colors of shape (N, N, N, 3) indexed by red, green and blue grid positions
+        :param domain: Minimum and maximum input values per channel of shape (2, 3) defaulting to [0, 1]
+        :param title: Optional title as written to .cube files
+        """
+
+        self.table = np.asarray(table, dtype='float64')
+        if len(self.table.shape) != 4 or self.table.shape[3] != 3 or len(set(self.table.shape[:3])) != 1:
+            raise BaseException('LUT table requires a shape of (N, N, N, 3), but got %s' % str(self.table.shape))
+        if self.table.shape[0] < 2:
+            raise BaseException('LUT requires at least 2 grid points per axis')
+
+        domain = [[0, 0, 0], [1, 1, 1]] if domain is None else domain
+        self.domain = np.broadcast_to(np.asarray(domain, dtype='float64').reshape(2, -1), (2, 3)).copy()
+        self.title = title
+
+    @property
+    def size(self) -> int:
+        return self.table.shape[0]
+
+    def __call__(self, img: np.ndarray = None, interp: str = 'tetrahedral', dtype: str = None) -> np.ndarray:
+        return self.apply(img, interp, dtype)
+
+    @classmethod
+    def bake(cls, transform=None, size: int = 33, domain: np.ndarray = None, title: str = None):
+        """
+        Sample a color mapping (e.g. a :class:`ColorTransform`) at all grid points of a LUT.
+
+        :param transform: Callable mapping an RGB image array of shape (H, W, 3) to one of the same shape
+        :param size: Number of grid points per axis
+        :param domain: Minimum and maximum input values per channel of shape (2, 3) defaulting to [0, 1]
+        :param title: Optional title as written to .cube files
+
+        :return: **lut**: Baked lookup table
+        :rtype: Lut3D
+        """
+
+        if getattr(transform, 'channels', 3) != 3:
+            raise BaseException('LUT requires a transform of 3 color channels')
+
+        lut = cls(table=np.zeros((size,)*3 + (3,)), domain=domain, title=title)
+
+        # grid image with red being the slowest and blue the fastest changing axis
+        axes = [np.linspace(lo, hi, size) for lo, hi in zip(*lut.domain)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(size**2, size, 3)
+        lut.table = np.asarray(transform(grid), dtype='float64').reshape((size,)*3 + (3,))
+
+        return lut
+
+    def apply(self, img: np.ndarray = None, interp: str = 'tetrahedral', dtype: str = None) -> np.ndarray:
+        """
+        Map an RGB image through the LUT where values outside the domain are clipped to its boundaries.
+
+        :param img: Image array with 3 (or 4 where alpha is dropped) color channels
+        :param interp: Interpolation type out of INTERP_TYPES
+        :param dtype: Floating point type of computations defaulting to that of :meth:`MatcherBaseclass.compute_dtype`
+
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type interp: :class:`str`
+        :type dtype: :class:`str`
+
+        :return: **res**: Resulting image after color mapping
+        :rtype: np.ndarray
+        """
+
+        if interp not in INTERP_TYPES:
+            raise BaseException('Interpolation type \'%s\' not recognized' % interp)
+
+        img = img[..., :3] if len(img.shape) == 3 and img.shape[2] == 4 else img
+        if len(img.shape) != 3 or img.shape[2] != 3:
+            raise BaseException('LUT requires an image of 3 color channels')
+
+        dtype = MatcherBaseclass(dtype=dtype).compute_dtype(img)
+        n = self.size
+        table = np.ascontiguousarray(self.table.reshape(-1, 3).T, dtype=dtype)
+        strides = np.array([n*n, n, 1], dtype=np.int32)
+        scale = ((n - 1) / (self.domain[1] - self.domain[0])).astype(dtype)
+        lo = self.domain[0].astype(dtype)
+
+        rgb = img.reshape(-1, 3)
+        res = np.empty(rgb.shape, dtype=dtype)
+        pos = np.empty((3, min(rgb.shape[0], CHUNK_SIZE)), dtype=dtype)
+        for i in range(0, rgb.shape[0], CHUNK_SIZE):
+            # grid coordinates of pixels as channel rows split into cell indices and fractions
+            chunk = rgb[i:i+CHUNK_SIZE]
+            pos = pos[:, :chunk.shape[0]]
+            for ch in range(3):
+                np.subtract(chunk[:, ch], lo[ch], out=pos[ch])
+                pos[ch] *= scale[ch]
+            np.clip(pos, 0, n - 1, out=pos)
+            cell = np.minimum(pos.astype(np.int32), n - 2)
+            frac = pos - cell.astype(dtype)
+            idx = cell[0] * strides[0] + cell[1] * strides[1] + cell[2]
+
+            if interp == 'tetrahedral':
+                # walk from the lower to the upper cell corner along axes in descending order of fractions where
+                # vertices that are ambiguous due to equal fractions are weighted by zero
+                f_max = np.maximum(np.maximum(frac[0], frac[1]), frac[2])
+                f_min = np.minimum(np.minimum(frac[0], frac[1]), frac[2])
+                f_mid = frac[0] + frac[1] + frac[2] - f_max - f_min
+                idx_max, idx_mid = idx.copy(), idx.copy()
+                for ch in range(3):
+                    idx_max += (frac[ch] >= f_max) * strides[ch]
+                    idx_mid += (frac[ch] > f_min) * strides[ch]
+                vals = np.take(table, idx, axis=1) * (1 - f_max)
+                vals += np.take(table, idx_max, axis=1) * (f_max - f_mid)
+                vals += np.take(table, idx_mid, axis=1) * (f_mid - f_min)
+                vals += np.take(table, idx + strides.sum(), axis=1) * f_min
+            else:
+                # weighted sum over all 8 corners of the cell
+                vals = 0
+                for corner in np.ndindex(2, 2, 2):
+                    weight = np.prod([f if c else 1 - f for c, f in zip(corner, frac)], axis=0)
+                    vals = vals + np.take(table, idx + strides @ corner, axis=1) * weight
+            for ch in range(3):
+                res[i:i+CHUNK_SIZE, ch] = vals[ch]
+
+        return res.reshape(img.shape)
+
+    def to_cube(self) -> str:
+        """ serialize LUT in the .cube format (Adobe/Resolve) with red being the fastest changing axis """
+
+        lines = ['TITLE "%s"' % self.title] if self.title else []
+        lines += ['LUT_3D_SIZE %d' % self.size]
+        if not np.array_equal(self.domain, [[0, 0, 0], [1, 1, 1]]):
+            lines += ['DOMAIN_MIN %s' % ' '.join('%.10g' % v for v in self.domain[0]),
+                      'DOMAIN_MAX %s' % ' '.join('%.10g' % v for v in self.domain[1])]
+        rows = self.table.transpose(2, 1, 0, 3).reshape(-1, 3)
+        lines += ['%.10g %.10g %.10g' % tuple(row) for row in rows]
+
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def from_cube(cls, text: str = None):
+        """ create LUT from the contents of a .cube file as obtained by :meth:`to_cube` """
+
+        size, title, domain, rows = None, None, [[0, 0, 0], [1, 1, 1]], []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, val = line.partition(' ')
+            if key == 'TITLE':
+                title = val.strip().strip('"')
+            elif key == 'LUT_3D_SIZE':
+                size = int(val)
+            elif key == 'LUT_1D_SIZE':
+                raise BaseException('1-D LUTs are not supported')
+            elif key == 'DOMAIN_MIN':
+                domain[0] = [float(v) for v in val.split()]
+            elif key == 'DOMAIN_MAX':
+                domain[1] = [float(v) for v in val.split()]
+            elif key == 'LUT_3D_INPUT_RANGE':
+                domain = [[float(v)]*3 for v in val.split()]
+            else:
+                rows.append([float(v) for v in line.split()])
+
+        if size is None or len(rows) != size**3:
+            raise BaseException('LUT data of %s entries does not match size %s' % (len(rows), size))
+
+        table = np.array(rows).reshape((size,)*3 + (3,)).transpose(2, 1, 0, 3)
+
+        return cls(table=table, domain=domain, title=title)
@@ -23,8 +23,15 @@ __license__ = """
 import numpy as np
 
 from .baseclass import MatcherBaseclass
+from .ref_model import ReferenceModel
 from types import FunctionType
 
+# number of pixels processed at once by chunked computations
+CHUNK_SIZE = 2**16
+
+# ratio of smallest to largest eigenvalue below which covariances are not inverted in closed form
+COND_TOL = 1e-8
+
 
 class TransferMVGD(MatcherBaseclass):
 
@@ -45,19 +52,70 @@ class TransferMVGD(MatcherBaseclass):
 
     def init_vars(self):
 
-        # reshape source and reference images
-        self.r, self.z = self._src.reshape([-1, self._src.shape[2]]).T, self._ref.reshape([-1, self._ref.shape[2]]).T
-
-        # compute covariance matrices
-        self.cov_r, self.cov_z = np.cov(self.r), np.cov(self.z)
-
-        # compute color channel means
-        self.mu_r, self.mu_z = self.r.mean(axis=1)[..., np.newaxis], self.z.mean(axis=1)[..., np.newaxis]
+        # reshape source image and compute its covariance matrix and color channel means (from a pixel sample)
+        self.r = self._src.reshape([-1, self._src.shape[2]]).T
+        sample = self.sample_pixels(self._src)
+        self.mu_r, self.cov_r = self.mvgd_stats(sample.T, self.pixel_weights(self._src_mask, self._src, sample=True))
+        self.stats_err.update(self.sample_err(sample, self.r.shape[1], 'r'))
+
+        # use precomputed reference statistics (if provided)
+        if isinstance(self._ref, ReferenceModel) and self._ref.require('mu', 'cov'):
+            self.z, self.mu_z, self.cov_z = self._ref.z, self._ref.mu, self._ref.cov
+        else:
+            self.z = self._ref.reshape([-1, self._ref.shape[2]]).T
+            sample = self.sample_pixels(self._ref)
+            self.mu_z, self.cov_z = self.mvgd_stats(sample.T, self.pixel_weights(self._ref_mask, self._ref, True))
+            self.stats_err.update(self.sample_err(sample, self.z.shape[1], 'z'))
 
         # validate dimensionality
         self.check_dims()
 
-    def multivar_transfer(self, src: np.ndarray = None, ref: np.ndarray = None, fun: FunctionType = None) -> np.ndarray:
+    @staticmethod
+    def mvgd_stats(mat: np.ndarray = None, weights: np.ndarray = None) -> tuple:
+        """
+        Compute the parameters of a Multi-Variate Gaussian Distribution (MVGD) from a pixel matrix.
+
+        :param mat: Pixel matrix of shape (p, N) with p color channels
+        :param weights: Optional non-negative weights of the N pixels (e.g. from a boolean mask)
+
+        :type mat: :class:`~numpy:numpy.ndarray`
+        :type weights: :class:`~numpy:numpy.ndarray`
+
+        :return: **stats**: tuple of color channel means with shape (p, 1) and covariance matrix
+        :rtype: tuple
+        """
+
+        # pixel rows of shape (N, p) which are shifted by the mean of a first chunk for numerical stability
+        rows = mat.T
+        n, p = rows.shape
+        shift = rows[:CHUNK_SIZE].mean(axis=0, dtype=np.float64)
+        ones = np.ones(min(n, CHUNK_SIZE))
+
+        # shift is repeated to the chunk shape as subtracting equally shaped arrays avoids slow broadcasting
+        shifts = np.tile(shift, (ones.size, 1))
+
+        # accumulate sums and cross-products over chunks to avoid a centered copy of the entire pixel matrix
+        s1, s2 = np.zeros(p), np.zeros((p, p))
+        for i in range(0, n, CHUNK_SIZE):
+            chunk = rows[i:i+CHUNK_SIZE]
+            chunk = chunk - shifts[:chunk.shape[0]]
+            if weights is None:
+                s1 += ones[:chunk.shape[0]] @ chunk
+                s2 += chunk.T @ chunk
+            else:
+                s1 += weights[i:i+CHUNK_SIZE] @ chunk
+                s2 += chunk.T @ (chunk * weights[i:i+CHUNK_SIZE, np.newaxis])
+
+        # weights sum up to the effective pixel number where unbiased covariances of weighted samples are normalized by
+        # the sum of weights less the sum of squared relative weights (n - 1 for boolean masks)
+        w, w2 = (n, n) if weights is None else (weights.sum(), weights @ weights)
+        mu = (shift + s1 / w)[:, np.newaxis]
+        cov = (s2 - np.outer(s1, s1) / w) / (w - w2 / w)
+
+        return mu, cov
+
+    def multivar_transfer(self, src: np.ndarray = None, ref: np.ndarray = None, fun: FunctionType = None,
+                          out: np.ndarray = None) -> np.ndarray:
         """
 
         Transfer function to map colors based on for Multi-Variate Gaussian Distributions (MVGDs).
@@ -65,6 +123,7 @@ class TransferMVGD(MatcherBaseclass):
         :param src: Source image that requires transfer
         :param ref: Palette image which serves as reference
         :param fun: Optional argument to pass a transfer function to solve for covariance matrices
+        :param out: Optional C-contiguous float array of the source shape to write the result into (may be src)
         :param res: Resulting image after the mapping
 
         :type src: :class:`~numpy:numpy.ndarray`
@@ -93,13 +152,130 @@ class TransferMVGD(MatcherBaseclass):
         self.transfer_mat = self._fun_call()
 
         # transfer the intensity distributions
-        res = np.dot(self.transfer_mat, self.r - self.mu_r) + self.mu_z
-
-        # reshape pixel array
-        res = res.T.reshape(self._src.shape)
+        res = self.apply_transfer_mat(self._src, self.transfer_mat, self.mu_r, self.mu_z, out, self.compute_dtype(),
+                                      self._n_threads)
 
         return res
 
+    @staticmethod
+    def apply_transfer_mat(img: np.ndarray, transfer_mat: np.ndarray, mu_r: np.ndarray, mu_z: np.ndarray,
+                           out: np.ndarray = None, dtype: np.dtype = None, n_threads: int = None) -> np.ndarray:
+        """
+        This function applies an affine color transfer as obtained from the MVGD or MKL solution to an image.
+        Pixels are multiplied row-wise with the transposed matrix so that neither the image nor the result is
+        transposed or centered in memory, and the mean shifts are folded into a single offset added in-place.
+
+        :param img: Image array whose last axis holds the color channels
+        :param transfer_mat: Transfer matrix
+        :param mu_r: Color channel means of the source distribution with shape (p, 1)
+        :param mu_z: Color channel means of the reference distribution with shape (p, 1)
+        :param out: Optional C-contiguous float array of the image shape to write the result into (may be img)
+        :param dtype: Floating point type of the result if out is not provided (defaults to float64)
+        :param n_threads: Number of threads processing row tiles in parallel (None for serial execution)
+
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type transfer_mat: :class:`~numpy:numpy.ndarray`
+        :type mu_r: :class:`~numpy:numpy.ndarray`
+        :type mu_z: :class:`~numpy:numpy.ndarray`
+        :type out: :class:`~numpy:numpy.ndarray`
+        :type dtype: :class:`~numpy:numpy.dtype`
+        :type n_threads: :class:`int`
+
+        :return: **res**
+        :rtype: np.ndarray
+        """
+
+        if out is None:
+            out = np.empty(img.shape, dtype=np.dtype('float64') if dtype is None else dtype)
+        elif out.shape != img.shape or not out.flags.c_contiguous or not np.issubdtype(out.dtype, np.floating):
+            raise BaseException('Output array requires a C-contiguous float type of shape %s' % str(img.shape))
+
+        # pixel rows of shape (N, p) as views on image and result
+        r = img.reshape([-1, img.shape[-1]])
+        res = out.reshape(r.shape)
+        mat = transfer_mat.T.astype(out.dtype)
+        offset = (mu_z - np.dot(transfer_mat, mu_r)).T.astype(out.dtype)
+
+        # transfer the intensity distributions in chunks which keeps in-place operation free of full-size copies
+        def apply_tile(i):
+            np.matmul(r[i:i+CHUNK_SIZE], mat, out=res[i:i+CHUNK_SIZE])
+            res[i:i+CHUNK_SIZE] += offset
+
+        TransferMVGD.run_parallel(apply_tile, range(0, r.shape[0], CHUNK_SIZE), n_threads)
+
+        return out
+
+    def multivar_transfer_batch(self, srcs: np.ndarray = None, model: ReferenceModel = None) -> np.ndarray:
+        """
+
+        Batched MVGD transfer of stacked source images towards a fitted reference. Statistics of all frames are computed
+        in vectorized form and transfer matrices are applied in a single broadcast matrix product.
+
+        :param srcs: Stacked source images of shape (B, H, W, p)
+        :param model: Fitted reference model
+
+        :type srcs: :class:`~numpy:numpy.ndarray`
+        :type model: :class:`ReferenceModel`
+
+        :return: **res**: Resulting images of shape (B, H, W, p)
+        :rtype: np.ndarray
+
+        """
+
+        model.require('mu', 'cov')
+
+        # pixel matrices of shape (B, N, p) and their statistics
+        r = srcs.reshape([srcs.shape[0], -1, srcs.shape[-1]])
+        mu_r, cov_r = self.mvgd_stats_batch(self.sample_pixels(srcs))
+
+        # compute transfer matrices of shape (B, p, p)
+        if self._fun_name == 'mvgd':
+            if model.z is None:
+                raise Exception('Analytical MVGD solution requires reference pixels which have not been fitted')
+            if r.shape[1] != model.z.shape[-1]:
+                raise Exception('Analytical MVGD solution requires spatial dimensions of both images to be equal')
+            # reference term is shared across the batch and centering of sources is folded into it
+            ref_mat = self.ref_term(model.z, model.mu, model.cov)
+            ref_r_c = ref_mat @ r - ref_mat.sum(axis=1)[:, np.newaxis] * np.swapaxes(mu_r, -1, -2)
+            transfer_mats = ref_r_c @ np.linalg.pinv(cov_r)
+        else:
+            transfer_mats = self.mkl_mat(cov_r, model.cov)
+
+        # fold mean shifts into offsets and transfer the intensity distributions of all frames at once
+        dtype = self.compute_dtype(srcs)
+        offsets = np.swapaxes(model.mu - transfer_mats @ mu_r, -1, -2).astype(dtype)
+        res = r @ np.swapaxes(transfer_mats, -1, -2).astype(dtype)
+        res += offsets
+
+        return res.reshape(srcs.shape)
+
+    @staticmethod
+    def mvgd_stats_batch(mats: np.ndarray = None) -> tuple:
+        """
+        Compute the parameters of Multi-Variate Gaussian Distributions (MVGDs) from stacked pixel matrices.
+
+        :param mats: Pixel matrices of shape (B, N, p) with p color channels
+        :type mats: :class:`~numpy:numpy.ndarray`
+
+        :return: **stats**: tuple of color channel means with shape (B, p, 1) and covariance matrices (B, p, p)
+        :rtype: tuple
+        """
+
+        # sums and cross-products of chunks shifted by the mean of a first chunk are accumulated in double precision
+        # as in :meth:`mvgd_stats` to avoid cancellation without centered copies of the entire pixel matrices
+        b, n, p = mats.shape
+        shift = mats[:, :CHUNK_SIZE].mean(axis=1, dtype=np.float64)[:, np.newaxis, :]
+        s1, s2 = np.zeros((b, 1, p)), np.zeros((b, p, p))
+        for i in range(0, n, CHUNK_SIZE):
+            chunk = mats[:, i:i+CHUNK_SIZE] - shift
+            s1 += chunk.sum(axis=1, keepdims=True)
+            s2 += np.swapaxes(chunk, -1, -2) @ chunk
+
+        mu = np.swapaxes(shift + s1 / n, -1, -2)
+        cov = (s2 - np.swapaxes(s1, -1, -2) @ s1 / n) / (n - 1)
+
+        return mu, cov
+
     def mkl_solver(self):
         """
         This function computes the transfer matrix based on the Monge-Kantorovich Linearization (MKL).
@@ -113,20 +289,126 @@ class TransferMVGD(MatcherBaseclass):
         # validate dimensionality
         self.check_dims()
 
-        eig_val_r, eig_vec_r = np.linalg.eig(self.cov_r)
-        eig_val_r[eig_val_r < 0] = 0
-        val_r = np.diag(np.sqrt(eig_val_r[::-1]))
-        vec_r = np.array(eig_vec_r[:, ::-1])
-        inv_r = np.diag(1. / (np.diag(val_r + np.spacing(1))))
+        self.transfer_mat = self.mkl_mat(self.cov_r, self.cov_z)
 
-        mat_c = val_r @ vec_r.T @ self.cov_z @ vec_r @ val_r
-        eig_val_c, eig_vec_c = np.linalg.eig(mat_c)
-        eig_val_c[eig_val_c < 0] = 0
-        val_c = np.diag(np.sqrt(eig_val_c))
+        return self.transfer_mat
 
-        self.transfer_mat = vec_r @ inv_r @ eig_vec_c @ val_c @ eig_vec_c.T @ inv_r @ vec_r.T
+    @staticmethod
+    def mkl_mat(cov_r: np.ndarray, cov_z: np.ndarray) -> np.ndarray:
+        """
+        This function solves for the MKL transfer matrix given covariance matrices, which may be stacked along leading
+        dimensions of shape (..., p, p) to solve for many image pairs at once. Stacks of 3x3 matrices are solved in
+        closed form (see :meth:`mkl_mat_3x3`) and others by symmetric eigen decompositions.
 
-        return self.transfer_mat
+        :param cov_r: Covariance matrix of the source
+        :param cov_z: Covariance matrix of the reference
+
+        :type cov_r: :class:`~numpy:numpy.ndarray`
+        :type cov_z: :class:`~numpy:numpy.ndarray`
+
+        :return: **transfer_mat**: Transfer matrix
+        :rtype: np.ndarray
+        """
+
+        if cov_r.shape[-1] == 3 and len(cov_r.shape) > 2:
+            return TransferMVGD.mkl_mat_3x3(cov_r, cov_z)
+
+        return TransferMVGD.mkl_mat_eigh(cov_r, cov_z)
+
+    @staticmethod
+    def mkl_mat_eigh(cov_r: np.ndarray, cov_z: np.ndarray) -> np.ndarray:
+        """ MKL transfer matrices from (batched) eigen decompositions of symmetric matrices (see :meth:`mkl_mat`) """
+
+        eig_val_r, eig_vec_r = np.linalg.eigh(cov_r)
+        val_r = np.sqrt(np.maximum(eig_val_r, 0))
+        inv_r = 1. / (val_r + np.spacing(1))
+
+        # diagonal matrix products are carried out by broadcasting
+        mat_c = np.swapaxes(eig_vec_r, -1, -2) @ cov_z @ eig_vec_r
+        mat_c = val_r[..., :, np.newaxis] * mat_c * val_r[..., np.newaxis, :]
+        eig_val_c, eig_vec_c = np.linalg.eigh(mat_c)
+        val_c = np.sqrt(np.maximum(eig_val_c, 0))
+
+        vec_inv = eig_vec_r * inv_r[..., np.newaxis, :]
+        mat_sqrt = (eig_vec_c * val_c[..., np.newaxis, :]) @ np.swapaxes(eig_vec_c, -1, -2)
+        transfer_mat = vec_inv @ mat_sqrt @ np.swapaxes(vec_inv, -1, -2)
+
+        return transfer_mat
+
+    @staticmethod
+    def mkl_mat_3x3(cov_r: np.ndarray, cov_z: np.ndarray) -> np.ndarray:
+        """
+        Closed-form MKL solution T = A^(-1/2) (A^(1/2) B A^(1/2))^(1/2) A^(-1/2) for stacks of 3x3 covariance matrices
+        A of sources and B of references, which is vectorized over the stack without calls to LAPACK. Ill-conditioned
+        source covariances are solved by :meth:`mkl_mat_eigh` instead.
+
+        :param cov_r: Covariance matrices of the sources of shape (..., 3, 3)
+        :param cov_z: Covariance matrices of the references of shape (..., 3, 3) (broadcast against cov_r)
+
+        :type cov_r: :class:`~numpy:numpy.ndarray`
+        :type cov_z: :class:`~numpy:numpy.ndarray`
+
+        :return: **transfer_mat**: Transfer matrices of shape (..., 3, 3)
+        :rtype: np.ndarray
+        """
+
+        cov_r, cov_z = [np.array(arr, dtype=np.float64) for arr in np.broadcast_arrays(cov_r, cov_z)]
+
+        # singular matrices yield non-finite entries which are caught below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eig_vals = TransferMVGD.eigvalsh_3x3(cov_r)
+            sqrt_r = TransferMVGD.sqrtm_3x3(cov_r, eig_vals)
+            inv_sqrt_r = TransferMVGD.inv_3x3(sqrt_r)
+            transfer_mat = inv_sqrt_r @ TransferMVGD.sqrtm_3x3(sqrt_r @ cov_z @ sqrt_r) @ inv_sqrt_r
+
+        # fall back to eigen decompositions where the inverse square root is inaccurate
+        valid = (eig_vals[..., 0] > COND_TOL * eig_vals[..., 2]) & np.isfinite(transfer_mat).all(axis=(-2, -1))
+        if not np.all(valid):
+            transfer_mat[~valid] = TransferMVGD.mkl_mat_eigh(cov_r[~valid], cov_z[~valid])
+
+        return transfer_mat
+
+    @staticmethod
+    def eigvalsh_3x3(mats: np.ndarray = None) -> np.ndarray:
+        """ eigenvalues of symmetric 3x3 matrices in ascending order by the trigonometric solution of their cubic """
+
+        q = np.trace(mats, axis1=-2, axis2=-1) / 3
+        dev = mats - q[..., np.newaxis, np.newaxis] * np.eye(3)
+        p = np.sqrt(np.sum(dev**2, axis=(-2, -1)) / 6)
+
+        # matrices equal to multiples of the identity have a single eigenvalue
+        scale = np.where(p > 0, p, 1)
+        phi = np.arccos(np.clip(np.linalg.det(dev / scale[..., np.newaxis, np.newaxis]) / 2, -1, 1)) / 3
+        val_max = q + 2 * p * np.cos(phi)
+        val_min = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+
+        return np.stack([val_min, 3 * q - val_max - val_min, val_max], axis=-1)
+
+    @staticmethod
+    def sqrtm_3x3(mats: np.ndarray = None, eig_vals: np.ndarray = None) -> np.ndarray:
+        """
+        Square roots of symmetric positive semi-definite 3x3 matrices M in closed form from the square roots s of
+        their eigenvalues via M^(1/2) = (-M^2 + (I1^2 - I2) M + I1 I3 E) / (I1 I2 - I3) with the invariants I of s.
+        """
+
+        eig_vals = TransferMVGD.eigvalsh_3x3(mats) if eig_vals is None else eig_vals
+        s = np.sqrt(np.maximum(eig_vals, 0))
+        i1, i2, i3 = s.sum(axis=-1), (s[..., 0]*s[..., 1] + s[..., 0]*s[..., 2] + s[..., 1]*s[..., 2]), s.prod(axis=-1)
+        denom = i1 * i2 - i3
+        denom = np.where(denom > 0, denom, np.nan)[..., np.newaxis, np.newaxis]
+
+        return (-mats @ mats + (i1**2 - i2)[..., np.newaxis, np.newaxis] * mats +
+                (i1 * i3)[..., np.newaxis, np.newaxis] * np.eye(3)) / denom
+
+    @staticmethod
+    def inv_3x3(mats: np.ndarray = None) -> np.ndarray:
+        """ inverses of 3x3 matrices from cross products of their rows (adjugate divided by the determinant) """
+
+        rows = [mats[..., i, :] for i in range(3)]
+        adj = np.stack([np.cross(rows[1], rows[2]), np.cross(rows[2], rows[0]), np.cross(rows[0], rows[1])], axis=-1)
+        det = np.sum(rows[0] * adj[..., :, 0], axis=-1)
+
+        return adj / det[..., np.newaxis, np.newaxis]
 
     def analytical_solver(self) -> np.ndarray:
         """
@@ -140,40 +422,100 @@ class TransferMVGD(MatcherBaseclass):
 
         # validate dimensionality
         self.check_dims()
+        if self.z is None:
+            raise Exception('Analytical MVGD solution requires reference pixels which have not been fitted')
         if self.r.shape[-1] != self.z.shape[-1]:
             raise Exception('Analytical MVGD solution requires spatial dimensions of both images to be equal')
 
-        cov_r_inv = np.linalg.pinv(self.cov_r)
-        cov_z_inv = np.linalg.pinv(self.cov_z)
+        # pixel correspondences are weighted by both masks (if provided) in the least-squares sense
+        weights = self.pixel_weights(self._src_mask, self._src)
+        if self._ref_mask is not None and not isinstance(self._ref, ReferenceModel):
+            ref_weights = self.pixel_weights(self._ref_mask, self._ref)
+            weights = ref_weights if weights is None else weights * ref_weights
 
-        # compute transfer matrix using analytical method
-        self.transfer_mat = np.linalg.pinv((self.z-self.mu_z).T @ cov_z_inv) @ (self.r-self.mu_r).T @ cov_r_inv
+        # least-squares solution pinv((z-mu_z).T @ inv(cov_z)) @ (r-mu_r).T @ inv(cov_r) obtained from the 3x3 moment
+        # matrices of centered pixels, i.e. cov_z @ inv(S_zz) @ S_zr @ inv(cov_r), instead of pseudo-inverting N rows
+        s_zz = self.cross_moments(self.z, self.z, self.mu_z, self.mu_z, weights)
+        s_zr = self.cross_moments(self.z, self.r, self.mu_z, self.mu_r, weights)
+        self.transfer_mat = self.cov_z @ np.linalg.pinv(s_zz) @ s_zr @ np.linalg.pinv(self.cov_r)
 
         return self.transfer_mat
 
     @staticmethod
-    def w2_dist(mu_a: np.ndarray, mu_b: np.ndarray, cov_a: np.ndarray, cov_b: np.ndarray) -> float:
+    def cross_moments(mat_a: np.ndarray, mat_b: np.ndarray, mu_a: np.ndarray, mu_b: np.ndarray,
+                      weights: np.ndarray = None) -> np.ndarray:
+        """
+        Sum of (weighted) outer products of centered pixel pairs computed in chunks without centered copies.
+
+        :param mat_a: Pixel matrix of shape (p, N)
+        :param mat_b: Pixel matrix of shape (q, N)
+        :param mu_a: Centers of shape (p, 1)
+        :param mu_b: Centers of shape (q, 1)
+        :param weights: Optional non-negative weights of the N pixel pairs
+
+        :return: **moments**: Matrix of shape (p, q)
+        :rtype: np.ndarray
+        """
+
+        mom = np.zeros((mat_a.shape[0], mat_b.shape[0]))
+        for i in range(0, mat_a.shape[1], CHUNK_SIZE):
+            chunk_a = mat_a[:, i:i+CHUNK_SIZE] - mu_a
+            chunk_b = mat_b[:, i:i+CHUNK_SIZE] - mu_b
+            if weights is not None:
+                chunk_b *= weights[i:i+CHUNK_SIZE]
+            mom += chunk_a @ chunk_b.T
+
+        return mom
+
+    @staticmethod
+    def ref_term(z: np.ndarray = None, mu_z: np.ndarray = None, cov_z: np.ndarray = None) -> np.ndarray:
+        """ reference term pinv((z-mu_z).T @ inv(cov_z)) of the analytical solution via the 3x3 moment matrix """
+
+        return cov_z @ np.linalg.pinv(TransferMVGD.cross_moments(z, z, mu_z, mu_z)) @ (z - mu_z)
+
+    @staticmethod
+    def w2_dist(mu_a: np.ndarray, mu_b: np.ndarray, cov_a: np.ndarray, cov_b: np.ndarray):
         """
-        Wasserstein-2 distance metric is a similarity measure for Gaussian distributions
+        Squared Wasserstein-2 distance as a similarity measure for Gaussian distributions, which is given by
+        ||mu_a - mu_b||^2 + tr(cov_a + cov_b - 2 (cov_a^(1/2) cov_b cov_a^(1/2))^(1/2)). Parameters may be stacked
+        along leading dimensions (e.g. one query against many distributions) which are broadcast against each other.
 
-        :param mu_a: Gaussian mean of distribution *a*
-        :param mu_b: Gaussian mean of distribution *b*
-        :param cov_a: Covariance matrix of distribution *a*
-        :param cov_b: Covariance matrix of distribution *b*
+        :param mu_a: Gaussian mean of distribution *a* of shape (..., p) or (..., p, 1)
+        :param mu_b: Gaussian mean of distribution *b* of shape (..., p) or (..., p, 1)
+        :param cov_a: Covariance matrix of distribution *a* of shape (..., p, p)
+        :param cov_b: Covariance matrix of distribution *b* of shape (..., p, p)
 
         :type mu_a: :class:`~numpy:numpy.ndarray`
         :type mu_b: :class:`~numpy:numpy.ndarray`
         :type cov_a: :class:`~numpy:numpy.ndarray`
         :type cov_b: :class:`~numpy:numpy.ndarray`
 
-        :return: **scalar**: Wasserstein-2 metric as a scalar
+        :return: **scalar**: Squared Wasserstein-2 metric as a scalar (or array for stacked distributions)
         :rtype: float
         """
 
-        mean_dist = np.sum((mu_a-mu_b)**2)
-        vars_dist = np.trace(cov_a+cov_b - 2*(np.dot(np.abs(cov_b)**.5, np.dot(np.abs(cov_a), np.abs(cov_b)**.5))**.5))
+        cov_a, cov_b = np.asarray(cov_a, dtype=np.float64), np.asarray(cov_b, dtype=np.float64)
+        p = cov_a.shape[-1]
+        mu_a, mu_b = [np.asarray(mu, dtype=np.float64) for mu in (mu_a, mu_b)]
+        mu_a, mu_b = [mu[..., 0] if mu.shape[-2:] == (p, 1) else mu for mu in (mu_a, mu_b)]
+
+        mean_dist = np.sum((mu_a-mu_b)**2, axis=-1)
+        sqrt_a = TransferMVGD.sqrtm_psd(cov_a)
+        eig_vals = np.linalg.eigvalsh(sqrt_a @ cov_b @ sqrt_a)
+        vars_dist = np.trace(cov_a, axis1=-2, axis2=-1) + np.trace(cov_b, axis1=-2, axis2=-1) - \
+            2 * np.sqrt(np.maximum(eig_vals, 0)).sum(axis=-1)
+
+        dist = np.maximum(mean_dist + vars_dist, 0)
+
+        return float(dist) if np.ndim(dist) == 0 else dist
+
+    @staticmethod
+    def sqrtm_psd(mat: np.ndarray = None) -> np.ndarray:
+        """ square root of symmetric positive semi-definite matrices of shape (..., p, p) by eigen decomposition """
+
+        eig_vals, eig_vecs = np.linalg.eigh(mat)
 
-        return float(mean_dist + vars_dist)
+        return (eig_vecs * np.sqrt(np.maximum(eig_vals, 0))[..., np.newaxis, :]) @ np.swapaxes(eig_vecs, -1, -2)
 
     def w2_img_dist(self, img_a: np.ndarray, img_b:np.ndarray):
 
@@ -190,8 +532,8 @@ class TransferMVGD(MatcherBaseclass):
         :rtype: float
         """
 
-        mu_a, mu_b = np.mean(img_a, axis=(0, 1)), np.mean(img_b, axis=(0, 1))
-        cov_a, cov_b = np.cov(img_a.reshape(-1, 3).T), np.cov(img_b.reshape(-1, 3).T)
+        mu_a, cov_a = self.mvgd_stats(self.sample_pixels(img_a).T)
+        mu_b, cov_b = self.mvgd_stats(self.sample_pixels(img_b).T)
         w2_img_dist = self.w2_dist(mu_a, mu_b, cov_a, cov_b)
 
         return w2_img_dist
@@ -22,18 +22,22 @@ __license__ = """
 
 import numpy as np
 
+from color_matcher.mvgd_matcher import CHUNK_SIZE
+
 
 class Normalizer(object):
 
-    def __init__(self, data=None, min=None, max=None):
+    def __init__(self, data=None, min=None, max=None, dtype='float64'):
 
         self._data, self._min, self._max = None, None, None
+        self._float = str(np.dtype(dtype))
         self._var_init(data, min, max)
 
     def _var_init(self, data=None, min=None, max=None):
 
-        self._data = self._data if data is None else np.asarray(data, dtype='float64')
-        self._dtype = str(self._data.dtype) if isinstance(self._data, np.ndarray) else 'float64'
+        # keep data in its storage type as conversion takes place once during normalization
+        self._data = self._data if data is None else np.asarray(data)
+        self._dtype = self._float
 
         self._min = self._min if min is None else min
         self._max = self._max if max is None else max
@@ -43,12 +47,24 @@ class Normalizer(object):
     def uint16_norm(self):
         """ normalize image array to 16-bit unsigned integer """
 
-        return np.asarray(np.round(self.norm_fun()*(2**16-1)), dtype=np.uint16)
+        return self.int_norm(np.uint16)
 
     def uint8_norm(self):
         """ normalize image array to 8-bit unsigned integer """
 
-        return np.asarray(np.round(self.norm_fun()*(2**8-1)), dtype=np.uint8)
+        return self.int_norm(np.uint8)
+
+    def int_norm(self, dtype=None, new_min=None, new_max=None):
+        """ normalize image array to full range of provided integer type with in-place scaling and rounding """
+
+        new_max = np.iinfo(np.dtype(dtype)).max if new_max is None else new_max
+        new_min = np.iinfo(np.dtype(dtype)).min if new_min is None else new_min
+        img_norm = self.norm_fun()
+        img_norm *= new_max - new_min
+        img_norm += new_min
+        np.rint(img_norm, out=img_norm)
+
+        return img_norm.astype(dtype)
 
     def type_norm(self, data=None, min=None, max=None, new_min=None, new_max=None):
         """ normalize numpy image array for provided data type """
@@ -56,23 +72,46 @@ class Normalizer(object):
         self._var_init(data, min, max)
 
         if self._dtype.startswith(('int', 'uint')):
-            new_max = np.iinfo(np.dtype(self._dtype)).max if new_max is None else new_max
-            new_min = np.iinfo(np.dtype(self._dtype)).min if new_min is None else new_min
-            img_norm = np.round(self.norm_fun() * (new_max - new_min) + new_min)
-        else:
-            new_max = 1.0 if new_max is None else new_max
-            new_min = 0.0 if new_min is None else new_min
-            img_norm = self.norm_fun() * (new_max - new_min) + new_min
+            return self.int_norm(self._dtype, new_min, new_max)
+
+        new_max = 1.0 if new_max is None else new_max
+        new_min = 0.0 if new_min is None else new_min
+        img_norm = self.norm_fun()
+        if (new_min, new_max) != (0, 1):
+            img_norm *= new_max - new_min
+            img_norm += new_min
+
+        return img_norm
+
+    def type_cast(self, data=None, dtype=None):
+        """ convert image array to provided integer type by rounding and clipping to its range without stretching """
+
+        data = self._data if data is None else np.asarray(data)
+        dtype = np.dtype(self._dtype if dtype is None else dtype)
+        if not np.issubdtype(dtype, np.integer) or np.can_cast(data.dtype, dtype):
+            return data.astype(dtype, copy=False)
+
+        # chunks of flat pixels limit transient memory to a fraction of the image
+        info = np.iinfo(dtype)
+        res = np.empty(data.shape, dtype=dtype)
+        src, dst = data.reshape(-1), res.reshape(-1)
+        for i in range(0, src.size, CHUNK_SIZE):
+            chunk = np.clip(src[i:i+CHUNK_SIZE], info.min, info.max)
+            dst[i:i+CHUNK_SIZE] = np.rint(chunk, out=chunk) if np.issubdtype(chunk.dtype, np.floating) else chunk
 
-        return np.asarray(img_norm, dtype=self._dtype)
+        return res
 
     def norm_fun(self):
         """ normalize image to values between 1 and 0 """
 
-        norm = (self._data - self._min) / (self._max - self._min) if self._max != (self._min and 0) else self._data
+        # single float copy so that data of the caller remains untouched
+        dtype = self._dtype if np.issubdtype(np.dtype(self._dtype), np.floating) else 'float64'
+        norm = np.array(self._data, dtype=dtype)
+        if self._max != self._min:
+            norm -= self._min
+            norm /= self._max - self._min
 
         # prevent wrap-around
-        norm[norm < 0] = 0
-        norm[norm > 1] = 1
+        np.clip(norm, 0, 1, out=norm)
 
         return norm
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from color_matcher.baseclass import MatcherBaseclass
+from color_matcher.mvgd_matcher import TransferMVGD
+from color_matcher.ref_model import ReferenceModel
+
+
+class ReferenceIndex(object):
+
+    def __init__(self, channels: int = 3, **kwargs):
+        """
+        Library of reference palettes described by the mean and covariance of their colors, which finds the references
+        closest to a query image by the squared Wasserstein-2 distance of Gaussian distributions. Moments of each
+        reference are stored once, and a query is compared to all entries in one vectorized call where the square root
+        of the query covariance is computed once and only 3x3 eigenvalue problems remain per entry.
+
+        :param channels: Number of color channels
+        :param kwargs: Options of :class:`MatcherBaseclass` for the statistics of images (e.g. stats_sample)
+        """
+
+        self.channels = channels
+        self._matcher = MatcherBaseclass(**kwargs)
+        self.keys = []
+        self._mus, self._covs = [], []
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def moments(self, ref=None) -> tuple:
+        """ mean vector and covariance matrix of an image or fitted :class:`ReferenceModel` """
+
+        if isinstance(ref, ReferenceModel):
+            ref.require('mu', 'cov')
+            mu, cov = ref.mu, ref.cov
+        else:
+            ref = np.asarray(ref)
+            if len(ref.shape) != 3:
+                raise BaseException('Each image must have 3 dimensions')
+            mu, cov = TransferMVGD.mvgd_stats(self._matcher.sample_pixels(ref[..., :self.channels]).T)
+
+        if cov.shape != (self.channels, self.channels):
+            raise BaseException('Reference index expects %s color channels' % self.channels)
+
+        return np.asarray(mu, dtype=np.float64).reshape(-1), np.asarray(cov, dtype=np.float64)
+
+    def add(self, key=None, ref=None) -> int:
+        """
+        Add a reference to the library.
+
+        :param key: Identifier returned by queries (e.g. a file name)
+        :param ref: Reference image of shape (H, W, C) or fitted :class:`ReferenceModel`
+
+        :return: **num**: Number of references in the library
+        :rtype: int
+        """
+
+        mu, cov = self.moments(ref)
+        self.keys.append(key)
+        self._mus.append(mu)
+        self._covs.append(cov)
+        self._arrays = None
+
+        return len(self.keys)
+
+    def arrays(self) -> tuple:
+        """ stacked means of shape (N, p) and covariances of shape (N, p, p), which are built once after additions """
+
+        if self._arrays is None:
+            self._arrays = (np.array(self._mus).reshape(-1, self.channels),
+                            np.array(self._covs).reshape(-1, self.channels, self.channels))
+
+        return self._arrays
+
+    def distances(self, query=None) -> np.ndarray:
+        """
+        Squared Wasserstein-2 distances of a query to all references.
+
+        :param query: Query image of shape (H, W, C) or fitted :class:`ReferenceModel`
+
+        :return: **dists**: Distances in the order of the keys
+        :rtype: np.ndarray
+        """
+
+        mu, cov = self.moments(query)
+        mus, covs = self.arrays()
+
+        return np.atleast_1d(TransferMVGD.w2_dist(mu, mus, cov, covs))
+
+    def query(self, query=None, k: int = 1, candidates: int = None) -> list:
+        """
+        Find the references closest to a query.
+
+        The distance of means is a lower bound of the Wasserstein-2 distance as the covariance term is non-negative.
+        If candidates is given, only this number of references with the nearest means is evaluated in full, which
+        skips eigenvalue problems of most entries at the risk of missing references of similar covariance only.
+
+        :param query: Query image of shape (H, W, C) or fitted :class:`ReferenceModel`
+        :param k: Number of references to return
+        :param candidates: Number of references with nearest means evaluated in full (None evaluates all)
+
+        :type k: :class:`int`
+        :type candidates: :class:`int`
+
+        :return: **matches**: list of (key, distance) pairs in ascending order of distance
+        :rtype: list
+        """
+
+        if not self.keys:
+            raise BaseException('Reference index is empty')
+
+        mu, cov = self.moments(query)
+        mus, covs = self.arrays()
+        idxs = np.arange(len(self.keys))
+
+        # coarse pre-filter by distance of means
+        if candidates is not None and max(candidates, k) < idxs.size:
+            mean_dists = np.sum((mus - mu)**2, axis=-1)
+            idxs = np.argpartition(mean_dists, max(candidates, k) - 1)[:max(candidates, k)]
+
+        dists = np.atleast_1d(TransferMVGD.w2_dist(mu, mus[idxs], cov, covs[idxs]))
+        k = min(k, idxs.size)
+        top = np.argpartition(dists, k - 1)[:k]
+        top = top[np.argsort(dists[top], kind='stable')]
+
+        return [(self.keys[idxs[i]], float(dists[i])) for i in top]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+MODEL_FIELDS = ('method', 'shape', 'hist', 'lab', 'mu', 'cov', 'z', 'gray')
+MODEL_VERSION = 1
+
+
+class ReferenceModel(namedtuple('ReferenceModel', MODEL_FIELDS, defaults=(None,) * len(MODEL_FIELDS))):
+    """
+    Immutable container of precomputed reference statistics as returned by :meth:`ColorMatcher.fit`.
+
+    It may be passed wherever a reference image is expected, in which case only source statistics are computed.
+    Fields that are not required by the fitted method are set to None.
+
+    :param method: method the statistics were fitted for or None if fitted for all methods
+    :param shape: shape of the reference image after channel validation
+    :param hist: tuple of (values, cdf) pairs per color channel for histogram matching
+    :param lab: tuple of (mean, std) vectors in Lab space for Reinhard's method
+    :param mu: color channel means of shape (p, 1)
+    :param cov: color channel covariance matrix of shape (p, p)
+    :param z: reference pixel matrix of shape (p, N) as required by the analytical MVGD solver
+    :param gray: :class:`ReferenceModel` of the monochromatic reference for transfers of gray scale sources
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+
+        self = super(ReferenceModel, cls).__new__(cls, *args, **kwargs)
+
+        # make arrays read-only so that the model cannot be altered by matchers
+        for arr in self.arrays():
+            arr.setflags(write=False)
+
+        return self
+
+    def arrays(self) -> list:
+        """ list all numpy arrays held by the model (excluding the nested gray scale model) """
+
+        arrs = []
+        for field in ('hist', 'lab', 'mu', 'cov', 'z'):
+            val = getattr(self, field)
+            if isinstance(val, np.ndarray):
+                arrs.append(val)
+            elif isinstance(val, tuple):
+                arrs += [arr for pair in val for arr in (pair if isinstance(pair, tuple) else (pair,))]
+
+        return arrs
+
+    def require(self, *fields):
+        """ raise an exception if statistics required by a method have not been fitted """
+
+        missing = [field for field in fields if getattr(self, field) is None]
+        if missing:
+            raise Exception('Reference model fitted for method \'%s\' lacks %s' % (self.method, ', '.join(missing)))
+
+        return True
+
+    def to_dict(self, prefix: str = '') -> dict:
+        """ flatten model to a dictionary of numpy arrays (e.g., for storage in an npz file) """
+
+        data = {prefix + 'method': np.array('' if self.method is None else self.method),
+                prefix + 'shape': np.array(self.shape)}
+        if not prefix:
+            data['version'] = np.array(MODEL_VERSION)
+        if self.hist is not None:
+            for ch, (vals, cdf) in enumerate(self.hist):
+                data['%shist_vals_%d' % (prefix, ch)] = vals
+                data['%shist_cdf_%d' % (prefix, ch)] = cdf
+        if self.lab is not None:
+            data[prefix + 'lab_mean'], data[prefix + 'lab_std'] = self.lab
+        for field in ('mu', 'cov', 'z'):
+            if getattr(self, field) is not None:
+                data[prefix + field] = getattr(self, field)
+        if self.gray is not None:
+            data.update(self.gray.to_dict(prefix + 'gray_'))
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict = None, prefix: str = ''):
+        """ create model from a dictionary of numpy arrays as obtained by :meth:`to_dict` """
+
+        if not prefix and int(data['version']) > MODEL_VERSION:
+            raise BaseException('Model version %s is not supported (max. %s)' % (int(data['version']), MODEL_VERSION))
+
+        shape = tuple(int(n) for n in data[prefix + 'shape'])
+        hist = None
+        if prefix + 'hist_vals_0' in data:
+            hist = tuple((data['%shist_vals_%d' % (prefix, ch)], data['%shist_cdf_%d' % (prefix, ch)])
+                         for ch in range(shape[2]))
+        lab = (data[prefix + 'lab_mean'], data[prefix + 'lab_std']) if prefix + 'lab_mean' in data else None
+        mu, cov, z = [data[prefix + field] if prefix + field in data else None for field in ('mu', 'cov', 'z')]
+        gray = cls.from_dict(data, prefix + 'gray_') if prefix + 'gray_shape' in data else None
+
+        return cls(method=str(data[prefix + 'method']) or None, shape=shape, hist=hist, lab=lab, mu=mu, cov=cov, z=z,
+                   gray=gray)
+
+    @classmethod
+    def blend(cls, models: list = None, weights: list = None, method: str = None):
+        """
+        Combine fitted reference models into the model of a weighted mixture of their pixel distributions without
+        revisiting any pixels, where the cost depends on the number of models and histogram values only. Means and
+        covariances are pooled as those of a Gaussian mixture, Lab moments likewise per channel, and cumulative
+        distributions are averaged over the union of histogram values. Pixel matrices for the analytical MVGD solver
+        cannot be blended and are left out.
+
+        :param models: List of fitted reference models with equal numbers of color channels
+        :param weights: Non-negative mixture weights of the models (defaults to equal weights)
+        :param method: Method of the blended model (defaults to the common method of all models)
+
+        :return: **model**: Blended reference model
+        :rtype: ReferenceModel
+        """
+
+        models = list(models)
+        weights = np.ones(len(models)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if not models or weights.shape != (len(models),):
+            raise BaseException('One weight per reference model is required')
+        if np.any(weights < 0) or weights.sum() <= 0:
+            raise BaseException('Weights must be non-negative with a positive sum')
+        if len(set(model.shape[2] for model in models)) > 1:
+            raise BaseException('Reference models differ in their number of color channels')
+        weights = weights / weights.sum()
+
+        # fields are blended if present in all models
+        has = {field: all(getattr(model, field) is not None for model in models) for field in ('hist', 'lab', 'mu')}
+        hist = lab = mu = cov = None
+        if has['hist']:
+            hist = tuple(cls.blend_cdfs(hists, weights) for hists in zip(*(model.hist for model in models)))
+        if has['lab']:
+            mean = sum(w * np.asarray(model.lab[0]) for w, model in zip(weights, models))
+            var = sum(w * (np.asarray(model.lab[1])**2 + (np.asarray(model.lab[0]) - mean)**2)
+                      for w, model in zip(weights, models))
+            lab = (mean, np.sqrt(var))
+        if has['mu'] and all(model.cov is not None for model in models):
+            mu = sum(w * model.mu for w, model in zip(weights, models))
+            cov = sum(w * (model.cov + (model.mu - mu) @ (model.mu - mu).T) for w, model in zip(weights, models))
+
+        gray = None
+        if all(model.gray is not None for model in models):
+            gray = cls.blend([model.gray for model in models], weights, method)
+
+        methods = set(model.method for model in models)
+        method = method if method is not None else methods.pop() if len(methods) == 1 else None
+
+        return cls(method=method, shape=models[0].shape, hist=hist, lab=lab, mu=mu, cov=cov, gray=gray)
+
+    @staticmethod
+    def blend_cdfs(hists: tuple = None, weights: np.ndarray = None) -> tuple:
+        """ weighted mixture of (values, cdf) pairs evaluated as step functions over the union of their values """
+
+        vals = np.unique(np.concatenate([np.asarray(vals, dtype=np.float64) for vals, _ in hists]))
+        cdf = np.zeros(vals.size)
+        for w, (ref_vals, ref_cdf) in zip(weights, hists):
+            idxs = np.searchsorted(ref_vals, vals, side='right') - 1
+            cdf += w * np.where(idxs >= 0, np.asarray(ref_cdf)[np.maximum(idxs, 0)], 0)
+
+        return vals, cdf
@@ -1,28 +1,48 @@
 import numpy as np
 
 from .baseclass import MatcherBaseclass
+from .ref_model import ReferenceModel
+from .mvgd_matcher import CHUNK_SIZE
 
 LMS_MAT = np.array([[0.3811, 0.5783, 0.0402], [0.1967, 0.7244, 0.0782], [0.0241, 0.1288, 0.8444]])
 LMS_MAT_INV = np.array([[4.4679, -3.5873, 0.1193], [-1.2186, 2.3809, -0.1624], [0.0497, -0.2439, 1.2045]])
 
+# PCA transform matrices according to Rudermann et al.
+PCA_B = np.array([[1/np.sqrt(3), 0, 0], [0, 1/np.sqrt(6), 0], [0, 0, 1/np.sqrt(2)]])
+PCA_C = np.array([[1, 1, 1], [1, 1, -2], [1, -1, 0]])
+
+# precomposed conversions between logarithmic LMS and Lab space (rows of the latter are orthonormal)
+LAB_MAT = np.dot(PCA_B, PCA_C)
+LAB_MAT_INV = np.dot(PCA_C.T, PCA_B)
+LN10 = np.log(10)
+
 
 class ReinhardMatcher(MatcherBaseclass):
 
     def __init__(self, *args, **kwargs):
         super(ReinhardMatcher, self).__init__(*args, **kwargs)
 
-    def reinhard(self, src: np.ndarray = None, ref: np.ndarray = None) -> np.ndarray:
+        # Lab space alignment parameters of the most recent mapping
+        self.lab_params = None
+
+    def reinhard(self, src: np.ndarray = None, ref: np.ndarray = None, out: np.ndarray = None) -> np.ndarray:
         """
 
         This function conducts color matching based on the principles proposed by Reinhard et al.
         The paper of the original work can be found at https://www.cs.tau.ac.il/~turkel/imagepapers/ColorTransfer.pdf
 
+        Pixels are converted to logarithmic LMS space only once, from which Lab statistics follow by the precomposed
+        linear map, and the channel-wise alignment in Lab space is folded into a single affine map in that space.
+        Inputs are left untouched unless passed as out.
+
         :param src: Source image that requires transfer
         :param ref: Palette image which serves as reference
+        :param out: Optional C-contiguous float array of the source shape to write the result into (may be src)
         :param res: Resulting image after the mapping
 
         :type src: :class:`~numpy:numpy.ndarray`
         :type ref: :class:`~numpy:numpy.ndarray`
+        :type out: :class:`~numpy:numpy.ndarray`
         :type res: :class:`~numpy:numpy.ndarray`
 
         :return: **res**
@@ -37,48 +57,268 @@ class ReinhardMatcher(MatcherBaseclass):
         # get image dimensions after validating that 3 color channels are present
         m, n, p = self._src.shape if self.validate_color_chs() else self._src.shape + (1,)
 
-        # flatten images along spatial dimensions
-        src = self._src.reshape((-1, p)).transpose()
-        ref = self._ref.reshape((-1, p)).transpose()
+        # convert source to logarithmic LMS space and compute Lab statistics (from a pixel sample)
+        # (the sample is converted before the source may be overwritten by the result)
+        dtype = self.compute_dtype()
+        sample = None if self._stats_sample is None else self.log_lms(self.sample_pixels(self._src), dtype=dtype)
+        log_src = self.log_lms(self._src, out=out, dtype=dtype, n_threads=self._n_threads)
+        sample = log_src if sample is None else sample
+        mean_src, std_src = self.lab_moments(sample, self.pixel_weights(self._src_mask, self._src, sample=True))
+        if sample.shape[0] < log_src.shape[0]:
+            self.stats_err.update(self.sample_err(sample @ LAB_MAT.T / LN10, log_src.shape[0], 'src'))
+
+        # use precomputed reference statistics (if provided)
+        if isinstance(self._ref, ReferenceModel) and self._ref.require('lab'):
+            mean_ref, std_ref = self._ref.lab
+        else:
+            sample, num = self.log_lms(self.sample_pixels(self._ref), dtype=dtype), int(np.prod(self._ref.shape[:2]))
+            mean_ref, std_ref = self.lab_moments(sample, self.pixel_weights(self._ref_mask, self._ref, sample=True))
+            if sample.shape[0] < num:
+                self.stats_err.update(self.sample_err(sample @ LAB_MAT.T / LN10, num, 'ref'))
+
+        # compute ratios of standard deviations channel-wise
+        std_ratios = std_ref / std_src
+        self.lab_params = (mean_src, std_ratios, mean_ref)
+
+        # apply statistical alignment and convert back to RGB in-place
+        res = self.lab_transfer(log_src, *self.lab_params, out=log_src, n_threads=self._n_threads)
+
+        # reshape to 2-D image
+        res = res.reshape((m, n, p))
+
+        return res
+
+    def reinhard_batch(self, srcs: np.ndarray = None, model: ReferenceModel = None) -> np.ndarray:
+        """
+
+        Batched version of Reinhard's method for stacked source images and a fitted reference.
+
+        :param srcs: Stacked source images of shape (B, H, W, 3)
+        :param model: Fitted reference model
+
+        :type srcs: :class:`~numpy:numpy.ndarray`
+        :type model: :class:`ReferenceModel`
+
+        :return: **res**: Resulting images of shape (B, H, W, 3)
+        :rtype: np.ndarray
+
+        """
+
+        model.require('lab')
+        mean_ref, std_ref = model.lab
+
+        # frames are converted in-place of the result array and aligned with their own statistics (from pixel samples)
+        dtype = self.compute_dtype(srcs)
+        res = np.empty(srcs.shape, dtype=dtype)
+        for i in range(srcs.shape[0]):
+            log_src = self.log_lms(srcs[i], out=res[i], dtype=dtype, n_threads=self._n_threads)
+            sample = log_src if self._stats_sample is None else self.log_lms(self.sample_pixels(srcs[i]), dtype=dtype)
+            mean_src, std_src = self.lab_moments(sample)
+            self.lab_transfer(log_src, mean_src, std_ref / std_src, mean_ref, out=log_src, n_threads=self._n_threads)
+
+        return res
+
+    @staticmethod
+    def log_lms(rgb: np.ndarray = None, out: np.ndarray = None, dtype: np.dtype = None,
+                n_threads: int = None) -> np.ndarray:
+        """
+        Convert RGB pixels to natural logarithms of LMS cone responses in chunks where zeros are replaced by the
+        smallest 8-bit intensity (relative to the integer range for integer pixels) for numerical stability.
+
+        :param rgb: Image array with 3 color channels
+        :param out: Optional C-contiguous float array of the image shape to write the result into (may be rgb)
+        :param dtype: Floating point type of the result if out is not provided (defaults to float64)
+        :param n_threads: Number of threads converting row tiles in parallel (None for serial execution)
+
+        :type rgb: :class:`~numpy:numpy.ndarray`
+        :type out: :class:`~numpy:numpy.ndarray`
+        :type dtype: :class:`~numpy:numpy.dtype`
+        :type n_threads: :class:`int`
+
+        :return: **log_lms**: Pixel rows of shape (N, 3)
+        :rtype: np.ndarray
+        """
+
+        rows = rgb.reshape((-1, rgb.shape[-1]))
+        if out is None:
+            out = np.empty(rows.shape, dtype=np.dtype('float64') if dtype is None else dtype)
+        elif out.shape != rgb.shape or not out.flags.c_contiguous or not np.issubdtype(out.dtype, np.floating):
+            raise BaseException('Output array requires a C-contiguous float type of shape %s' % str(rgb.shape))
+        res = out.reshape(rows.shape)
+        scale = np.iinfo(rows.dtype).max if np.issubdtype(rows.dtype, np.integer) else 1
+        mat, eps = LMS_MAT.T.astype(res.dtype), res.dtype.type(scale/(2**8-1))
+
+        def convert_tile(i):
+            chunk = rows[i:i+CHUNK_SIZE]
+            chunk = chunk if chunk.all() else np.where(chunk == 0, eps, chunk)
+            np.matmul(chunk.astype(res.dtype, copy=False), mat, out=res[i:i+CHUNK_SIZE])
+            np.log(res[i:i+CHUNK_SIZE], out=res[i:i+CHUNK_SIZE])
+
+        ReinhardMatcher.run_parallel(convert_tile, range(0, rows.shape[0], CHUNK_SIZE), n_threads)
+
+        return res
+
+    @staticmethod
+    def lab_moments(log_lms: np.ndarray = None, weights: np.ndarray = None) -> tuple:
+        """
+        Compute channel-wise means and standard deviations in Lab space from logarithmic LMS pixels in chunks
+        without keeping converted pixels.
+
+        :param log_lms: Pixel rows of shape (N, 3) as obtained by :meth:`log_lms`
+        :param weights: Optional non-negative weights of the N pixels (e.g. from a boolean mask)
+
+        :type log_lms: :class:`~numpy:numpy.ndarray`
+        :type weights: :class:`~numpy:numpy.ndarray`
+
+        :return: **stats**: tuple of (mean, std) vectors
+        :rtype: tuple
+        """
+
+        n = log_lms.shape[0]
+        dtype = log_lms.dtype if log_lms.dtype in (np.float32, np.float64) else np.dtype('float64')
+        mat = (LAB_MAT.T / LN10).astype(dtype)
 
-        # replace zeros with small value for numerical stability
-        src[src == 0] = 1/(2**8-1)
-        ref[ref == 0] = 1/(2**8-1)
+        # Lab pixels are shifted by the mean of a first chunk for numerical stability (see TransferMVGD.mvgd_stats)
+        shift = np.dot(log_lms[:CHUNK_SIZE].mean(axis=0, dtype=np.float64), mat).astype(dtype)
+        ones = np.ones(min(n, CHUNK_SIZE), dtype=dtype)
+        shifts = np.tile(shift, (ones.size, 1))
+
+        # weights take the place of ones in the sums (weighted moments)
+        s1, s2 = np.zeros(3), np.zeros(3)
+        for i in range(0, n, CHUNK_SIZE):
+            lab = np.matmul(log_lms[i:i+CHUNK_SIZE], mat)
+            lab -= shifts[:lab.shape[0]]
+            w = ones[:lab.shape[0]] if weights is None else weights[i:i+CHUNK_SIZE].astype(dtype)
+            s1 += w @ lab
+            lab *= lab
+            s2 += w @ lab
+
+        n = n if weights is None else weights.sum()
+        var = s2 / n - (s1 / n)**2
+
+        return shift + s1 / n, np.sqrt(np.maximum(var, 0))
+
+    @staticmethod
+    def lab_transfer(log_lms: np.ndarray, mean_src: np.ndarray, std_ratios: np.ndarray, mean_ref: np.ndarray,
+                     out: np.ndarray = None, n_threads: int = None) -> np.ndarray:
+        """
+        Align logarithmic LMS pixels channel-wise in Lab space and convert them back to RGB. The alignment is folded
+        into a single affine map of logarithmic LMS values so that each chunk takes two matrix products and one
+        exponentiation.
+
+        :param log_lms: Pixel rows of shape (N, 3) as obtained by :meth:`log_lms`
+        :param mean_src: Channel means of the source
+        :param std_ratios: Ratios of reference and source standard deviations
+        :param mean_ref: Channel means of the reference
+        :param out: Optional float array of shape (N, 3) to write the result into (may be log_lms)
+        :param n_threads: Number of threads processing row tiles in parallel (None for serial execution)
+
+        :return: **rgb**: RGB pixel rows of shape (N, 3)
+        :rtype: np.ndarray
+        """
+
+        out = np.empty(log_lms.shape, dtype=log_lms.dtype) if out is None else out
+        std_ratios = np.asarray(std_ratios, dtype='float64')
+        mat = (LAB_MAT_INV * std_ratios) @ LAB_MAT
+        offset = LAB_MAT_INV @ (np.asarray(mean_ref) - std_ratios * np.asarray(mean_src)) * LN10
+
+        # offset is applied as factor after exponentiation and thereby folded into the conversion to RGB
+        mat, rgb_mat = mat.T.astype(out.dtype), (np.exp(offset)[:, np.newaxis] * LMS_MAT_INV.T).astype(out.dtype)
+
+        def transfer_tile(i):
+            lms = np.matmul(log_lms[i:i+CHUNK_SIZE], mat)
+            np.exp(lms, out=lms)
+            np.matmul(lms, rgb_mat, out=out[i:i+CHUNK_SIZE])
+
+        ReinhardMatcher.run_parallel(transfer_tile, range(0, log_lms.shape[0], CHUNK_SIZE), n_threads)
+
+        return out
+
+    @staticmethod
+    def rgb2lab(rgb: np.ndarray = None, dtype: np.dtype = None) -> np.ndarray:
+        """
+        Convert an RGB image to the decorrelated logarithmic Lab space of Ruderman et al.
+
+        :param rgb: Image array with 3 color channels
+        :param dtype: Floating point type of the computation (defaults to float64)
+        :type rgb: :class:`~numpy:numpy.ndarray`
+        :type dtype: :class:`~numpy:numpy.dtype`
+
+        :return: **lab**: Lab pixel matrix of shape (3, N)
+        :rtype: np.ndarray
+        """
+
+        # flatten image along spatial dimensions
+        rgb = rgb.reshape((-1, rgb.shape[-1])).transpose()
+
+        # replace zeros with small value (relative to the integer range for integer pixels) for numerical stability
+        dtype = np.dtype('float64') if dtype is None else np.dtype(dtype)
+        scale = np.iinfo(rgb.dtype).max if np.issubdtype(rgb.dtype, np.integer) else 1
+        rgb = np.where(rgb == 0, dtype.type(scale/(2**8-1)), rgb).astype(dtype, copy=False)
 
         # convert to LMS color space
-        lms_src = np.dot(LMS_MAT, src)
-        lms_ref = np.dot(LMS_MAT, ref)
+        lms = np.dot(LMS_MAT.astype(dtype), rgb)
 
         # convert data to logarithmic LMS color space to eliminate skew
-        lms_src = np.log10(lms_src)
-        lms_ref = np.log10(lms_ref)
-
-        # PCA transform matrices according to Rudermann et al.
-        b = np.array([[1/np.sqrt(3), 0, 0], [0, 1/np.sqrt(6), 0], [0, 0, 1/np.sqrt(2)]])
-        c = np.array([[1, 1, 1], [1, 1, -2], [1, -1, 0]])
+        lms = np.log10(lms, out=lms)
 
         # convert to Lab space
-        lab_src = np.dot(np.dot(b, c), lms_src)
-        lab_ref = np.dot(np.dot(b, c), lms_ref)
+        lab = np.dot(LAB_MAT.astype(dtype), lms)
 
-        # compute statistical measures
-        mean_src, std_src = np.mean(lab_src, axis=1), np.std(lab_src, axis=1)
-        mean_ref, std_ref = np.mean(lab_ref, axis=1), np.std(lab_ref, axis=1)
+        return lab
 
-        # compute ratios of standard deviations channel-wise
-        std_ratios = std_ref / std_src
+    @staticmethod
+    def lab2rgb(lab: np.ndarray = None) -> np.ndarray:
+        """
+        Convert a Lab pixel matrix back to RGB space, which is computed in the floating point type of the Lab data.
 
-        # apply statistical alignment channel-wise
-        res_lab = ((lab_src.T - mean_src) * std_ratios + mean_ref).T
+        :param lab: Lab pixel matrix of shape (3, N)
+        :type lab: :class:`~numpy:numpy.ndarray`
+
+        :return: **rgb**: RGB pixel matrix of shape (N, 3)
+        :rtype: np.ndarray
+        """
 
         # convert back to LMS
-        lms_res = np.dot(np.dot(c.T, b), res_lab)
-        lms_res = 10**lms_res
+        lms = np.dot(LAB_MAT_INV.astype(lab.dtype), lab)
+        lms = np.power(lab.dtype.type(10), lms, out=lms)
 
         # convert back to RGB
-        res = np.dot(LMS_MAT_INV, lms_res).transpose()
+        rgb = np.dot(LMS_MAT_INV.astype(lab.dtype), lms).transpose()
 
-        # reshape to 2-D image
-        res = res.reshape((m, n, p))
+        return rgb
 
-        return res
+    @staticmethod
+    def lab_align(lab: np.ndarray, mean_src: np.ndarray, std_ratios: np.ndarray, mean_ref: np.ndarray) -> np.ndarray:
+        """
+        Align Lab pixels channel-wise by shifting the source mean and scaling by ratios of standard deviations.
+
+        :param lab: Lab pixel matrix of shape (3, N)
+        :param mean_src: Channel means of the source
+        :param std_ratios: Ratios of reference and source standard deviations
+        :param mean_ref: Channel means of the reference
+
+        :return: **res_lab**: Lab pixel matrix of shape (3, N)
+        :rtype: np.ndarray
+        """
+
+        mean_src, std_ratios, mean_ref = [np.asarray(arg, dtype=lab.dtype) for arg in (mean_src, std_ratios, mean_ref)]
+
+        return ((lab.T - mean_src) * std_ratios + mean_ref).T
+
+    @staticmethod
+    def lab_stats(img: np.ndarray = None, dtype: np.dtype = None) -> tuple:
+        """
+        Compute the channel-wise mean and standard deviation of an RGB image in Lab space, e.g. to cache reference
+        statistics without transferring any image.
+
+        :param img: Image array with 3 color channels
+        :param dtype: Floating point type of the computation (defaults to float64)
+        :type img: :class:`~numpy:numpy.ndarray`
+        :type dtype: :class:`~numpy:numpy.dtype`
+
+        :return: **stats**: tuple of (mean, std) vectors
+        :rtype: tuple
+        """
+
+        return ReinhardMatcher.lab_moments(ReinhardMatcher.log_lms(img, dtype=dtype))
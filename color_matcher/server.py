@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import getopt
+import hashlib
+import ipaddress
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from color_matcher import __version__, METHODS
+from color_matcher.top_level import ColorMatcher
+from color_matcher.ref_model import ReferenceModel
+from color_matcher.io_handler import load_img_file, save_img_file, decode_img, encode_img
+from color_matcher.benchmark import latency_stats
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+STAGES = ('load', 'fit', 'transfer', 'save', 'total')
+
+
+class ReferenceCache(object):
+
+    def __init__(self, max_mb: float = 512):
+        """
+        Thread-safe least recently used (LRU) cache of fitted reference models keyed by the content hash of the
+        reference file and the method. Models are evicted once their arrays exceed the memory budget.
+
+        :param max_mb: Memory budget of cached model arrays in megabytes
+        """
+
+        self._max_bytes = max_mb * 2**20
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    @staticmethod
+    def model_nbytes(model: ReferenceModel = None) -> int:
+        """ memory occupied by the arrays of a model including its gray scale model """
+
+        nbytes = sum(arr.nbytes for arr in model.arrays())
+
+        return nbytes + ReferenceCache.model_nbytes(model.gray) if model.gray is not None else nbytes
+
+    def get(self, key: tuple = None) -> ReferenceModel:
+        """ return cached model (None if absent) and mark it as most recently used """
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._models.move_to_end(key)
+
+        return model
+
+    def put(self, key: tuple = None, model: ReferenceModel = None) -> ReferenceModel:
+        """ insert model while evicting least recently used ones (including itself if it exceeds the budget) """
+
+        with self._lock:
+            if key in self._models:
+                self.nbytes -= self.model_nbytes(self._models.pop(key))
+            self._models[key] = model
+            self.nbytes += self.model_nbytes(model)
+            while self.nbytes > self._max_bytes and self._models:
+                self.nbytes -= self.model_nbytes(self._models.popitem(last=False)[1])
+                self.evictions += 1
+
+        return model
+
+    def stats(self) -> dict:
+
+        return {'models': len(self), 'mb': self.nbytes / 2**20, 'max_mb': self._max_bytes / 2**20, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class MatchServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host: str = SERVER_HOST, port: int = SERVER_PORT, jobs: int = None, cache_mb: float = 512,
+                 method: str = METHODS[0], window: int = 1000, roots: list = None):
+        """
+        Long-running HTTP server matching source images against references whose fitted statistics are kept in a
+        :class:`ReferenceCache`. Requests are accepted concurrently whereas matching runs on a pool of worker threads
+        (numpy releases the GIL in the underlying array operations) sharing the cache. Files of path-based requests
+        are read and written with the permissions of the server, which is why paths are confined to root directories
+        (if provided) and are otherwise only accepted by servers bound to a loopback address.
+
+        :param host: Host address to bind to (localhost by default)
+        :param port: Port number (0 picks a free port)
+        :param jobs: Number of worker threads (defaults to the number of CPUs)
+        :param cache_mb: Memory budget of the reference cache in megabytes
+        :param method: Method out of METHODS for requests which do not specify one
+        :param window: Number of most recent requests latency percentiles are computed from
+        :param roots: Directories files of path-based requests are confined to (None for any path on loopback only)
+        """
+
+        if method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+
+        super(MatchServer, self).__init__((host, port), MatchHandler)
+
+        self.method = method
+        self.roots = [os.path.realpath(root) for root in roots] if roots else []
+        self.cache = ReferenceCache(cache_mb)
+        self.pool = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+        self.started = time.time()
+
+        self._lock = threading.Lock()
+        self._counts = {'requests': 0, 'errors': 0}
+        self._times = {stage: deque(maxlen=window) for stage in STAGES}
+
+    def server_close(self):
+
+        super(MatchServer, self).server_close()
+        self.pool.shutdown(wait=True)
+
+    @property
+    def loopback(self) -> bool:
+        """ whether the server is bound to a loopback address and thus only reachable from the local machine """
+
+        try:
+            return ipaddress.ip_address(self.server_address[0]).is_loopback
+        except ValueError:
+            return False
+
+    def resolve_path(self, path: str = None) -> str:
+        """
+        Resolve the path of a file a client requests to read or write, which has to lie within one of the root
+        directories (if provided). Without roots, path-based requests are refused unless bound to a loopback address.
+
+        :param path: File path sent by a client
+
+        :return: **path**: Absolute path with symbolic links resolved
+        :rtype: str
+        """
+
+        if not isinstance(path, str):
+            raise TypeError('File path must be a string')
+
+        real_path = os.path.realpath(path)
+        if self.roots:
+            if not any(os.path.commonpath([real_path, root]) == root for root in self.roots):
+                raise PermissionError('Path %s is outside of the served root directories' % path)
+        elif not self.loopback:
+            raise PermissionError('Path-based requests require root directories on non-loopback addresses')
+
+        return real_path
+
+    def reference(self, data: bytes = None, path: str = None, method: str = None, times: dict = None) -> tuple:
+        """
+        Return the content hash of a reference passed as file contents or path together with its fitted model,
+        which is only computed if not cached.
+
+        :param data: Contents of an image file
+        :param path: Path to an image file (if data is not provided)
+        :param method: Method out of METHODS
+        :param times: Dictionary stage latencies are added to
+
+        :return: **ref_id**, **model**: Content hash and reference model
+        :rtype: tuple
+        """
+
+        if data is None:
+            with open(self.resolve_path(path), 'rb') as f:
+                data = f.read()
+        ref_id = hashlib.sha1(data).hexdigest()
+
+        model = self.cache.get((ref_id, method))
+        if model is None:
+            start = time.perf_counter()
+            ref = decode_img(data)
+            times['load'] = times.get('load', 0) + time.perf_counter() - start
+            start = time.perf_counter()
+            model = self.cache.put((ref_id, method), ColorMatcher().fit(ref, method=method))
+            times['fit'] = time.perf_counter() - start
+
+        return ref_id, model
+
+    def match(self, src, model: ReferenceModel = None, method: str = None, times: dict = None):
+        """ transfer colors of a decoded source image from a reference model """
+
+        start = time.perf_counter()
+        res = ColorMatcher(method=method).transfer(src=src, ref=model)
+        times['transfer'] = time.perf_counter() - start
+
+        return res
+
+    def record(self, times: dict = None, error: bool = False):
+        """ add request latencies to the metrics """
+
+        with self._lock:
+            self._counts['requests'] += 1
+            self._counts['errors'] += int(error)
+            if not error:
+                for stage in STAGES:
+                    self._times[stage].append(times.get(stage, 0))
+
+    def metrics(self) -> dict:
+
+        with self._lock:
+            latency = {stage: latency_stats(vals) for stage, vals in self._times.items() if vals}
+            counts = dict(self._counts)
+
+        return dict(counts, uptime_s=time.time() - self.started, latency_s=latency, cache=self.cache.stats(),
+                    version=__version__)
+
+
+class MatchHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the :class:`MatchServer` where
+
+    - ``POST /reference?method=<method>`` fits a reference from image file contents or a JSON body {"path": ...}
+    - ``POST /match?ref_id=<id>&method=<method>&type=<ext>`` returns the file contents of the matched image body
+    - ``POST /match`` with a JSON body {"src": ..., "ref": ... or "ref_id": ..., "out": ..., "method": ...} writes
+      the matched source file to the out path (defaults to that of the CLI) where paths are confined to the roots
+    - ``GET /metrics`` reports request counts, latency percentiles per stage and cache statistics
+    """
+
+    server_version = 'color-matcher/' + __version__
+
+    def do_GET(self):
+
+        if urlparse(self.path).path == '/metrics':
+            self.reply(200, self.server.metrics())
+        else:
+            self.reply(404, {'error': 'Unknown route %s' % self.path})
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+        query = {key: vals[-1] for key, vals in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        args = json.loads(body) if self.headers.get('Content-Type', '').startswith('application/json') else None
+        query.update(args or {})
+        method = query.get('method', self.server.method).lower()
+
+        times, start = dict(), time.perf_counter()
+        try:
+            if method not in METHODS:
+                raise ValueError('Method type \'%s\' not recognized' % method)
+            if url.path == '/reference':
+                future = self.server.pool.submit(self.server.reference, None if args else body, query.get('path'),
+                                                 method, times)
+                ref_id, _ = future.result()
+                res = {'ref_id': ref_id, 'method': method, 'cache': 'miss' if 'fit' in times else 'hit'}
+            elif url.path == '/match':
+                res = self.server.pool.submit(self.match_request, None if args else body, query, method,
+                                              times).result()
+            else:
+                self.reply(404, {'error': 'Unknown route %s' % self.path})
+                return
+        except (KeyError, ValueError, TypeError, OSError) as e:
+            self.server.record(error=True)
+            code = 404 if isinstance(e, KeyError) else 403 if isinstance(e, PermissionError) else 400
+            self.reply(code, {'error': str(e.args[0] if e.args else e)})
+            return
+        except Exception as e:
+            self.server.record(error=True)
+            self.reply(500, {'error': str(e)})
+            return
+
+        times['total'] = time.perf_counter() - start
+        self.server.record(times)
+        if isinstance(res, bytes):
+            self.reply(200, res, content_type='image/' + query.get('type', 'png'),
+                       headers={'X-Latency': json.dumps(times)})
+        else:
+            self.reply(200, dict(res, latency_s=times))
+
+    def match_request(self, data: bytes = None, query: dict = None, method: str = None, times: dict = None):
+        """ match source from file contents (returning contents) or from a path (returning the output path) """
+
+        server = self.server
+        if 'ref' in query:
+            ref_id, model = server.reference(path=query['ref'], method=method, times=times)
+        else:
+            ref_id, model = query.get('ref_id'), server.cache.get((query.get('ref_id'), method))
+            if model is None:
+                raise KeyError('Reference %s not fitted for method \'%s\', register it first' % (ref_id, method))
+
+        start = time.perf_counter()
+        src = decode_img(data) if data is not None else load_img_file(server.resolve_path(query['src']))
+        times['load'] = times.get('load', 0) + time.perf_counter() - start
+
+        res = server.match(src, model, method, times)
+
+        start = time.perf_counter()
+        if data is not None:
+            res = encode_img(res, query.get('type', 'png'))
+        else:
+            file_path = server.resolve_path(query.get('out', os.path.splitext(query['src'])[0] + '_' + method))
+            file_type = os.path.splitext(file_path)[-1][1:] or os.path.splitext(query['src'])[-1][1:]
+            save_img_file(res, file_path=file_path, file_type=file_type)
+            res = {'out': os.path.splitext(file_path)[0] + '.' + file_type, 'ref_id': ref_id, 'method': method}
+        times['save'] = time.perf_counter() - start
+
+        return res
+
+    def reply(self, code: int = 200, body=None, content_type: str = 'application/json', headers: dict = None):
+
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, jobs: int = None, cache_mb: float = 512,
+          method: str = METHODS[0], roots: list = None):
+    """ run a :class:`MatchServer` until interrupted """
+
+    server = MatchServer(host, port, jobs, cache_mb, method, roots=roots)
+    print('color-matcher v%s serving on http://%s:%s' % (__version__, *server.server_address[:2]))
+    if not server.loopback:
+        print('Warning: server is reachable beyond this machine and %s' % (
+              'any client may read and write image files in ' + ', '.join(server.roots) if server.roots else
+              'refuses path-based requests unless root directories are given by --root'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return True
+
+
+def usage():
+
+    print("Usage: color-matcher serve <options>\n")
+    print("Options:")
+    print("--host=<address>               Host address to bind to (default %s)" % SERVER_HOST)
+    print("                               Non-loopback addresses expose the server to other machines where files of")
+    print("                               path-based requests can only be accessed within --root directories")
+    print("-r <dir>,    --root=<dir>      Directory files of path-based requests are confined to (repeatable)")
+    print("-p <num>,    --port=<num>      Port number (default %s)" % SERVER_PORT)
+    print("-j <num>,    --jobs=<num>      Number of worker threads (default number of CPUs)")
+    print("-c <MB>,     --cache=<MB>      Memory budget of the reference cache in megabytes (default 512)")
+    print("-m <method>, --method=<method> Default method out of:")
+    print("                               "+', '.join(['"'+m+'"' for m in METHODS]))
+    print("-h,          --help            Print this help message")
+    print("")
+
+
+def main(argv: list = None):
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, "hp:j:c:m:r:",
+                                   ["help", "host=", "port=", "jobs=", "cache=", "method=", "root="])
+    except getopt.GetoptError as e:
+        print(e)
+        sys.exit(2)
+
+    cfg = {'host': SERVER_HOST, 'port': SERVER_PORT, 'jobs': None, 'cache_mb': 512, 'method': METHODS[0],
+           'roots': []}
+
+    try:
+        for (opt, arg) in opts:
+            arg = arg.strip(" \"\'")
+            if opt in ("-h", "--help"):
+                usage()
+                sys.exit()
+            if opt == "--host":
+                cfg['host'] = arg
+            if opt in ("-p", "--port"):
+                cfg['port'] = int(arg)
+            if opt in ("-j", "--jobs"):
+                cfg['jobs'] = max(int(arg), 1)
+            if opt in ("-c", "--cache"):
+                cfg['cache_mb'] = float(arg)
+            if opt in ("-m", "--method"):
+                cfg['method'] = arg.lower() if arg.lower() in METHODS else METHODS[0]
+            if opt in ("-r", "--root"):
+                cfg['roots'].append(arg)
+    except ValueError:
+        print('Numeric option could not be parsed\n')
+        usage()
+        sys.exit(2)
+
+    return serve(**cfg)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from color_matcher.ref_model import ReferenceModel, MODEL_VERSION
+
+CACHE_DIR = os.environ.get('COLOR_MATCHER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'color-matcher'))
+CACHE_EXT = 'npz'
+
+
+class StatsCache(object):
+
+    def __init__(self, cache_dir: str = None, max_mb: float = 1024):
+        """
+        On-disk cache of fitted reference statistics (:class:`ReferenceModel`) shared across runs and processes.
+        Entries are keyed by a hash of the reference pixels, the method and the options affecting the statistics,
+        and the least recently used entries are deleted once the files exceed the size cap.
+
+        :param cache_dir: Cache directory (defaults to the COLOR_MATCHER_CACHE variable or ~/.cache/color-matcher)
+        :param max_mb: Size cap of all cache files in megabytes
+        """
+
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        self._max_bytes = max_mb * 2**20
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(ref: np.ndarray = None, method: str = None, options: dict = None) -> str:
+        """
+        Hash of reference pixels (including shape and type) together with the method and statistics options.
+
+        :param ref: Reference image
+        :param method: Method the statistics are fitted for (None for all methods)
+        :param options: Options of the matcher affecting the statistics (e.g. stats_sample or dtype)
+
+        :return: **key**: Hexadecimal digest
+        :rtype: str
+        """
+
+        ref = np.ascontiguousarray(ref)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((MODEL_VERSION, ref.shape, str(ref.dtype), method, sorted((options or {}).items())))
+                      .encode())
+        digest.update(ref.data)
+
+        return digest.hexdigest()
+
+    def file_path(self, key: str = None) -> str:
+        return os.path.join(self.cache_dir, key + '.' + CACHE_EXT)
+
+    def get(self, key: str = None) -> ReferenceModel:
+        """ load cached model (None if absent or unreadable) and mark it as most recently used """
+
+        file_path = self.file_path(key)
+        try:
+            with np.load(file_path, allow_pickle=False) as data:
+                model = ReferenceModel.from_dict(dict(data))
+            os.utime(file_path)
+        except Exception:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return model
+
+    def put(self, key: str = None, model: ReferenceModel = None) -> ReferenceModel:
+        """ write model to the cache and evict least recently used entries exceeding the size cap """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write to a temporary file first so that concurrent readers never see partial entries
+        tmp_path = self.file_path(key) + '.%s.%s.tmp' % (os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **model.to_dict())
+        os.replace(tmp_path, self.file_path(key))
+        self.evict()
+
+        return model
+
+    def evict(self) -> int:
+        """ delete least recently used entries until the cache files fit into the size cap and return their number """
+
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.' + CACHE_EXT)]
+        entries = sorted(entries, key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+        num, total = 0, 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total > self._max_bytes:
+                try:
+                    os.remove(entry.path)
+                    num += 1
+                except OSError:
+                    pass
+
+        return num
+
+    def clear(self):
+        """ delete all cache entries """
+
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.' + CACHE_EXT):
+                    os.remove(entry.path)
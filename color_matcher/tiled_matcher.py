@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from color_matcher.top_level import ColorMatcher, METHODS
+from color_matcher.hist_matcher import HistogramMatcher
+from color_matcher.mvgd_matcher import TransferMVGD
+from color_matcher.reinhard_matcher import ReinhardMatcher
+from color_matcher.ref_model import ReferenceModel
+from color_matcher.color_transform import ColorTransform
+
+
+class TiledMatcher(object):
+
+    def __init__(self, method: str = 'default', tile_rows: int = 256, bins: int = 2**12):
+        """
+        Color matching of images larger than memory, which are read and written in tiles of rows (e.g. from and to
+        :class:`~numpy:numpy.memmap` arrays). Statistics are accumulated over tiles in streaming passes for each stage
+        of a method before the fitted transform is applied tile by tile. Peak memory is thus bounded by the tile size.
+
+        Integer images are scaled to [0, 1] by their type range. Histograms of integer images are exact, whereas
+        histograms of float data (e.g. the output of a previous stage) are counted in a fixed number of bins.
+
+        :param method: Method out of METHODS
+        :param tile_rows: Number of image rows per tile
+        :param bins: Number of histogram bins for float data
+        """
+
+        self._method = method.lower()
+        if self._method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+
+        self._tile_rows = tile_rows
+        self._bins = bins
+        self.transform = None
+
+    def tiles(self, img, transform: ColorTransform = None):
+        """ yield row slices with normalized tiles of an image after an optional transform """
+
+        transform = transform if transform is not None and transform.stages else None
+        for y in range(0, img.shape[0], self._tile_rows):
+            rows = slice(y, min(y + self._tile_rows, img.shape[0]))
+            tile = self.norm_tile(img[rows])
+            yield rows, tile if transform is None else transform.apply(tile)
+
+    @staticmethod
+    def norm_tile(tile) -> np.ndarray:
+        """ convert tile to float in [0, 1] while adding channel axis and dropping alpha channel """
+
+        tile = np.asarray(tile)
+        tile = tile[..., np.newaxis] if len(tile.shape) == 2 else tile
+        tile = tile[..., :3] if tile.shape[-1] == 4 else tile
+        if np.issubdtype(tile.dtype, np.integer):
+            tile = tile / float(np.iinfo(tile.dtype).max)
+
+        return np.asarray(tile, dtype='float64')
+
+    def moments(self, img, transform: ColorTransform = None, lab: bool = False) -> tuple:
+        """ accumulate pixel count, sum and cross-products of an image in RGB or Lab space """
+
+        n, s1, s2 = 0, 0, 0
+        for _, tile in self.tiles(img, transform):
+            mat = ReinhardMatcher.rgb2lab(tile).T if lab else tile.reshape(-1, tile.shape[-1])
+            n += mat.shape[0]
+            s1 = s1 + mat.sum(axis=0)
+            s2 = s2 + mat.T @ mat
+
+        return n, s1, s2
+
+    def cross_moment(self, src, ref, transform: ColorTransform = None) -> np.ndarray:
+        """ accumulate cross-products of pixel pairs from reference and (transformed) source """
+
+        if src.shape[:2] != ref.shape[:2]:
+            raise Exception('Analytical MVGD solution requires spatial dimensions of both images to be equal')
+
+        s_zr = 0
+        for (_, tile_r), (_, tile_z) in zip(self.tiles(src, transform), self.tiles(ref)):
+            s_zr = s_zr + tile_z.reshape(-1, tile_z.shape[-1]).T @ tile_r.reshape(-1, tile_r.shape[-1])
+
+        return s_zr
+
+    def hist(self, img, transform: ColorTransform = None) -> tuple:
+        """ accumulate channel-wise histograms and return (values, cdf) pairs as used for histogram matching """
+
+        # exact counts for untransformed integer images
+        transformed = transform is not None and bool(transform.stages)
+        if not transformed and np.issubdtype(img.dtype, np.integer) and img.dtype.itemsize <= 2:
+            cnts, offset = 0, 0
+            for y in range(0, img.shape[0], self._tile_rows):
+                tile = np.asarray(img[y:y + self._tile_rows])
+                tile = tile[..., np.newaxis] if len(tile.shape) == 2 else tile
+                tile = tile[..., :3] if tile.shape[-1] == 4 else tile
+                bincounts = [HistogramMatcher.int_bincount(tile[..., ch].ravel()) for ch in range(tile.shape[-1])]
+                cnts = cnts + np.stack([bincount[0] for bincount in bincounts])
+                offset = bincounts[0][2]
+            scale = float(np.iinfo(img.dtype).max)
+            return tuple(((np.flatnonzero(c) + offset) / scale, np.cumsum(c[c > 0]) / c.sum()) for c in cnts)
+
+        # range of (transformed) float data
+        lo, hi = np.inf, -np.inf
+        for _, tile in self.tiles(img, transform):
+            lo = np.minimum(lo, tile.min(axis=(0, 1)))
+            hi = np.maximum(hi, tile.max(axis=(0, 1)))
+
+        # counts in fixed bins
+        edges = [np.linspace(lo[ch], hi[ch] if hi[ch] > lo[ch] else lo[ch]+1, self._bins + 1) for ch in range(len(lo))]
+        cnts = 0
+        for _, tile in self.tiles(img, transform):
+            cnts = cnts + np.stack([np.histogram(tile[..., ch], bins=edges[ch])[0] for ch in range(len(lo))])
+
+        return tuple((edges[ch], np.concatenate([[0], np.cumsum(c)]) / c.sum()) for ch, c in enumerate(cnts))
+
+    def fit(self, ref) -> ReferenceModel:
+        """
+        Accumulate reference statistics required by the method in streaming passes over tiles.
+
+        :param ref: Reference image array (e.g. :class:`~numpy:numpy.memmap`) of shape (H, W, C)
+
+        :return: **model**: Reference model
+        :rtype: ReferenceModel
+        """
+
+        ch_num = min(ref.shape[2], 3) if len(ref.shape) == 3 else 1
+        names = self.stage_names() if ch_num > 1 else ['hist_match']
+
+        hist = self.hist(ref) if 'hist_match' in names else None
+        mu, cov, lab = None, None, None
+        if 'multivar_transfer' in names:
+            n, s1, s2 = self.moments(ref)
+            mu = (s1 / n)[:, np.newaxis]
+            cov = (s2 - n * mu @ mu.T) / (n - 1)
+        if 'reinhard' in names:
+            n, s1, s2 = self.moments(ref, lab=True)
+            mean = s1 / n
+            lab = mean, np.sqrt(np.maximum(np.diagonal(s2) / n - mean**2, 0))
+
+        return ReferenceModel(method=self._method, shape=tuple(ref.shape[:2]) + (ch_num,), hist=hist, lab=lab,
+                              mu=mu, cov=cov)
+
+    def stage_names(self) -> list:
+        """ names of matching functions applied by the method """
+
+        return [fun.__name__ for fun in ColorMatcher().select_funs(self._method)]
+
+    def fit_transform(self, src, ref) -> ColorTransform:
+        """
+        Fit color transform stage by stage, where statistics of each stage are gathered from the source after
+        application of all previous stages.
+
+        :param src: Source image array (e.g. :class:`~numpy:numpy.memmap`) of shape (H, W, C)
+        :param ref: Reference image array or fitted :class:`ReferenceModel`
+
+        :return: **transform**: Fitted color transform
+        :rtype: ColorTransform
+        """
+
+        model = ref if isinstance(ref, ReferenceModel) else self.fit(ref)
+        ch_num = min(src.shape[2], 3) if len(src.shape) == 3 else 1
+        if ch_num != model.shape[2]:
+            raise BaseException('Tiled processing requires equal color channel numbers')
+
+        # restrict monochromatic transfer to histogram matching
+        names = self.stage_names() if ch_num > 1 else ['hist_match']
+
+        transform = ColorTransform(channels=ch_num, method=self._method)
+        for name in names:
+            if name == 'hist_match':
+                model.require('hist')
+                luts = tuple((vals, np.interp(cdf, ref_cdf, ref_vals))
+                             for (vals, cdf), (ref_vals, ref_cdf) in zip(self.hist(src, transform), model.hist))
+                params = {'luts': luts}
+            elif name == 'multivar_transfer':
+                model.require('mu', 'cov')
+                n, s1, s2 = self.moments(src, transform)
+                mu_r = (s1 / n)[:, np.newaxis]
+                cov_r = (s2 - n * mu_r @ mu_r.T) / (n - 1)
+                if self._method.__contains__('mvgd'):
+                    # analytical solution from the cross-covariance of pixel pairs
+                    cov_zr = (self.cross_moment(src, ref, transform) - n * model.mu @ mu_r.T) / (n - 1)
+                    transfer_mat = cov_zr @ np.linalg.pinv(cov_r)
+                else:
+                    transfer_mat = TransferMVGD.mkl_mat(cov_r, model.cov)
+                params = {'transfer_mat': transfer_mat, 'mu_r': mu_r, 'mu_z': model.mu}
+            else:
+                model.require('lab')
+                n, s1, s2 = self.moments(src, transform, lab=True)
+                mean_src = s1 / n
+                std_src = np.sqrt(np.maximum(np.diagonal(s2) / n - mean_src**2, 0))
+                params = {'mean_src': mean_src, 'std_ratios': model.lab[1] / std_src, 'mean_ref': model.lab[0]}
+            transform.stages.append((name, params))
+
+        self.transform = transform
+
+        return transform
+
+    def transfer(self, src, ref, out=None):
+        """
+        Fit the transform in streaming passes and apply it tile by tile.
+
+        :param src: Source image array (e.g. :class:`~numpy:numpy.memmap`) of shape (H, W, C)
+        :param ref: Reference image array or fitted :class:`ReferenceModel`
+        :param out: Output array (e.g. :class:`~numpy:numpy.memmap`) where integer types are scaled by their range
+
+        :return: **out**: Resulting image array
+        :rtype: np.ndarray
+        """
+
+        transform = self.fit_transform(src, ref)
+
+        out = np.zeros(src.shape[:2] + (transform.channels,)) if out is None else out
+        for rows, tile in self.tiles(src, transform):
+            if np.issubdtype(out.dtype, np.integer):
+                tile = np.round(np.clip(tile, 0, 1) * np.iinfo(out.dtype).max)
+            out[rows] = tile.reshape(out[rows].shape).astype(out.dtype)
+
+        if isinstance(out, np.memmap):
+            out.flush()
+
+        return out
@@ -22,10 +22,12 @@ __license__ = """
 
 from color_matcher.hist_matcher import HistogramMatcher
 from color_matcher.mvgd_matcher import TransferMVGD
-from color_matcher.reinhard_matcher import ReinhardMatcher
+from color_matcher.reinhard_matcher import ReinhardMatcher, LAB_MAT, LN10
+from color_matcher.ref_model import ReferenceModel
+from color_matcher.color_transform import ColorTransform, STAGE_PARAMS
+from color_matcher import METHODS
 import numpy as np
-
-METHODS = ('default', 'hm', 'reinhard', 'mvgd', 'mkl', 'hm-mvgd-hm', 'hm-mkl-hm')
+import warnings
 
 
 class ColorMatcher(HistogramMatcher, ReinhardMatcher, TransferMVGD):
@@ -35,6 +37,7 @@ class ColorMatcher(HistogramMatcher, ReinhardMatcher, TransferMVGD):
 
         self._method = kwargs['method'] if 'method' in kwargs else 'default'
         self._funs = []
+        self._stages = []
 
     def main(self) -> np.ndarray:
         """
@@ -48,18 +51,21 @@ class ColorMatcher(HistogramMatcher, ReinhardMatcher, TransferMVGD):
 
         return self._src
 
-    def transfer(self, src: np.ndarray = None, ref: np.ndarray = None, method: str = None) -> np.ndarray:
+    def transfer(self, src: np.ndarray = None, ref: np.ndarray = None, method: str = None,
+                 out: np.ndarray = None) -> np.ndarray:
         """
 
         Transfer function to map colors based on provided transfer method.
 
         :param src: Source image that requires transfer
-        :param ref: Palette image which serves as reference
+        :param ref: Palette image or fitted :class:`ReferenceModel` which serves as reference
         :param method: ('default', 'hm', 'reinhard', 'mvgd', 'mkl', 'hm-mvgd-hm', 'hm-mkl-hm') determining color mapping
+        :param out: Optional C-contiguous float array of the result shape to write into (may be the source itself)
 
         :type src: :class:`~numpy:numpy.ndarray`
         :type ref: :class:`~numpy:numpy.ndarray`
         :type method: :class:`str`
+        :type out: :class:`~numpy:numpy.ndarray`
 
         :return: Resulting image after color mapping
         :rtype: np.ndarray
@@ -71,19 +77,12 @@ class ColorMatcher(HistogramMatcher, ReinhardMatcher, TransferMVGD):
         self._src = src if src is not None else self._src
         self._ref = ref if ref is not None else self._ref
 
+        # reference statistics are fitted or loaded from the cache once
+        if self._stats_cache is not None and not isinstance(self._ref, ReferenceModel):
+            self._ref = self.fit(self._ref, method=self._method)
+
         # color transfer methods (to be iterated through)
-        if self._method == METHODS[0]:
-            self._funs = [self.multivar_transfer]
-        elif self._method == METHODS[1]:
-            self._funs = [self.hist_match]
-        elif self._method == METHODS[2]:
-            self._funs = [self.reinhard]
-        elif self._method in METHODS[3:5]:
-            self._funs = [self.multivar_transfer]
-        elif self._method in METHODS[5:]:
-            self._funs = [self.hist_match, self.multivar_transfer, self.hist_match]
-        else:
-            raise BaseException('Method type \'%s\' not recognized' % method)
+        self._funs = self.select_funs(self._method)
 
         # check if three color channels are provided
         self.validate_img_dims()
@@ -91,8 +90,416 @@ class ColorMatcher(HistogramMatcher, ReinhardMatcher, TransferMVGD):
         # check provided color channels
         self.validate_color_chs()
 
-        # proceed with the color match
-        for fun in self._funs:
-            self._src = fun(self._src, self._ref)
+        # fit on reduced-resolution proxies and apply the transform at full resolution
+        if self._proxy_size is not None and int(np.prod(self._src.shape[:2])) > int(self._proxy_size):
+            return self.proxy_transfer(out)
+
+        # keep source for pixels outside of the region the transfer is applied to
+        src = self._src
+        if self._apply_mask is not None and out is not None and np.shares_memory(out, src):
+            raise BaseException('Output array must not share memory with the source when applying a mask')
+
+        # proceed with the color match while keeping parameters of each stage
+        self._stages = []
+        if self._method in METHODS[5:] and len(self._funs) == 3:
+            self._src = self.fused_transfer(out)
+        else:
+            for fun in self._funs:
+                if out is not None and fun.__name__ in ('multivar_transfer', 'reinhard'):
+                    # apply transfer directly into the output buffer
+                    self._src = fun(self._src, self._ref, out=out)
+                else:
+                    self._src = fun(self._src, self._ref)
+                self._stages.append(self.stage_params(fun.__name__))
+
+        if self._apply_mask is not None:
+            self._src = self.blend_mask(self._src, src, self._apply_mask)
+
+        if out is not None and self._src is not out:
+            out[...] = self._src.reshape(out.shape)
+            self._src = out
 
         return self._src
+
+    def fused_transfer(self, out: np.ndarray = None) -> np.ndarray:
+        """
+
+        Fused execution of the hm-mvgd-hm and hm-mkl-hm methods. Reference statistics are computed once and shared by
+        both histogram matching stages. The first stage writes into the result array, from which the MVGD source
+        moments are computed and which the subsequent stages overwrite in-place.
+
+        :param out: Optional C-contiguous float array of the source shape to write the result into
+
+        :type out: :class:`~numpy:numpy.ndarray`
+
+        :return: Resulting image after color mapping
+        :rtype: np.ndarray
+
+        """
+
+        # reference statistics shared across stages
+        model = self._ref
+        if not isinstance(model, ReferenceModel):
+            z, sample = self._ref.reshape([-1, self._ref.shape[2]]).T, self.sample_pixels(self._ref)
+            mu, cov = self.mvgd_stats(sample.T, self.pixel_weights(self._ref_mask, self._ref, sample=True))
+            self.stats_err.update(self.sample_err(sample, z.shape[1], 'z'))
+            hist = self.hist_stats(self._ref, self._hist_bins, self.pixel_weights(self._ref_mask, self._ref))
+            model = ReferenceModel(method=self._method, shape=self._ref.shape, hist=hist, mu=mu, cov=cov,
+                                   z=z if self._fun_name == 'mvgd' else None)
+
+        # float result array (also for integer sources to keep precision of intermediate stages)
+        res = np.empty(self._src.shape, dtype=self.compute_dtype()) if out is None else out
+
+        # first histogram matching into result array
+        res = self.hist_match(self._src, model, out=res)
+        self._stages.append(self.stage_params('hist_match'))
+
+        # MVGD transfer based on moments of the first stage output
+        res = self.multivar_transfer(res, model, out=res)
+        self._stages.append(self.stage_params('multivar_transfer'))
+
+        # second histogram matching with the same reference histograms
+        res = self.hist_match(res, model, out=res)
+        self._stages.append(self.stage_params('hist_match'))
+
+        return res
+
+    def proxy_transfer(self, out: np.ndarray = None) -> np.ndarray:
+        """
+
+        Fit the method on area-averaged proxies of source and reference with at most proxy_size pixels and apply the
+        fitted transform to the full-resolution source. Histogram matching thereby applies the mapping function of the
+        proxies by interpolation instead of ranking all source pixels. Masks are reduced to weights of the proxies.
+
+        :param out: Optional C-contiguous float array of the result shape to write into
+
+        :type out: :class:`~numpy:numpy.ndarray`
+
+        :return: Resulting image after color mapping
+        :rtype: np.ndarray
+
+        """
+
+        src, ref, size = self._src, self._ref, int(self._proxy_size)
+        masks = self._src_mask, self._ref_mask, self._apply_mask
+        dtype = self.compute_dtype(src)
+
+        # proxies share the reduction factor of equally sized images as required by the analytical MVGD solver
+        src_proxy = self.area_proxy(src, size, dtype)
+        ref_proxy = ref if isinstance(ref, ReferenceModel) else self.area_proxy(ref, size, dtype)
+        self._src_mask = None if masks[0] is None else self.area_proxy(np.reshape(masks[0], src.shape[:2]), size)
+        self._ref_mask = None if masks[1] is None or isinstance(ref, ReferenceModel) else \
+            self.area_proxy(np.reshape(masks[1], ref.shape[:2]), size)
+        self._proxy_size, self._apply_mask = None, None
+        try:
+            res_dtype = self.transfer(src_proxy, ref_proxy, self._method).dtype
+        finally:
+            self._proxy_size = size
+            self._src_mask, self._ref_mask, self._apply_mask = masks
+
+        # result in the type of the proxy transfer (e.g. integer for histogram matching of integer images)
+        res = self.get_transform().apply(src, dtype)
+        if np.issubdtype(res_dtype, np.integer) and res.dtype != res_dtype:
+            info = np.iinfo(res_dtype)
+            res = np.clip(res, info.min, info.max).astype(res_dtype)
+        if self._apply_mask is not None:
+            res = self.blend_mask(res, src, self._apply_mask)
+        if out is not None:
+            out[...] = res.reshape(out.shape)
+            res = out
+        self._src = res
+
+        return res
+
+    @staticmethod
+    def blend_mask(res: np.ndarray = None, src: np.ndarray = None, mask: np.ndarray = None) -> np.ndarray:
+        """
+        Restrict a transfer result to a region in-place, where source pixels are restored outside of a boolean mask or
+        blended with the result by weights in [0, 1].
+
+        :param res: Result of the transfer which is overwritten
+        :param src: Source image of equal shape
+        :param mask: Boolean or weight mask of shape (H, W)
+
+        :type res: :class:`~numpy:numpy.ndarray`
+        :type src: :class:`~numpy:numpy.ndarray`
+        :type mask: :class:`~numpy:numpy.ndarray`
+
+        :return: **res**
+        :rtype: np.ndarray
+        """
+
+        mask = np.asarray(mask)
+        if mask.size != int(np.prod(res.shape[:2])):
+            raise BaseException('Mask of shape %s does not match image of shape %s' % (mask.shape, res.shape))
+        mask = mask.reshape(tuple(res.shape[:2]) + (1,))
+
+        if mask.dtype == bool:
+            np.copyto(res, src, where=~mask, casting='unsafe')
+        elif np.issubdtype(res.dtype, np.integer):
+            np.copyto(res, np.rint(src + mask * (res - src.astype(np.float64))), casting='unsafe')
+        else:
+            # blending in-place of the result as res = src + mask * (res - src)
+            np.subtract(res, src, out=res, casting='unsafe')
+            res *= mask.astype(res.dtype)
+            np.add(res, src, out=res, casting='unsafe')
+
+        return res
+
+    def select_funs(self, method: str = None, batch: bool = False) -> list:
+        """
+        Select the sequence of matching functions for a given method and set the solver for the transfer matrix.
+
+        :param method: Method out of METHODS
+        :param batch: Whether functions for stacked images are selected
+
+        :type method: :class:`str`
+        :type batch: :class:`bool`
+
+        :return: **funs**: list of matching functions
+        :rtype: list
+        """
+
+        # select solver for the transfer matrix according to method
+        self._fun_name = 'mvgd' if method.__contains__('mvgd') else 'mkl'
+        self._fun_call = self._fun_dict[self._fun_name]
+
+        hist_match = self.hist_match_batch if batch else self.hist_match
+        multivar_transfer = self.multivar_transfer_batch if batch else self.multivar_transfer
+        reinhard = self.reinhard_batch if batch else self.reinhard
+
+        if method == METHODS[0]:
+            funs = [multivar_transfer]
+        elif method == METHODS[1]:
+            funs = [hist_match]
+        elif method == METHODS[2]:
+            funs = [reinhard]
+        elif method in METHODS[3:5]:
+            funs = [multivar_transfer]
+        elif method in METHODS[5:]:
+            funs = [hist_match, multivar_transfer, hist_match]
+        else:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+
+        return funs
+
+    def transfer_batch(self, srcs: np.ndarray = None, ref: np.ndarray = None, method: str = None) -> np.ndarray:
+        """
+
+        Transfer function to map colors of many equally sized source images (e.g., video frames) at once.
+
+        :param srcs: Stacked source images of shape (B, H, W, C), (B, H, W) for gray scale or a list of images
+        :param ref: Palette image or fitted :class:`ReferenceModel` which serves as reference
+        :param method: ('default', 'hm', 'reinhard', 'mvgd', 'mkl', 'hm-mvgd-hm', 'hm-mkl-hm') determining color mapping
+
+        :type srcs: :class:`~numpy:numpy.ndarray`
+        :type ref: :class:`~numpy:numpy.ndarray`
+        :type method: :class:`str`
+
+        :return: Resulting images after color mapping of shape (B, H, W, C)
+        :rtype: np.ndarray
+
+        """
+
+        self._method = self._method.lower() if method is None else method.lower()
+        ref = ref if ref is not None else self._ref
+
+        # stack list of frames and add channel dimension for gray scale frames
+        srcs = np.stack(srcs) if isinstance(srcs, (list, tuple)) else np.asarray(srcs)
+        srcs = srcs[..., np.newaxis] if len(srcs.shape) == 3 else srcs
+        if len(srcs.shape) != 4:
+            raise BaseException('Batch of images must have 3 or 4 dimensions')
+        if srcs.shape[-1] > 4:
+            raise BaseException('Each image cannot have more than 4 color channels')
+
+        if self._src_mask is not None or self._apply_mask is not None:
+            raise BaseException('Source and apply masks are not supported for batches, use transfer() per image')
+
+        # reference statistics are computed once for all frames
+        model = ref if isinstance(ref, ReferenceModel) else self.fit(ref, method=self._method)
+
+        # adapt color channels
+        srcs = srcs[..., :3] if srcs.shape[-1] == 4 else srcs
+        if srcs.shape[-1] == 3 and model.shape[2] == 1:
+            srcs = self.rgb2gray(srcs.reshape((-1,) + srcs.shape[2:])).reshape(srcs.shape[:3] + (1,))
+        elif srcs.shape[-1] == 1 and model.shape[2] == 3:
+            model = model.gray
+        if srcs.shape[-1] != model.shape[2]:
+            raise BaseException('Color channel number of %s images and reference %s mismatch' % (srcs.shape[-1],
+                                                                                                  model.shape[2]))
+
+        # restrict monochromatic transfer to histogram matching
+        if srcs.shape[-1] == 1:
+            funs = [self.hist_match_batch]
+            warnings.warn('Transfer restricted to histogram matching due to monochromatic input')
+        else:
+            funs = self.select_funs(self._method, batch=True)
+
+        # float results of the first stage (also for integer frames) keep the precision of intermediate stages as in
+        # the fused transfer of single images
+        if len(funs) == 3 and np.issubdtype(srcs.dtype, np.integer):
+            srcs = funs[0](srcs, model, out=np.empty(srcs.shape, dtype=self.compute_dtype(srcs)))
+            funs = funs[1:]
+
+        # transforms of individual frames are not kept
+        self._stages = []
+        for fun in funs:
+            srcs = fun(srcs, model)
+
+        return srcs
+
+    def stage_params(self, name: str = None) -> tuple:
+        """
+        Collect the parameters of the most recent mapping performed by the function of the given name.
+
+        :param name: Name of a matching function (e.g. 'hist_match')
+        :type name: :class:`str`
+
+        :return: **stage**: tuple of name and parameter dictionary
+        :rtype: tuple
+        """
+
+        if name == 'hist_match':
+            vals = (self.hist_luts,)
+        elif name == 'multivar_transfer':
+            vals = (self.transfer_mat, self.mu_r, self.mu_z)
+        elif name == 'reinhard':
+            vals = self.lab_params
+        else:
+            raise BaseException('Stage \'%s\' not recognized' % name)
+
+        return name, dict(zip(STAGE_PARAMS[name], vals))
+
+    def get_transform(self) -> ColorTransform:
+        """
+        Obtain the color transform fitted by the most recent transfer, which can be applied to other images
+        (e.g., a full resolution version of the source) without the reference.
+
+        :return: **transform**: Fitted color transform
+        :rtype: ColorTransform
+        """
+
+        if not self._stages:
+            raise BaseException('No transform available, run transfer() first')
+
+        return ColorTransform(stages=self._stages, channels=self._src.shape[2], method=self._method)
+
+    def fit(self, ref: np.ndarray = None, method: str = None) -> ReferenceModel:
+        """
+
+        Analyze a reference image once so that subsequent transfers only compute source statistics.
+
+        :param ref: Palette image which serves as reference
+        :param method: Method out of METHODS to fit statistics for or None to fit all methods
+
+        :type ref: :class:`~numpy:numpy.ndarray`
+        :type method: :class:`str`
+
+        :return: **model**: Immutable and picklable reference model to be passed to :meth:`apply`
+        :rtype: ReferenceModel
+
+        """
+
+        ref = ref if ref is not None else self._ref
+        method = method.lower() if method is not None else None
+        if method is not None and method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+
+        # validate reference image while dropping alpha channel
+        ref = ref[..., np.newaxis] if len(ref.shape) == 2 else ref
+        if len(ref.shape) != 3:
+            raise BaseException('Each image must have 2 or 3 dimensions')
+        if ref.shape[2] > 4:
+            raise BaseException('Each image cannot have more than 4 color channels')
+        ref = ref[..., :3] if ref.shape[2] == 4 else ref
+        ch_num = ref.shape[2]
+
+        # statistics of a reduced-resolution proxy (if set) with a reference mask reduced to weights
+        if self._proxy_size is not None and int(np.prod(ref.shape[:2])) > int(self._proxy_size):
+            size, ref_mask = int(self._proxy_size), self._ref_mask
+            self._proxy_size = None
+            self._ref_mask = None if ref_mask is None else self.area_proxy(np.reshape(ref_mask, ref.shape[:2]), size)
+            try:
+                return self.fit(self.area_proxy(ref, size, self.compute_dtype(ref)), method)
+            finally:
+                self._proxy_size, self._ref_mask = size, ref_mask
+
+        # statistics of identical reference pixels and options from previous runs
+        if self._stats_cache is not None:
+            options = {'stats_sample': self._stats_sample, 'stats_sampler': self._stats_sampler,
+                       'stats_seed': self._stats_seed, 'dtype': str(self.compute_dtype(ref)),
+                       'hist_bins': self._hist_bins,
+                       'ref_mask': None if self._ref_mask is None else self._stats_cache.key(self._ref_mask)}
+            key = self._stats_cache.key(ref, method, options)
+            model = self._stats_cache.get(key)
+            if model is not None:
+                return model
+
+        # determine statistics required by method(s)
+        methods = METHODS if method is None else (method,)
+        use_hist = ch_num == 1 or any('hm' in m.split('-') for m in methods)
+        use_lab = ch_num == 3 and METHODS[2] in methods
+        use_mvgd = ch_num > 1 and any(m not in METHODS[1:3] for m in methods)
+        use_pixels = use_mvgd and any(m.__contains__('mvgd') for m in methods)
+
+        # statistics are estimated from a pixel sample (if set) and weighted by the reference mask (if provided)
+        z, sample = ref.reshape([-1, ch_num]).T, self.sample_pixels(ref)
+        weights, sample_weights = [self.pixel_weights(self._ref_mask, ref, sample=flag) for flag in (False, True)]
+        mu, cov = self.mvgd_stats(sample.T, sample_weights) if use_mvgd else (None, None)
+        lab = None
+        if use_lab:
+            log_sample = self.log_lms(sample, dtype=self.compute_dtype(ref))
+            lab = self.lab_moments(log_sample, sample_weights)
+            if sample.shape[0] < z.shape[1]:
+                self.stats_err.update(self.sample_err(log_sample @ LAB_MAT.T / LN10, z.shape[1], 'ref'))
+        if use_mvgd:
+            self.stats_err.update(self.sample_err(sample, z.shape[1], 'z'))
+
+        # monochromatic statistics for gray scale sources
+        gray = None
+        if ch_num == 3:
+            gray_ref = self.rgb2gray(ref)
+            gray = ReferenceModel(method=method, shape=gray_ref.shape,
+                                  hist=self.hist_stats(gray_ref, self._hist_bins, weights))
+
+        model = ReferenceModel(
+            method=method,
+            shape=ref.shape,
+            hist=self.hist_stats(ref, self._hist_bins, weights) if use_hist else None,
+            lab=lab,
+            mu=mu,
+            cov=cov,
+            z=np.array(z) if use_pixels else None,
+            gray=gray,
+        )
+
+        if self._stats_cache is not None:
+            self._stats_cache.put(key, model)
+
+        return model
+
+    def apply(self, src: np.ndarray = None, model: ReferenceModel = None, method: str = None) -> np.ndarray:
+        """
+
+        Transfer colors to a source image using a reference model obtained from :meth:`fit`.
+
+        :param src: Source image that requires transfer
+        :param model: Fitted reference model
+        :param method: Transfer method which defaults to the method the model has been fitted for
+
+        :type src: :class:`~numpy:numpy.ndarray`
+        :type model: :class:`ReferenceModel`
+        :type method: :class:`str`
+
+        :return: Resulting image after color mapping
+        :rtype: np.ndarray
+
+        """
+
+        model = model if model is not None else self._ref
+        if not isinstance(model, ReferenceModel):
+            raise BaseException('Reference model required, use fit() to obtain one')
+
+        method = method if method is not None else model.method if model.method is not None else self._method
+
+        return self.transfer(src=src, ref=model, method=method)
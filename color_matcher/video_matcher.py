@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+__author__ = "Christopher Hahne"
+__email__ = "inbox@christopherhahne.de"
+__license__ = """
+Copyright (c) 2020 Christopher Hahne <inbox@christopherhahne.de>
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+
+import numpy as np
+import warnings
+
+from color_matcher.top_level import ColorMatcher, METHODS
+from color_matcher.hist_matcher import HistogramMatcher
+from color_matcher.mvgd_matcher import TransferMVGD
+from color_matcher.reinhard_matcher import ReinhardMatcher
+from color_matcher.ref_model import ReferenceModel
+from color_matcher.color_transform import ColorTransform
+
+
+class VideoMatcher(object):
+
+    def __init__(self, method: str = 'default', alpha: float = .2, window: int = None, threshold: float = 1e-3,
+                 quantiles: int = 256, **kwargs):
+        """
+        Color matching of frame sequences towards a single reference. Source statistics of each stage are smoothed
+        over time either exponentially with weight alpha of the latest frame or as the mean of the last window frames.
+        Transforms are only re-solved if smoothed statistics change by more than a relative threshold since the last
+        solution, which stabilizes the output (no flicker from jumping transfer matrices) and saves per-frame cost.
+
+        Source distributions for histogram matching are described by a number of quantiles per color channel so that
+        temporal smoothing averages their quantile functions. The analytical MVGD solution depends on pixel pairs of
+        each frame which is why its transfer matrix is smoothed instead of being solved from smoothed moments.
+
+        :param method: Method out of METHODS
+        :param alpha: Weight of the latest frame in the exponential smoothing in (0, 1] where 1 disables smoothing
+        :param window: Number of frames to average statistics over instead of exponential smoothing (if provided)
+        :param threshold: Relative change of statistics below which the previous solution is reused (0 re-solves)
+        :param quantiles: Number of quantiles describing source distributions for histogram matching
+        :param kwargs: Options passed to :class:`ColorMatcher` (e.g. stats_sample, dtype)
+        """
+
+        self._method = method.lower()
+        if self._method not in METHODS:
+            raise BaseException('Method type \'%s\' not recognized' % method)
+        if not 0 < alpha <= 1:
+            raise BaseException('Smoothing weight alpha must be in (0, 1]')
+        if window is not None and window < 1:
+            raise BaseException('Smoothing window must span at least one frame')
+
+        self._alpha = alpha
+        self._window = window
+        self._threshold = threshold
+        self._probs = np.linspace(0, 1, quantiles)
+        self._matcher = ColorMatcher(**kwargs)
+
+        self.model = None
+        self.transform = None
+        self.solves = 0
+        self.frames = 0
+        self._states = []
+
+    def fit(self, ref: np.ndarray = None) -> ReferenceModel:
+        """
+        Analyze the reference once and reset the temporal state.
+
+        :param ref: Palette image or fitted :class:`ReferenceModel` which serves as reference
+
+        :return: **model**: Reference model
+        :rtype: ReferenceModel
+        """
+
+        self.model = ref if isinstance(ref, ReferenceModel) else self._matcher.fit(ref, method=self._method)
+        self.reset()
+
+        return self.model
+
+    def reset(self):
+        """ discard smoothed statistics and solutions (e.g. at scene cuts) """
+
+        self.transform = None
+        self.solves = 0
+        self.frames = 0
+        self._states = []
+
+    def transfer(self, frames, ref: np.ndarray = None):
+        """
+        Lazily match an iterable of frames, which is consumed one frame at a time.
+
+        :param frames: Iterable of images of shape (H, W, C) or (H, W) (e.g. a generator decoding a video)
+        :param ref: Palette image or fitted :class:`ReferenceModel` (previous reference is kept if None)
+
+        :return: **res**: Generator of resulting frames after color mapping
+        :rtype: generator
+        """
+
+        if ref is not None:
+            self.fit(ref)
+        if self.model is None:
+            raise BaseException('Reference required, pass ref or use fit() first')
+
+        for frame in frames:
+            yield self.match_frame(frame)
+
+    def match_frame(self, frame: np.ndarray = None) -> np.ndarray:
+        """
+        Match the next frame of a sequence while updating the temporal state.
+
+        :param frame: Image array of shape (H, W, C) or (H, W)
+        :type frame: :class:`~numpy:numpy.ndarray`
+
+        :return: **res**: Resulting frame after color mapping
+        :rtype: np.ndarray
+        """
+
+        if self.model is None:
+            raise BaseException('Reference required, use fit() first')
+
+        res, model = self.validate_chs(np.asarray(frame))
+        # restrict monochromatic transfer to histogram matching
+        funs = [self._matcher.hist_match] if res.shape[2] == 1 else self._matcher.select_funs(self._method)
+        names = [fun.__name__ for fun in funs]
+        if not self._states:
+            self._states = [dict() for _ in names]
+
+        dtype = self._matcher.compute_dtype(res)
+        stages = []
+        for name, state in zip(names, self._states):
+            stage = self.update_stage(name, state, res, model)
+            res = ColorTransform(stages=[stage], channels=res.shape[2]).apply(res, dtype)
+            stages.append(stage)
+
+        self.transform = ColorTransform(stages=stages, channels=res.shape[2], method=self._method)
+        self.frames += 1
+
+        return res
+
+    def validate_chs(self, frame: np.ndarray = None) -> tuple:
+        """ adapt color channels of a frame to those of the reference and return the frame with the matching model """
+
+        frame = frame[..., np.newaxis] if len(frame.shape) == 2 else frame
+        if len(frame.shape) != 3:
+            raise BaseException('Each frame must have 2 or 3 dimensions')
+        if frame.shape[2] > 4:
+            raise BaseException('Each frame cannot have more than 4 color channels')
+
+        model = self.model
+        frame = frame[..., :3] if frame.shape[2] == 4 else frame
+        if frame.shape[2] == 3 and model.shape[2] == 1:
+            frame = ColorMatcher.rgb2gray(frame)
+        elif frame.shape[2] == 1 and model.shape[2] == 3:
+            model = model.gray
+        if frame.shape[2] != model.shape[2]:
+            raise BaseException('Color channel number of frame %s and reference %s mismatch' % (frame.shape[2],
+                                                                                                 model.shape[2]))
+        if frame.shape[2] == 1 and not self.frames:
+            warnings.warn('Transfer restricted to histogram matching due to monochromatic input')
+
+        return frame, model
+
+    def update_stage(self, name: str = None, state: dict = None, img: np.ndarray = None,
+                     model: ReferenceModel = None) -> tuple:
+        """
+        Update the smoothed source statistics of a stage from an image and re-solve its parameters if required.
+
+        :param name: Name of the matching function (e.g. 'hist_match')
+        :param state: Temporal state of the stage which is updated in-place
+        :param img: Input image of the stage
+        :param model: Reference model
+
+        :return: **stage**: tuple of name and parameter dictionary
+        :rtype: tuple
+        """
+
+        sample = self._matcher.sample_pixels(img)
+        if name == 'hist_match':
+            stats = (np.stack([self.quantiles(sample[..., ch].ravel(), self._probs) for ch in range(img.shape[2])]),)
+        elif name == 'multivar_transfer':
+            stats = TransferMVGD.mvgd_stats(sample.T)
+        else:
+            stats = ReinhardMatcher.lab_stats(sample, 'float64')
+        stats = self.smooth(state, 'stats', stats)
+
+        # reuse previous solution while statistics are steady
+        if 'params' in state and self.change(name, state['anchor'], stats) <= self._threshold:
+            return name, state['params']
+
+        if name == 'hist_match':
+            model.require('hist')
+            luts = []
+            for quants, (ref_vals, ref_cdf) in zip(stats[0], model.hist):
+                # keep the upper quantile of repeated values to map them by their cdf as in histogram matching
+                vals, idxs = np.unique(quants[::-1], return_index=True)
+                luts.append((vals, np.interp(self._probs[len(quants)-1-idxs], ref_cdf, ref_vals)))
+            params = {'luts': tuple(luts)}
+        elif name == 'multivar_transfer':
+            model.require('mu', 'cov')
+            if self._method.__contains__('mvgd'):
+                # reference term of the analytical solution is computed once
+                state['ref_mat'] = state['ref_mat'] if 'ref_mat' in state else self.ref_mat(img, model)
+                transfer_mat = self.smooth(state, 'mats', (self.mvgd_mat(img, state['ref_mat']),))[0]
+            else:
+                transfer_mat = TransferMVGD.mkl_mat(stats[1], model.cov)
+            params = {'transfer_mat': transfer_mat, 'mu_r': stats[0], 'mu_z': model.mu}
+        else:
+            model.require('lab')
+            params = {'mean_src': stats[0], 'std_ratios': model.lab[1] / stats[1], 'mean_ref': model.lab[0]}
+
+        state['anchor'], state['params'] = stats, params
+        self.solves += 1
+
+        return name, params
+
+    def smooth(self, state: dict = None, key: str = None, vals: tuple = None) -> tuple:
+        """ blend a tuple of arrays into the temporal state exponentially or by a moving window """
+
+        if self._window is not None:
+            state.setdefault(key + '_win', deque(maxlen=self._window)).append(vals)
+            state[key] = tuple(np.mean(arrs, axis=0) for arrs in zip(*state[key + '_win']))
+        elif key in state:
+            state[key] = tuple((1-self._alpha) * prev + self._alpha * val for prev, val in zip(state[key], vals))
+        else:
+            state[key] = tuple(vals)
+
+        return state[key]
+
+    @staticmethod
+    def quantiles(vec: np.ndarray = None, probs: np.ndarray = None) -> np.ndarray:
+        """ inverse cumulative distribution of a 1-D array at given probabilities from bin counts or sorted values """
+
+        bincount = HistogramMatcher.int_bincount(vec)
+        if bincount is not None:
+            cnts, _, offset = bincount
+            cdf = np.cumsum(cnts) / vec.size
+            idxs = np.minimum(np.searchsorted(cdf, probs), cnts.size-1)
+            return (idxs + offset).astype('float64')
+
+        idxs = np.maximum(np.ceil(probs * vec.size).astype(np.intp) - 1, 0)
+
+        return np.sort(vec)[idxs].astype('float64')
+
+    @staticmethod
+    def change(name: str = None, prev: tuple = None, stats: tuple = None) -> float:
+        """ relative change of stage statistics with respect to the scale of the previous ones """
+
+        if name == 'hist_match':
+            scale = prev[0][:, -1] - prev[0][:, 0] + np.spacing(1)
+            return float(np.max(np.abs(stats[0] - prev[0]) / scale[:, np.newaxis]))
+        elif name == 'multivar_transfer':
+            scale = np.sqrt(np.trace(prev[1])) + np.spacing(1)
+            return float(np.linalg.norm(stats[0] - prev[0]) / scale + np.linalg.norm(stats[1] - prev[1]) / scale**2)
+        else:
+            scale = prev[1] + np.spacing(1)
+            return float(np.max(np.abs(stats[0] - prev[0]) / scale) + np.max(np.abs(stats[1] - prev[1]) / scale))
+
+    @staticmethod
+    def ref_mat(img: np.ndarray = None, model: ReferenceModel = None) -> np.ndarray:
+        """ reference term of the analytical MVGD solution (see :meth:`TransferMVGD.analytical_solver`) """
+
+        if model.z is None:
+            raise Exception('Analytical MVGD solution requires reference pixels which have not been fitted')
+        if int(np.prod(img.shape[:2])) != model.z.shape[-1]:
+            raise Exception('Analytical MVGD solution requires spatial dimensions of both images to be equal')
+
+        return TransferMVGD.ref_term(model.z, model.mu, model.cov)
+
+    @staticmethod
+    def mvgd_mat(img: np.ndarray = None, ref_mat: np.ndarray = None) -> np.ndarray:
+        """ analytical MVGD transfer matrix of a frame with centering of its pixels folded into the reference term """
+
+        r = img.reshape([-1, img.shape[2]])
+        if r.shape[0] != ref_mat.shape[1]:
+            raise Exception('Analytical MVGD solution requires spatial dimensions of both images to be equal')
+        mu_r, cov_r = TransferMVGD.mvgd_stats(r.T)
+
+        return (ref_mat @ r - ref_mat.sum(axis=1)[:, np.newaxis] * mu_r.T) @ np.linalg.pinv(cov_r)
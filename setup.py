@@ -94,7 +94,7 @@ setup(
                'film movie sequence automatic grading color-grading colour-grading '
                'equalize equalise equalization equalisation light-field lightfield stop-motion stopmotion',
       scripts=['color_matcher/bin/cli.py'],
-      entry_points={'console_scripts': ['color-matcher=color_matcher.bin.cli:main'], },
+      entry_points={'console_scripts': ['color-matcher=color_matcher.bin.cli:run'], },
       packages=find_packages(),
       install_requires=req_list,
       include_package_data=True,
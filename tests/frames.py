@@ -1,4 +1,4 @@
-from color_matcher import ColorMatcher
+from color_matcher import VideoMatcher
 from color_matcher.io_handler import load_img_file
 from color_matcher.normalizer import Normalizer
 
@@ -17,18 +17,18 @@ if fn_img1.endswith('gif'):
 duration = 40  #im.info['duration'] if 'duration' in im.info else
 img2 = load_img_file(os.path.join(dir_path, 'sunrise_mvgd.png'))
 
-sequence = []
 method = 'mvgd'
 #size = 200, 200
+frames = []
 for frame in ImageSequence.Iterator(im):
 
     #img1 = np.asarray(frame.convert('RGB').resize(size, Image.ANTIALIAS), np.uint8)
-    img1 = np.asarray(frame.convert('RGB'), np.uint8)
+    frames.append(np.asarray(frame.convert('RGB'), np.uint8))
 
-    # create color match object
-    match = ColorMatcher(img1, img2, method=method).main()
+# color match frames one after another with temporally smoothed statistics
+matches = VideoMatcher(method=method).transfer(frames, img2)
 
-    sequence.append(Image.fromarray(Normalizer(match).uint8_norm()))
+sequence = [Image.fromarray(Normalizer(match).uint8_norm()) for match in matches]
 
 output_fn = os.path.join(dir_path, os.path.splitext(fn_img1)[0] + '_' + method + '.gif')
 imageio.mimwrite(output_fn, sequence, duration=1/duration, palettesize=2**8)
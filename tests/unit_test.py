@@ -21,11 +21,29 @@ __license__ = """
 """
 
 from color_matcher.top_level import ColorMatcher, METHODS
+from color_matcher.ref_model import ReferenceModel
+from color_matcher.hist_matcher import HistogramMatcher
+from color_matcher.reinhard_matcher import ReinhardMatcher
+from color_matcher.tiled_matcher import TiledMatcher
+from color_matcher.video_matcher import VideoMatcher
+from color_matcher.lut3d import Lut3D, INTERP_TYPES
 from color_matcher.io_handler import *
+from color_matcher.normalizer import Normalizer
 from color_matcher.bin.cli import main
+from color_matcher.benchmark import run_benchmark, synth_img, save_bench_img, load_bench_img
+from color_matcher.server import MatchServer
+from color_matcher.stats_cache import StatsCache
+from color_matcher.accumulators import ReferenceAccumulator
+from color_matcher.ref_index import ReferenceIndex
 
 import unittest
 import os, sys
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import urllib.request
 import numpy as np
 from ddt import ddt, idata, unpack
 try:
@@ -90,6 +108,671 @@ class MatchMethodTester(unittest.TestCase):
         if save:
             save_img_file(match, file_path=os.path.join(self.dat_path, 'scotland_'+method), file_type='png')
 
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_fit_apply(self, method):
+
+        # load images
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+
+        # fit reference for all methods and pass model through pickle
+        model = pickle.loads(pickle.dumps(ColorMatcher().fit(plain)))
+
+        # compare against transfer from reference image
+        match = ColorMatcher(src=house.copy(), ref=plain.copy(), method=method).main()
+        apply = ColorMatcher().apply(house.copy(), model, method=method)
+
+        # assertion
+        self.assertTrue(isinstance(model, ReferenceModel))
+        self.assertTrue(np.allclose(match, apply))
+
+    def test_fit_method_stats(self):
+
+        ref = np.random.rand(5, 5, 4)
+
+        # fit statistics for single method only
+        model = ColorMatcher().fit(ref, method='mkl')
+
+        # assertion
+        self.assertEqual((5, 5, 3), model.shape)
+        self.assertEqual(None, model.hist)
+        self.assertFalse(model.cov.flags.writeable)
+        self.assertRaises(Exception, ColorMatcher().apply, np.random.rand(5, 5, 3), model, 'hm')
+
+    def test_stats_cache(self):
+
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # statistics are written once and read by another matcher (as in a later run)
+            cache = StatsCache(tmp_dir)
+            model = ColorMatcher(stats_cache=cache).fit(plain, method='hm-mkl-hm')
+            cached = ColorMatcher(stats_cache=tmp_dir).fit(plain, method='hm-mkl-hm')
+            match = ColorMatcher(stats_cache=cache).transfer(src=house, ref=plain, method='hm-mkl-hm')
+            files = os.listdir(tmp_dir)
+
+            # other options or pixels yield separate entries of which the least recently used exceed the size cap
+            ColorMatcher(stats_cache=cache, stats_sample=.5).fit(plain, method='hm-mkl-hm')
+            size = max(os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir))
+            ColorMatcher(stats_cache=StatsCache(tmp_dir, max_mb=2.5*size/2**20)).fit(house, method='hm-mkl-hm')
+            num = len(os.listdir(tmp_dir))
+
+        # assertion
+        self.assertEqual((1, 2, 1), (len(files), cache.misses, cache.hits))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(model.arrays(), cached.arrays())))
+        self.assertTrue(np.allclose(ColorMatcher().transfer(src=house, ref=plain, method='hm-mkl-hm'), match))
+        self.assertEqual(2, num)
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_transform_file(self, method):
+
+        # load images
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+
+        # fit transform and pass it through a file
+        cm = ColorMatcher(method=method)
+        match = cm.transfer(src=house.copy(), ref=plain)
+        file_path = save_transform_file(cm.get_transform(), os.path.join(self.dat_path, 'transform_' + method))
+        transform = load_transform_file(file_path)
+        os.remove(file_path)
+
+        # assertion
+        self.assertEqual(method, transform.method)
+        self.assertTrue(np.allclose(match, transform.apply(house)))
+
+    @idata((['npz', 'default'], ['cube', 'lut']))
+    @unpack
+    def test_cli_transform(self, ext, name):
+
+        # copies of the images in a temporary directory the CLI writes its results to
+        dat_files = sorted(os.listdir(self.dat_path))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fn in ('scotland_house.png', 'scotland_plain.png', 'bee_2.png'):
+                shutil.copy(os.path.join(self.dat_path, fn), tmp_dir)
+            file_path = os.path.join(tmp_dir, 'transform_cli.' + ext)
+
+            # export transform and apply it to another image without reference
+            for args in (['-s', os.path.join(tmp_dir, 'scotland_house.png'),
+                          '-r', os.path.join(tmp_dir, 'scotland_plain.png'), '--export=' + file_path],
+                         ['-s', os.path.join(tmp_dir, 'bee_2.png'), '--transform=' + file_path]):
+                sys.argv = [sys.argv[0]] + args
+                ret = main()
+                sys.argv = [sys.argv[0]]
+                self.assertEqual(True, ret)
+
+            # assertion
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'bee_2_%s.png' % name)))
+
+        # neither transform nor LUT results are left in the test data
+        self.assertEqual(dat_files, sorted(os.listdir(self.dat_path)))
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_lut_cube(self, method):
+
+        # load images
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+
+        # bake fitted transform into LUT and pass it through a .cube file
+        cm = ColorMatcher(method=method)
+        match = cm.transfer(src=house, ref=plain)
+        file_path = save_lut_file(cm.get_transform().to_lut(size=33), os.path.join(self.dat_path, 'lut_' + method))
+        lut = load_lut_file(file_path)
+        os.remove(file_path)
+
+        # identity LUT reproduces colors on and in between grid points
+        grid = np.stack(np.meshgrid(*[np.linspace(-1, 2, 4)]*3, indexing='ij'), axis=-1)
+        identity = Lut3D(table=grid, domain=(-1, 2))
+
+        # assertion (affine transforms are reproduced exactly, nonlinear ones up to grid resolution)
+        for interp in INTERP_TYPES:
+            res = lut(house, interp=interp)
+            self.assertTrue(np.allclose(match, res, atol=1e-5) if method in ('default', 'mvgd', 'mkl') else
+                            np.abs(match - res).mean() < 1e-2)
+            self.assertTrue(np.allclose(house, identity(house, interp=interp), atol=1e-6))
+        self.assertEqual(method, lut.title)
+
+    @idata(([dtype] for dtype in ['uint8', 'uint16', 'int16', 'int32']))
+    @unpack
+    def test_hist_match_int(self, dtype):
+
+        # integer images (including negative values where supported)
+        lo, hi = max(np.iinfo(dtype).min, -99), min(np.iinfo(dtype).max, 4095)
+        src = np.random.randint(lo, hi, size=(40, 50, 3)).astype(dtype)
+        ref = np.random.randint(lo, hi, size=(30, 20, 3)).astype(dtype)
+
+        # lookup table path for integers vs. sorting path for floats
+        res_int = ColorMatcher().transfer(src=src, ref=ref, method='hm')
+        res_flt = ColorMatcher().transfer(src=src.astype('float64'), ref=ref.astype('float64'), method='hm')
+
+        # assertion
+        self.assertEqual(dtype, str(res_int.dtype))
+        self.assertTrue(np.array_equal(res_int, res_flt.astype(dtype)))
+
+    @idata(([dtype] for dtype in ['float32', 'float64']))
+    @unpack
+    def test_hist_bins(self, dtype):
+
+        # float images off a grid (noisy) and on a grid (8-bit)
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), dtype=dtype)
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), dtype=dtype)
+        rng = np.random.default_rng(0)
+        src, ref = [(img + rng.normal(0, .01, img.shape)).astype(dtype) for img in (house, plain)]
+
+        # binned vs. exact histogram matching
+        cm = ColorMatcher(method='hm', hist_bins=4096)
+        res = cm.transfer(src=src, ref=ref)
+        exp = ColorMatcher(method='hm').transfer(src=src, ref=ref)
+        err = np.abs(res - exp) / (ref.max() - ref.min())
+
+        # assertion
+        self.assertTrue(err.max() < 1e-2 and err.mean() < 1e-4)
+        self.assertEqual([4097] * 3, [vals.size for vals, _ in cm.hist_luts])
+        self.assertTrue(np.allclose(res, cm.get_transform()(src), atol=1e-5))
+        self.assertTrue(np.array_equal(ColorMatcher(method='hm').transfer(src=house, ref=plain),
+                                       ColorMatcher(method='hm', hist_bins=256).transfer(src=house, ref=plain)))
+
+    @idata(([method] for method in METHODS))
+    @unpack
+    def test_n_threads(self, method):
+
+        # images spanning several row tiles and a noisy float variant for binned histogram matching
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        noisy = np.clip(src + np.random.default_rng(0).normal(0, .01, src.shape), 0, 1)
+
+        # results of thread-parallel execution are identical to the serial path
+        for img, kwargs in [(src, {}), (noisy, {'hist_bins': 4096})]:
+            exp = ColorMatcher(method=method, **kwargs).transfer(src=img, ref=ref)
+            res = ColorMatcher(method=method, n_threads=4, **kwargs).transfer(src=img, ref=ref)
+            self.assertTrue(np.array_equal(res, exp))
+
+    @idata(([method] for method in METHODS))
+    @unpack
+    def test_masks(self, method):
+
+        # letterboxed images where bars are excluded from statistics by masks
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        src[:40], src[-40:], ref[:40], ref[-40:] = 0, 0, 1, 1
+        mask = np.zeros(src.shape[:2], dtype=bool)
+        mask[40:-40] = True
+
+        # masked statistics agree with those of cropped images
+        res = ColorMatcher(method=method, src_mask=mask, ref_mask=mask).transfer(src=src, ref=ref)
+        exp = ColorMatcher(method=method).transfer(src=src[40:-40], ref=ref[40:-40])
+        self.assertTrue(np.allclose(res[40:-40], exp, atol=1e-4))
+
+        # transfer restricted to masked region leaves bars untouched
+        cm = ColorMatcher(method=method, src_mask=mask, ref_mask=mask, apply_mask=mask)
+        res = cm.transfer(src=src, ref=ref)
+        self.assertTrue(np.array_equal(res[:40], src[:40]) and np.allclose(res[40:-40], exp, atol=1e-4))
+        model = ColorMatcher(ref_mask=mask).fit(ref, method=method)
+        self.assertTrue(np.allclose(ColorMatcher(src_mask=mask).transfer(src, model, method)[40:-40], exp, atol=1e-4))
+
+    def test_accumulators(self):
+
+        # reference rows fed chunk by chunk into two accumulators (e.g. of different processes) which are merged
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), native=True)
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), native=True)
+        accs = [ReferenceAccumulator(), ReferenceAccumulator()]
+        for i, y in enumerate(range(0, ref.shape[0], 50)):
+            accs[i % 2].update(ref[y:y+50])
+        model = pickle.loads(pickle.dumps(accs[0])).merge(accs[1]).model()
+        exp = ColorMatcher().fit(ref)
+
+        # assertion
+        self.assertTrue(np.allclose(model.mu, exp.mu) and np.allclose(model.cov, exp.cov))
+        self.assertTrue(np.allclose(model.lab[0], exp.lab[0], atol=1e-5) and np.allclose(model.lab[1], exp.lab[1]))
+        for hist, exp_hist in [(model.hist, exp.hist), (model.gray.hist, exp.gray.hist)]:
+            self.assertTrue(all(np.array_equal(vals, exp_vals) and np.allclose(cdf, exp_cdf)
+                                for (vals, cdf), (exp_vals, exp_cdf) in zip(hist, exp_hist)))
+        for method in ('default', 'hm', 'hm-mkl-hm'):
+            self.assertTrue(np.array_equal(ColorMatcher().transfer(src, model, method),
+                                           ColorMatcher().transfer(src, exp, method)))
+        self.assertTrue(np.array_equal(ColorMatcher().transfer(src[..., 0], model, 'hm'),
+                                       ColorMatcher().transfer(src[..., 0], exp, 'hm')))
+        self.assertRaises(BaseException, ColorMatcher().transfer, src, model, 'mvgd')
+
+        # merge into an accumulator without pixels
+        merged = ReferenceAccumulator().merge(accs[0]).merge(accs[1]).model()
+        self.assertTrue(np.array_equal(merged.gray.hist[0][0], exp.gray.hist[0][0]))
+
+    def test_blend_models(self):
+
+        # blend of models fitted to two equally sized halves describes the pixels of the entire reference
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), native=True)[:360]
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), native=True)
+        cm = ColorMatcher()
+        model = ReferenceModel.blend([cm.fit(ref[:180]), cm.fit(ref[180:])], weights=[.5, .5])
+        exp = cm.fit(ref)
+
+        # assertion
+        self.assertTrue(np.allclose(model.mu, exp.mu) and np.allclose(model.cov, exp.cov, rtol=1e-4))
+        self.assertTrue(np.allclose(model.lab[0], exp.lab[0]) and np.allclose(model.lab[1], exp.lab[1], atol=1e-5))
+        for hist, exp_hist in [(model.hist, exp.hist), (model.gray.hist, exp.gray.hist)]:
+            self.assertTrue(all(np.array_equal(vals, exp_vals) and np.allclose(cdf, exp_cdf)
+                                for (vals, cdf), (exp_vals, exp_cdf) in zip(hist, exp_hist)))
+        self.assertTrue(np.array_equal(cm.transfer(src, model, 'hm'), cm.transfer(src, exp, 'hm')))
+        self.assertTrue(model.z is None and ReferenceModel.blend([exp]).mu is not None)
+        self.assertRaises(BaseException, ReferenceModel.blend, [exp, exp], [1, -1])
+
+    def test_ref_index(self):
+
+        # library of references given as images and fitted models
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+        index = ReferenceIndex()
+        index.add('plain', plain)
+        index.add('house', ColorMatcher().fit(house, method='mkl'))
+        for i, gain in enumerate(np.linspace(.5, .9, 20)):
+            index.add('dark_%s' % i, plain * gain)
+
+        # vectorized distances agree with those of single pairs which are symmetric and vanish for equal inputs
+        mu_a, cov_a = index.moments(house)
+        mu_b, cov_b = index.moments(plain)
+        dists = index.distances(house)
+        self.assertAlmostEqual(dists[0], ColorMatcher.w2_dist(mu_a, mu_b, cov_a, cov_b))
+        self.assertAlmostEqual(dists[0], ColorMatcher.w2_dist(mu_b, mu_a, cov_b, cov_a))
+        self.assertAlmostEqual(dists[1], 0)
+        self.assertAlmostEqual(ColorMatcher().w2_img_dist(house, plain), dists[0])
+
+        # top-k search with and without pre-filter by means
+        matches = index.query(plain * .89, k=3)
+        self.assertEqual(['dark_19', 'dark_18', 'dark_17'], [key for key, _ in matches])
+        self.assertEqual(matches, index.query(plain * .89, k=3, candidates=5))
+        self.assertEqual(len(index), len(index.query(house, k=100)))
+
+    def test_solvers(self):
+
+        # stacked covariances of random pixels including singular and near-identity ones
+        rng = np.random.default_rng(0)
+        mats = rng.normal(size=(500, 3, 20))
+        covs = mats @ np.swapaxes(mats, -1, -2) / 20
+        covs[0], covs[1] = np.diag([1., 1., 0.]), np.eye(3) + 1e-12
+        cov_z = covs[2]
+
+        # closed-form and eigen decomposition solutions agree and solve the MKL equation T A T = B
+        transfer_mats = ColorMatcher.mkl_mat(covs, cov_z)
+        self.assertTrue(np.allclose(transfer_mats, ColorMatcher.mkl_mat_eigh(covs, cov_z), atol=1e-9))
+        self.assertTrue(np.allclose(transfer_mats[2:] @ covs[2:] @ transfer_mats[2:], cov_z, atol=1e-8))
+        self.assertTrue(np.allclose(ColorMatcher.eigvalsh_3x3(covs), np.linalg.eigvalsh(covs), atol=1e-9))
+
+        # analytical solution from 3x3 moment matrices equals the pseudo-inverse of pixel matrices
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))[:120, :160]
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))[:120, :160]
+        cm = ColorMatcher(method='mvgd', stats_sample=.5)
+        cm.transfer(src, ref)
+        exp = np.linalg.pinv((cm.z - cm.mu_z).T @ np.linalg.pinv(cm.cov_z)) @ (cm.r - cm.mu_r).T @ \
+            np.linalg.pinv(cm.cov_r)
+        self.assertTrue(np.allclose(cm.transfer_mat, exp, atol=1e-8))
+
+    @idata(([method, native] for method in METHODS for native in [False, True]))
+    @unpack
+    def test_proxy_size(self, method, native):
+
+        # images (in storage type if native) with black pixels upsampled by pixel repetition whose area-averaged
+        # proxies equal the original images
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), native=native)[:120, :160].copy()
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), native=native)[:120, :160].copy()
+        src[:10], ref[:5] = 0, 0
+        big_src, big_ref = [np.repeat(np.repeat(img, 4, axis=0), 4, axis=1) for img in (src, ref)]
+        self.assertTrue(np.allclose(ColorMatcher.area_proxy(big_src, src.shape[0] * src.shape[1]), src))
+
+        # transform fitted on proxies applied at full resolution
+        exp = np.repeat(np.repeat(ColorMatcher(method=method).transfer(src, ref), 4, axis=0), 4, axis=1)
+        res = ColorMatcher(method=method, proxy_size=src.shape[0] * src.shape[1]).transfer(big_src, big_ref)
+        self.assertEqual((big_src.shape, exp.dtype), (res.shape, res.dtype))
+        self.assertTrue(np.allclose(res, exp, atol=1e-5))
+
+        # region-restricted transfer with masks reduced to proxy weights
+        mask = np.zeros(big_src.shape[:2], dtype=bool)
+        mask[40:-40] = True
+        cm = ColorMatcher(method=method, proxy_size=src.size, src_mask=mask, ref_mask=mask, apply_mask=mask)
+        res = cm.transfer(big_src, big_ref)
+        self.assertTrue(np.array_equal(res[:40], big_src[:40]) and np.isfinite(res).all())
+
+    @idata(([dtype] for dtype in ['uint8', 'uint16']))
+    @unpack
+    def test_native_int(self, dtype):
+
+        # images in storage type (16-bit obtained from 8-bit files) of equal size for the analytical MVGD solver
+        scale = np.iinfo(dtype).max // 255
+        src = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), native=True)[:100, :150]
+        ref = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), native=True)[:100, :150]
+        src, ref = src.astype(dtype) * scale, ref.astype(dtype) * scale
+        src_copy = src.copy()
+
+        # integer inputs yield results in native units equal to those of [0, 1] normalized float inputs
+        for method in METHODS:
+            res = ColorMatcher(method=method).transfer(src=src, ref=ref)
+            exp = ColorMatcher(method=method).transfer(src=src/np.iinfo(dtype).max, ref=ref/np.iinfo(dtype).max)
+            self.assertTrue(np.allclose(exp, res / np.iinfo(dtype).max, atol=5e-3), msg=method)
+
+        # lossless round trip of native files and casting of float results without stretching
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_img_file(src, file_path=os.path.join(tmp_dir, 'src.tiff'), native=True)
+            self.assertTrue(np.array_equal(src, load_img_file(os.path.join(tmp_dir, 'src.tiff'), native=True)))
+            save_img_file(src, file_path=os.path.join(tmp_dir, 'src.png'), native=True)
+            png = load_img_file(os.path.join(tmp_dir, 'src.png'), native=True)
+            self.assertTrue(png.dtype == np.uint8 and np.array_equal(src >> 8 * (src.itemsize - 1), png))
+        cast = Normalizer(res).type_cast(dtype=dtype)
+        self.assertEqual(dtype, str(cast.dtype))
+        self.assertTrue(np.array_equal(cast, np.clip(np.rint(res), 0, np.iinfo(dtype).max)))
+        self.assertTrue(np.allclose(Normalizer(src).type_norm(), (src - src.min()) / (src.max() - src.min())))
+        self.assertTrue(np.array_equal(src, src_copy))
+
+    @idata(([dtype] for dtype in ['int8', 'int16']))
+    @unpack
+    def test_apply_luts_signed(self, dtype):
+
+        # signed images spanning more than the positive range of their type
+        info = np.iinfo(dtype)
+        lo, hi = info.min + 1, info.max
+        img = np.array([lo, 0, hi], dtype=dtype).reshape(1, 3, 1)
+        res = HistogramMatcher.apply_luts(img, ((np.array([lo, hi]), np.array([0., 1.])),))
+        self.assertTrue(np.allclose(res.ravel(), [0, -lo / (hi - lo), 1]))
+
+        # histogram matching of signed images agrees with the transform applying its lookup tables
+        rng = np.random.default_rng(0)
+        src = rng.integers(lo, hi, (20, 30, 3), endpoint=True).astype(dtype)
+        ref = rng.integers(lo, hi, (20, 30, 3), endpoint=True).astype(dtype)
+        cm = ColorMatcher(method='hm')
+        res = cm.transfer(src, ref)
+        self.assertTrue(np.array_equal(res, cm.get_transform().apply(src, 'float64').astype(dtype)))
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_transfer_batch(self, method):
+
+        # stacked frames
+        srcs = np.random.rand(4, 8, 9, 3)**2
+        ref = np.random.rand(8, 9, 3)
+
+        # batched vs. frame-wise transfer
+        res = ColorMatcher().transfer_batch(srcs=list(srcs), ref=ref, method=method)
+        exp = np.stack([ColorMatcher(method=method).transfer(src=src.copy(), ref=ref) for src in srcs])
+
+        # assertion
+        self.assertEqual(srcs.shape, res.shape)
+        self.assertTrue(np.allclose(exp, res))
+
+    @idata(([method, dtype] for method in ['mkl', 'hm-mkl-hm'] for dtype in ['float32', 'uint8']))
+    @unpack
+    def test_transfer_batch_low_contrast(self, method, dtype):
+
+        # low-contrast frames of single precision or 8-bit pixels exceeding a chunk of the moment accumulation
+        rng = np.random.default_rng(0)
+        scale = 1 if dtype == 'float32' else 255
+        srcs = np.clip(.7 + rng.normal(0, .002, (3, 300, 400, 3)), 0, 1) * scale
+        ref = np.clip(.5 + rng.normal(0, .05, (300, 400, 3)), 0, 1) * scale
+        srcs, ref = (srcs.round(), ref.round()) if dtype == 'uint8' else (srcs, ref)
+        srcs, ref = srcs.astype(dtype), ref.astype(dtype)
+
+        # batched vs. frame-wise transfer
+        res = ColorMatcher().transfer_batch(srcs=srcs, ref=ref, method=method)
+        exp = np.stack([ColorMatcher(method=method).transfer(src=src.copy(), ref=ref) for src in srcs])
+
+        # assertion
+        self.assertTrue(np.allclose(exp, res, atol=1e-3 * scale), msg=np.abs(exp - res).max())
+
+    @idata(([m, smp, sampler] for m in ['mkl', 'reinhard'] for smp in [.05, 2000] for sampler in ['random', 'grid']))
+    @unpack
+    def test_stats_sample(self, method, stats_sample, sampler):
+
+        # load images
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+
+        # transfer with statistics from all pixels vs. subsample
+        match = ColorMatcher(src=house.copy(), ref=plain.copy(), method=method).main()
+        cm = ColorMatcher(src=house.copy(), ref=plain.copy(), method=method, stats_sample=stats_sample,
+                          stats_sampler=sampler, stats_seed=1)
+        sampled = cm.main()
+
+        # assertion
+        self.assertEqual(match.shape, sampled.shape)
+        self.assertTrue(np.abs(match - sampled).max() < .05)
+        self.assertTrue(all(np.max(err) < .05 for err in cm.stats_err.values()))
+        self.assertEqual(6 if sampler == 'random' else 0, len(cm.stats_err))
+
+        # fractions of any real type in (0, 1] where 1 selects all pixels and grid samples capped at the sample size
+        n = house.shape[0] * house.shape[1]
+        for smp, k in [(1, n), (np.float32(.5), n // 2), (np.int64(2000), 2000), (2000., 2000)]:
+            mat = ColorMatcher(stats_sample=smp, stats_sampler=sampler).sample_pixels(house)
+            self.assertTrue(abs(mat.shape[0] - k) <= 1, msg=(smp, mat.shape))
+        self.assertRaises(BaseException, ColorMatcher, stats_sample=0)
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_tiled_memmap(self, method):
+
+        # integer images written to memory-mapped files
+        tmp_path = tempfile.mkdtemp()
+        src = (np.random.rand(40, 30, 3)**2 * 255).astype('uint8')
+        ref = (np.random.rand(40, 30, 3) * 255).astype('uint8')
+        np.save(os.path.join(tmp_path, 'src.npy'), src)
+        np.save(os.path.join(tmp_path, 'ref.npy'), ref)
+        src_map = load_img_memmap(os.path.join(tmp_path, 'src.npy'))
+        ref_map = load_img_memmap(os.path.join(tmp_path, 'ref.npy'))
+        out_map = create_img_memmap(os.path.join(tmp_path, 'out.npy'), shape=src.shape, dtype='float64')
+
+        # tiled vs. in-memory transfer
+        res = TiledMatcher(method=method, tile_rows=7).transfer(src_map, ref_map, out=out_map)
+        exp = ColorMatcher(method=method).transfer(src=src/255., ref=ref/255.)
+        del src_map, ref_map, out_map
+        shutil.rmtree(tmp_path)
+
+        # assertion (histograms of intermediate float results are binned)
+        self.assertTrue(np.allclose(exp, res) if method in METHODS[:5] else np.abs(exp - res).max() < .05)
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_dtype_out(self, method):
+
+        # load images in double precision
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), dtype='float64')
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), dtype='float64')
+
+        # single precision computation written into a preallocated buffer
+        match = ColorMatcher(method=method).transfer(src=house.copy(), ref=plain)
+        out = np.empty(house.shape, dtype='float32')
+        res = ColorMatcher(method=method, dtype='float32').transfer(src=house.copy(), ref=plain, out=out)
+
+        # assertion
+        self.assertTrue(res is out)
+        self.assertTrue(np.allclose(match, res, atol=1e-3))
+        self.assertEqual(np.float32, load_img_file(os.path.join(self.dat_path, 'scotland_plain.png')).dtype)
+
+        # in-place transfer with statistics of pixel samples equals out-of-place transfer
+        match = ColorMatcher(method=method, stats_sample=5000).transfer(src=house.copy(), ref=plain)
+        src = house.copy()
+        res = ColorMatcher(method=method, stats_sample=5000).transfer(src=src, ref=plain, out=src)
+        self.assertTrue(np.allclose(match, res))
+
+    @idata(([m, dtype] for m in METHODS[5:] for dtype in ['float32', 'float64']))
+    @unpack
+    def test_fused_transfer(self, method, dtype):
+
+        # load images
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'), dtype=dtype)
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'), dtype=dtype)
+
+        # fused pipeline vs. stages applied one after another
+        res = ColorMatcher(method=method).transfer(src=house.copy(), ref=plain)
+        cm = ColorMatcher(method=method)
+        cm._fun_name = 'mvgd' if method.__contains__('mvgd') else 'mkl'
+        cm._fun_call = cm._fun_dict[cm._fun_name]
+        seq = cm.hist_match(cm.multivar_transfer(cm.hist_match(house.copy(), plain), plain), plain)
+
+        # histogram index of float32 values without indirect sort
+        vec = np.concatenate([house.ravel(), -house.ravel(), [-0., 0., np.inf]]).astype('float32')
+        vals, cnts, idxs = HistogramMatcher.sort_index(vec)
+        ref_vals, ref_idxs, ref_cnts = np.unique(vec, return_inverse=True, return_counts=True)
+
+        # assertion
+        self.assertTrue(np.allclose(res, seq, atol=1e-5))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip((vals, cnts, idxs), (ref_vals, ref_cnts, ref_idxs))))
+
+    def test_benchmark(self):
+
+        # benchmark on small synthetic images within the test process
+        report = run_benchmark(methods=('hm', 'mkl', 'hm-mkl-hm'), height=24, width=32, bit_depth=16, repeats=2,
+                               warmup=0, isolate=False)
+        report = json.loads(json.dumps(report))
+
+        # assertion
+        self.assertEqual(['hm', 'mkl', 'hm-mkl-hm'], list(report['results']))
+        self.assertTrue(all(res['megapixels_per_s'] > 0 for res in report['results'].values()))
+        self.assertTrue(all(stage in report['results']['hm-mkl-hm']['stages']
+                            for stage in ('io_load', 'init_vars', 'solver', 'apply', 'hist_match', 'io_save')))
+
+        # float images are passed through files without quantization
+        img = synth_img(24, 32, bit_depth=32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_bench_img(img, os.path.join(tmp_dir, 'src.npy'), 'npy')
+            self.assertTrue(np.array_equal(img, load_bench_img(os.path.join(tmp_dir, 'src.npy'))))
+        report = run_benchmark(methods=('hm',), height=24, width=32, bit_depth=32, repeats=1, warmup=0, isolate=False)
+        self.assertTrue(report['results']['hm']['megapixels_per_s'] > 0)
+
+    def test_benchmark_startup(self):
+
+        # startup of fresh interpreters where package import defers matchers and imaging libraries
+        report = run_benchmark(methods=(), repeats=1, warmup=0, startup=True)
+
+        # assertion
+        self.assertEqual({}, report['results'])
+        self.assertEqual([], report['startup']['import_loads'])
+        self.assertTrue(all(report['startup'][name]['p50'] > 0 for name in ('import', 'import_matcher', 'cli_help')))
+
+    @idata(([dtype] for dtype in ['uint8', 'float32', 'float64']))
+    @unpack
+    def test_reinhard_fused(self, dtype):
+
+        # images with zeros in source and reference
+        src = (np.random.rand(30, 40, 3) * 255).astype(dtype)
+        ref = (np.random.rand(20, 30, 3) * 255).astype(dtype)
+        src[:5], ref[:3] = 0, 0
+        src_copy, ref_copy = src.copy(), ref.copy()
+        rm = ReinhardMatcher()
+
+        # fused transfer vs. conversion to and alignment in Lab space
+        res = rm.reinhard(src, ref)
+        lab_src, lab_ref = rm.rgb2lab(src), rm.rgb2lab(ref)
+        std_ratios = np.std(lab_ref, axis=1) / np.std(lab_src, axis=1)
+        lab = rm.lab_align(lab_src, np.mean(lab_src, axis=1), std_ratios, np.mean(lab_ref, axis=1))
+        exp = rm.lab2rgb(lab).reshape(src.shape)
+
+        # assertion
+        self.assertTrue(np.array_equal(src, src_copy) and np.array_equal(ref, ref_copy))
+        self.assertTrue(np.allclose(exp, res, atol=1e-2))
+        self.assertTrue(np.allclose(rm.lab_stats(ref), (np.mean(lab_ref, axis=1), np.std(lab_ref, axis=1))))
+
+    @idata(([m] for m in METHODS))
+    @unpack
+    def test_video_matcher(self, method):
+
+        # frames of randomly jittering crops and a reference of equal size as required by the analytical MVGD solver
+        plain = load_img_file(os.path.join(self.dat_path, 'scotland_plain.png'))[:, :300]
+        house = load_img_file(os.path.join(self.dat_path, 'scotland_house.png'))
+        frames = [house[:, o:o+300] for o in np.random.default_rng(0).integers(0, 180, 10)]
+
+        # without smoothing the first frame is matched as by a single transfer
+        res = next(VideoMatcher(method=method, alpha=1, threshold=0).transfer(iter(frames), plain))
+        exp = ColorMatcher(method=method).transfer(src=frames[0], ref=plain)
+
+        # transforms of consecutive frames applied to the same image reveal flicker
+        vm, cm = VideoMatcher(method=method, threshold=3e-2), ColorMatcher(method=method)
+        smooth, single = [], []
+        for frame, _ in zip(frames, vm.transfer(frames, plain)):
+            smooth.append(vm.transform(frames[0]))
+            cm.transfer(src=frame, ref=plain)
+            single.append(cm.get_transform()(frames[0]))
+        flicker = lambda seq: np.mean([np.abs(a - b).mean() for a, b in zip(seq[1:], seq[:-1])])
+
+        # assertion (source distributions for histogram matching are described by quantiles)
+        self.assertTrue(np.allclose(exp, res, atol=1e-5) if 'hm' not in method else np.abs(exp - res).mean() < 1e-2)
+        self.assertTrue(flicker(smooth) < flicker(single) / 1.5)
+        self.assertTrue(vm.solves < len(frames) * len(vm.transform.stages))
+
+    def test_server(self):
+
+        # server on a free port with a cache budget of a single mkl model (including its gray scale histograms)
+        server = MatchServer(port=0, jobs=2, cache_mb=2, method='mkl')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://%s:%s' % server.server_address[:2]
+        post = lambda route, data, ctype='image/png': urllib.request.urlopen(urllib.request.Request(
+            url + route, data=data, headers={'Content-Type': ctype}))
+        house_path, plain_path = [os.path.join(self.dat_path, 'scotland_%s.png' % n) for n in ('house', 'plain')]
+
+        try:
+            # register reference by its contents and match a source by its contents
+            with open(plain_path, 'rb') as f:
+                ref = json.loads(post('/reference', f.read()).read())
+            with open(house_path, 'rb') as f:
+                res = decode_img(post('/match?ref_id=%s' % ref['ref_id'], f.read()).read())
+
+            # match source path where the reference path resolves to the cached model
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                args = {'src': house_path, 'ref': plain_path, 'out': os.path.join(tmp_dir, 'res.png')}
+                out = json.loads(post('/match', json.dumps(args).encode(), 'application/json').read())
+                res_path = load_img_file(out['out'])
+            self.assertRaises(urllib.error.HTTPError, post, '/match?ref_id=unknown', b'')
+            metrics = json.loads(urllib.request.urlopen(url + '/metrics').read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # assertion
+        exp = ColorMatcher(method='mkl').transfer(src=load_img_file(house_path), ref=load_img_file(plain_path))
+        exp = Normalizer(exp).uint8_norm() / 255
+        self.assertTrue(np.array_equal(res, res_path) and np.allclose(exp, res, atol=1/255))
+        self.assertEqual(('miss', ref['ref_id']), (ref['cache'], out['ref_id']))
+        self.assertTrue(out['latency_s']['transfer'] > 0 and 'fit' not in out['latency_s'])
+        self.assertEqual((4, 1, 1), (metrics['requests'], metrics['errors'], metrics['cache']['models']))
+        self.assertTrue(all(stage in metrics['latency_s'] for stage in ('load', 'fit', 'transfer', 'save', 'total')))
+
+    def test_server_roots(self):
+
+        # server confining paths of requests to a root directory
+        house_path, plain_path = [os.path.join(self.dat_path, 'scotland_%s.png' % n) for n in ('house', 'plain')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server = MatchServer(port=0, jobs=1, method='mkl', roots=[tmp_dir])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            post = lambda args: urllib.request.urlopen(urllib.request.Request(
+                'http://%s:%s/match' % server.server_address[:2], data=json.dumps(args).encode(),
+                headers={'Content-Type': 'application/json'}))
+            try:
+                # paths outside of the root are refused for reading and writing
+                for args in [{'src': house_path, 'ref': plain_path, 'out': os.path.join(tmp_dir, 'res.png')},
+                             {'src': os.path.join(tmp_dir, '..', 'src.png'), 'ref': plain_path}]:
+                    with self.assertRaises(urllib.error.HTTPError) as cm:
+                        post(args)
+                    self.assertEqual(403, cm.exception.code)
+
+                # paths within the root are served
+                shutil.copy(house_path, tmp_dir)
+                shutil.copy(plain_path, tmp_dir)
+                args = {'src': os.path.join(tmp_dir, 'scotland_house.png'), 'out': os.path.join(tmp_dir, 'res.png'),
+                        'ref': os.path.join(tmp_dir, 'scotland_plain.png')}
+                out = json.loads(post(args).read())
+                self.assertTrue(os.path.isfile(out['out']))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        # non-loopback servers without roots refuse paths
+        server = MatchServer(host='0.0.0.0', port=0, jobs=1)
+        try:
+            self.assertRaises(PermissionError, server.resolve_path, house_path)
+        finally:
+            server.server_close()
+
     @unittest.skipUnless('imageio' in sys.modules, "requires imageio")
     def test_match_method_imageio(self):
 
@@ -171,6 +854,32 @@ class MatchMethodTester(unittest.TestCase):
         # assertion
         self.assertEqual(True, ret)
 
+    @idata(([1], [2]))
+    @unpack
+    def test_batch_process_jobs(self, jobs):
+
+        # folder with valid images and a corrupted file
+        tmp_path = tempfile.mkdtemp()
+        for fn in ['scotland_house.png', 'bee_2.png']:
+            shutil.copy(os.path.join(self.dat_path, fn), tmp_path)
+        with open(os.path.join(tmp_path, 'corrupted.png'), 'w') as f:
+            f.write('no image data')
+
+        # run CLI command which continues after failure and exits with summary
+        sys.argv = [sys.argv[0], '-s', tmp_path, '-r', os.path.join(self.dat_path, 'scotland_plain.png'),
+                    '--jobs=%s' % jobs]
+        try:
+            ret = main()
+        except SystemExit as e:
+            ret = e.code
+        sys.argv = [sys.argv[0]]
+        out_files = os.listdir(os.path.join(tmp_path, 'batch_proc_' + METHODS[0]))
+        shutil.rmtree(tmp_path)
+
+        # assertion
+        self.assertEqual('1 of 3 file(s) failed', ret)
+        self.assertEqual(2, len(out_files))
+
     @idata((
             # gray scale images
             [np.random.rand(5, 5, 1), np.random.rand(5, 5, 1), True],